@@ -12,6 +12,7 @@ import jwt
 from werkzeug.utils import secure_filename
 
 from src.run.utils import base_dir_for_run
+from src.cache import ledger
 from src.classification.classification_store import ClassificationIndexStore
 
 from cli import (
@@ -94,7 +95,8 @@ def run_pipeline(run_id):
             results["step_index"] = step_id
             logger.info(step)
             add_log(f"{step}")
-            globals()[pipeline_function](run_id, 'output', args)
+            with ledger.recording(base_dir_for_run(run_id, 'output'), pipeline_function):
+                globals()[pipeline_function](run_id, 'output', args)
 
         results["status"] = "completed"
         add_log("Pipeline completed")
@@ -302,7 +304,8 @@ def ask_query():
     query = flask.request.args.get("query")
     args = Args(run_id, query)
     logger.info("query :", query) 
-    response = query_with_composed_retriever(run_id, 'output', args)
+    with ledger.recording(base_dir_for_run(run_id, 'output'), "query_with_composed_retriever"):
+        response = query_with_composed_retriever(run_id, 'output', args)
     logger.info("response for run_id :", run_id, "and query :", query, " with args :", args, " is :", response)
 
     return flask.jsonify({
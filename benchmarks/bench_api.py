@@ -0,0 +1,279 @@
+"""Load test of the API read and query endpoints against the fake Ollama server.
+
+Starts the Flask app of `api.py` in another process (threaded werkzeug
+server) on a prepared run, or targets a running API with `--url`. Virtual
+users, each with a JWT minted by `create_token`, replay a mix of browse and
+ask requests in a closed loop for `--duration` seconds:
+
+    /category_tree, /tree, /node_text, /node_summary, /similar_nodes, /store, /ask_query
+
+and the throughput, the p50/p95/p99 latencies and the error rate of each
+endpoint are reported. The LLM cache of the API is disabled, unless `--cache`.
+
+Without `--run_id`, a run of `--size` synthetic documents is first prepared
+with the pipeline benchmark. A prepared run is read from the `output`
+directory of `--app_dir`, as the API does.
+
+Usage:
+    python -m benchmarks.bench_api [--size 100 | -r RUN_ID --app_dir .] [--users 1,8,32] [--duration 30] \\
+        [--mix category_tree:20,node_text:25,ask_query:5,...] [-o bench_api.json] [--baseline previous.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import httpx
+
+from benchmarks import bench_pipeline
+from benchmarks.bench_query import prepare_run
+from benchmarks.common import (
+    RESULTS_DIR,
+    compare_results,
+    latency_summary,
+    print_regressions,
+    read_results,
+    write_results,
+)
+from benchmarks.fake_ollama import add_server_args, server_process
+
+logger = logging.getLogger(__name__)
+
+# relative weights of the endpoints in the requests of a user
+DEFAULT_MIX = "category_tree:15,tree:10,node_text:25,node_summary:20,similar_nodes:20,store:2,ask_query:8"
+REGRESSION_KEYS = ["users", "endpoint"]
+REGRESSION_METRICS = ["p50", "p95", "p99"]
+QUERIES = [
+    "What happened to the little girl in the forest?",
+    "What did the government say about inflation?",
+    "Which stories are about a dragon?",
+    "What do analysts expect before the elections?",
+]
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    endpoints = []
+    for item in mix.split(","):
+        endpoint, weight = item.split(":")
+        endpoints.append((endpoint.strip(), float(weight)))
+    return endpoints
+
+
+def run_targets(store_path: str) -> Dict[str, List[str]]:
+    """Ids of the documents and the tree locations of a run, the arguments of the requests."""
+    with open(store_path) as f:
+        store = json.load(f)
+    document_ids = [node_id for node_ids in store["tree"].values() for node_id in node_ids]
+    locations = list(store.get("tree_summary", {})) + list(store.get("tree_path_summary", {})) + ["root"]
+    return {"documents": document_ids or ["unknown"], "locations": locations}
+
+
+def request_for(endpoint: str, rng: random.Random, run_id: str, targets: Dict[str, List[str]]) -> Tuple[str, dict]:
+    """Path and query parameters of a request to an endpoint."""
+    if endpoint in ["node_text", "similar_nodes"]:
+        return f"/{endpoint}", {"node_id": rng.choice(targets["documents"])}
+    if endpoint == "node_summary":
+        return "/node_summary", {"node_id": rng.choice(targets["locations"])}
+    if endpoint == "store":
+        return "/store", {"run_id": run_id}
+    if endpoint == "ask_query":
+        return "/ask_query", {"query": rng.choice(QUERIES)}
+    return f"/{endpoint}", {}
+
+
+def user_loop(user_index: int, url: str, token: str, mix: List[Tuple[str, float]], run_id: str, targets: Dict[str, List[str]],
+              deadline: float, think_time: float, timeout: float, results: List[tuple], results_lock: threading.Lock) -> None:
+    rng = random.Random(user_index)
+    endpoints, weights = zip(*mix)
+    with httpx.Client(base_url=url, headers={"Authorization": f"Bearer {token}"}, timeout=timeout) as client:
+        while time.monotonic() < deadline:
+            endpoint = rng.choices(endpoints, weights=weights)[0]
+            path, params = request_for(endpoint, rng, run_id, targets)
+            start = time.perf_counter()
+            try:
+                response = client.get(path, params=params)
+                response.read()
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latency = time.perf_counter() - start
+            with results_lock:
+                results.append((endpoint, status, latency))
+            if think_time > 0:
+                time.sleep(rng.expovariate(1 / think_time))
+
+
+def run_level(users: int, url: str, token: str, mix, run_id: str, targets, args) -> List[dict]:
+    results: List[tuple] = []
+    results_lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=user_loop, args=(i, url, token, mix, run_id, targets, deadline, args.think_time, args.timeout, results, results_lock))
+        for i in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    by_endpoint = defaultdict(list)
+    for endpoint, status, latency in results:
+        by_endpoint[endpoint].append((status, latency))
+    by_endpoint["all"] = [(status, latency) for _, status, latency in results]
+    rows = []
+    for endpoint in [endpoint for endpoint, _ in mix] + ["all"]:
+        requests = by_endpoint.get(endpoint, [])
+        statuses = defaultdict(int)
+        for status, _ in requests:
+            statuses[str(status)] += 1
+        errors = sum(count for status, count in statuses.items() if status != "200")
+        rows.append({
+            "users": users,
+            "endpoint": endpoint,
+            **latency_summary(latency for _, latency in requests),
+            "requests_per_second": len(requests) / elapsed if elapsed > 0 else 0.0,
+            "errors": errors,
+            "error_rate": errors / len(requests) if requests else 0.0,
+            "statuses": dict(statuses),
+        })
+    return rows
+
+
+def serve(args) -> None:
+    """Serve the API, in the process started by `api_process`."""
+    from werkzeug.serving import make_server
+    import api
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", args.port, api.app, threaded=True)
+    server.serve_forever()
+
+
+def api_process(args, app_dir: str, llm_url: str, work_dir: str):
+    """Url and process of the API served on the fake LLM."""
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [repo_dir, os.environ.get("PYTHONPATH")])),
+        "OLLAMA_BASE_URL": llm_url,
+        "OLLAMA_BASE_URLS": llm_url,
+        "CACHES_DIR": os.path.join(work_dir, "cache"),
+    }
+    if not args.cache:
+        env["DISABLE_CACHE"] = "true"
+    command = [sys.executable, "-m", "benchmarks.bench_api", "--serve", "--port", str(port)] + (["--verbose"] if args.verbose else [])
+    process = subprocess.Popen(command, cwd=app_dir, env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 120
+    while True:
+        try:
+            httpx.get(url, timeout=1)
+            return url, process
+        except httpx.HTTPError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError(f"API did not start on {url}")
+            time.sleep(0.5)
+
+
+def print_rows(rows: List[dict]) -> None:
+    print(f"{'users':>5} {'endpoint':<16} {'requests':>8} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7}")
+    for row in rows:
+        if not row["count"]:
+            continue
+        print(
+            f"{row['users']:>5} {row['endpoint']:<16} {row['count']:>8} {row['requests_per_second']:>8.1f} "
+            + " ".join(f"{row[key] * 1000:>7.1f}ms" for key in ["p50", "p95", "p99"])
+            + f" {row['error_rate']:>6.1%}"
+        )
+
+
+def bench(args) -> int:
+    from src.user.user import create_token
+
+    work_dir = tempfile.mkdtemp(prefix="bench_api_")
+    app_dir = os.path.abspath(args.app_dir)
+    if args.run_id is None:
+        app_dir = os.path.dirname(prepare_run(args, work_dir))
+        args.run_id = bench_pipeline.RUN_ID
+    store_path = os.path.join(app_dir, "output", f"run_{args.run_id}", "store_5.json")
+    targets = run_targets(store_path)
+    token = create_token("bench@example.com", api_key="bench", run_id=args.run_id)
+    mix = parse_mix(args.mix)
+
+    api = None
+    try:
+        with server_process(args) as llm_url:
+            if args.url is not None:
+                url = args.url
+            else:
+                url, api = api_process(args, app_dir, llm_url, work_dir)
+            rows = []
+            for users in [int(level) for level in args.users.split(",")]:
+                rows.extend(run_level(users, url, token, mix, args.run_id, targets, args))
+                print(f"{users} users done", file=sys.stderr)
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_rows(rows)
+    write_results(args.output, "api", vars(args), rows)
+    if args.baseline is not None:
+        regressions = compare_results(
+            rows, read_results(args.baseline)["rows"], REGRESSION_KEYS, REGRESSION_METRICS,
+            tolerance=args.tolerance, min_value=args.min_value,
+        )
+        print_regressions(regressions, REGRESSION_KEYS)
+        return 1 if regressions else 0
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test of the API endpoints, against a fake LLM.")
+    parser.add_argument("-r", "--run_id", type=str, default=None, help="prepared run, instead of a synthetic one")
+    parser.add_argument("--app_dir", type=str, default=".", help="directory of the output directory of the prepared run")
+    parser.add_argument("--url", type=str, default=None, help="url of a running API, instead of starting one")
+    parser.add_argument("--size", type=int, default=100, help="documents of the synthetic run")
+    parser.add_argument("--users", type=str, default="1,8,32", help="comma separated numbers of concurrent users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per number of users")
+    parser.add_argument("--think_time", type=float, default=0.0, help="mean seconds between the requests of a user")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds before a request fails")
+    parser.add_argument("--mix", type=str, default=DEFAULT_MIX, help="endpoint:weight list of the requests")
+    parser.add_argument("--cache", action="store_true", help="keep the LLM cache of the API enabled")
+    parser.add_argument("-o", "--output", type=str, default=os.path.join(RESULTS_DIR, "bench_api.json"), help="JSON result file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative growth of a latency reported as a regression")
+    parser.add_argument("--min_value", type=float, default=0.005, help="baseline latencies under this one are not compared")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the logs of the API")
+    add_server_args(parser)
+    # API served in the process started by `api_process`
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    args = parse_args()
+    if args.serve:
+        serve(args)
+    else:
+        sys.exit(bench(args))
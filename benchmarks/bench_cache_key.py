@@ -0,0 +1,98 @@
+"""Microbenchmark of the file cache keys.
+
+Compares the current cache keys (`cache_key`, canonical blake2b stream) with the
+former md5 based `recursive_hash` keys (`legacy_cache_key`) on payloads shaped
+like the pipeline calls: tree summaries of repacked chunks, chat histories,
+classification prompts and embedding batches.
+
+Usage:
+    python -m benchmarks.bench_cache_key [-n NUMBER]
+"""
+
+import argparse
+import inspect
+import random
+import timeit
+
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.prompts import PromptTemplate
+from llama_index.core.prompts.default_prompt_selectors import DEFAULT_TREE_SUMMARIZE_PROMPT_SEL
+
+from src.cache import wrapper
+from src.cache.file_cache import cache_key, hash_code, legacy_cache_key
+from src.classification.classification_assignment_extractor import DEFAULT_TYPE_ASSIGN_PROMPT
+
+WORDS = "the king took a long bath and the little girl played with a red ball near the big pit".split()
+
+
+def random_text(rng: random.Random, nb_chars: int) -> str:
+    words = []
+    size = 0
+    while size < nb_chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+
+def build_payloads(rng: random.Random):
+    """(name, cached function, key function, args, kwargs) of realistic calls."""
+    chunks = [random_text(rng, 1500) for _ in range(10)]
+    history = [
+        ChatMessage(role=MessageRole.USER if i % 2 == 0 else MessageRole.ASSISTANT, content=random_text(rng, 1000))
+        for i in range(30)
+    ]
+    category_tree_str = "\n".join(f"- {random_text(rng, 20)}\n  - {random_text(rng, 20)}" for _ in range(40))
+    return [
+        (
+            "tree summary (10 chunks)",
+            wrapper.predict_with_cache,
+            wrapper.predict_cache_key,
+            (DEFAULT_TREE_SUMMARIZE_PROMPT_SEL,),
+            {"context_str": "\n\n".join(chunks), "query_str": random_text(rng, 200)},
+        ),
+        (
+            "classification assign",
+            wrapper.predict_with_cache,
+            wrapper.predict_cache_key,
+            (PromptTemplate(template=DEFAULT_TYPE_ASSIGN_PROMPT),),
+            {"context_str": random_text(rng, 800), "category_tree_str": category_tree_str, "timeout": 10},
+        ),
+        (
+            "chat history (30 messages)",
+            wrapper.chat_with_cache,
+            wrapper.chat_cache_key,
+            (history,),
+            {},
+        ),
+        (
+            "embedding batch (10 texts)",
+            wrapper._get_text_embeddings_with_cache,
+            wrapper.embeddings_cache_key,
+            (chunks,),
+            {},
+        ),
+    ]
+
+
+def bench(number: int):
+    wrapper.LLMWrapper(model="benchmark-model")
+    wrapper.EmbeddingWrapper(model="benchmark-embedding-model")
+
+    payloads = build_payloads(random.Random(0))
+    print(f"{'payload':<30} {'legacy (us)':>12} {'current (us)':>13} {'speedup':>8}")
+    for name, cached_func, key_func, args, kwargs in payloads:
+        func = inspect.unwrap(cached_func)
+        source_hash = hash_code(inspect.getsource(func))
+        legacy_time = timeit.timeit(lambda: legacy_cache_key(func, source_hash, args, kwargs), number=number)
+        current_time = timeit.timeit(lambda: cache_key(func, source_hash, args, kwargs, key_func=key_func), number=number)
+        legacy_us = legacy_time / number * 1e6
+        current_us = current_time / number * 1e6
+        print(f"{name:<30} {legacy_us:>12.1f} {current_us:>13.1f} {legacy_us / current_us:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the file cache keys.")
+    parser.add_argument("-n", "--number", type=int, default=200, help="number of keys computed per payload")
+    args = parser.parse_args()
+    bench(args.number)
@@ -0,0 +1,327 @@
+"""Scaling benchmark of the ClassificationIndexStore methods.
+
+Builds synthetic stores of documents classified in a tree of `--branching`
+categories per level over `--depth` levels, with tags, similar documents,
+leaf and path summaries, saved in the `store_*.json` format. For each size,
+times `from_store_path`, `persist` and every public method, with arguments
+like those of the API requests, and fits the growth of the time of each
+method with the number of nodes: an exponent of 1 is linear, 2 quadratic.
+
+A method whose time at the next size is expected over `--max_seconds`,
+from its growth so far, is skipped at this size and the larger ones.
+
+Usage:
+    python -m benchmarks.bench_classification_store [--sizes 1000,10000,100000] [--branching 8] [--depth 3] \\
+        [-o bench_classification_store.json] [--baseline previous.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+
+from benchmarks.common import (
+    RESULTS_DIR,
+    compare_results,
+    fit_exponent,
+    format_bytes,
+    print_regressions,
+    read_results,
+    write_results,
+)
+from src.classification.classification_store import ClassificationIndexStore
+
+logger = logging.getLogger(__name__)
+
+REGRESSION_KEYS = ["nodes", "method"]
+REGRESSION_METRICS = ["seconds"]
+# exponent assumed for a method timed at a single size, to decide whether to skip the next one
+DEFAULT_EXPONENT = 2.0
+# the persistence methods are timed at all the sizes, being needed to build the stores anyway
+ALWAYS_TIMED = ["from_store_path", "persist"]
+WORDS = "the report describes a study of markets stars rivers kings cells and laws in many countries".split()
+
+
+def tree_leaves(branching: int, depth: int) -> List[List[str]]:
+    leaves = [[]]
+    for level in range(depth):
+        leaves = [path + [f"Topic {level + 1}.{i + 1}"] for path in leaves for i in range(branching)]
+    return leaves
+
+
+def random_text(rng: random.Random, nb_chars: int) -> str:
+    words = []
+    size = 0
+    while size < nb_chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+
+def classification_yaml(location: List[str], tags: List[str]) -> str:
+    lines = ["hierarchical_classification:"]
+    lines.extend(f"{'  ' * depth}- {name}" for depth, name in enumerate(location))
+    lines.append("tags:")
+    lines.extend(f"- {tag}" for tag in tags)
+    return "\n".join(lines)
+
+
+def document_node(i: int, rng: random.Random, leaves: List[List[str]], tags: List[str], nb_nodes: int, text_chars: int) -> TextNode:
+    location = rng.choice(leaves)
+    node_tags = rng.sample(tags, rng.randint(1, 3))
+    node = TextNode(
+        id_=f"doc-{i}",
+        text=random_text(rng, text_chars),
+        metadata={
+            "title": f"Document {i}",
+            "classification_location_and_tags": classification_yaml(location, node_tags),
+            "classification_tree_location": location,
+            "classification_tags": node_tags,
+            "similar_ids": [f"doc-{rng.randrange(nb_nodes)}" for _ in range(5)],
+            "url": f"https://example.com/{i}",
+            "file_name": f"document_{i}.pdf",
+        },
+    )
+    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=f"source-{i}")
+    return node
+
+
+def build_store_data(nb_nodes: int, branching: int, depth: int, nb_tags: int, text_chars: int, seed: int) -> dict:
+    """Data of a store of `nb_nodes` documents, in the persisted format."""
+    rng = random.Random(seed)
+    leaves = tree_leaves(branching, depth)
+    tags = [f"Tag {i + 1}" for i in range(nb_tags)]
+    tree: Dict[str, List[str]] = {}
+    tags_nodes: Dict[str, List[str]] = {}
+    nodes = []
+    for i in range(nb_nodes):
+        node = document_node(i, rng, leaves, tags, nb_nodes, text_chars)
+        tree.setdefault(" - ".join(node.metadata["classification_tree_location"]), []).append(node.id_)
+        for tag in node.metadata["classification_tags"]:
+            tags_nodes.setdefault(tag, []).append(node.id_)
+        nodes.append(node)
+
+    tree_summary = {}
+    for location in tree:
+        summary_node = TextNode(id_=f"summary-{location}", text=random_text(rng, text_chars), metadata={"summary_for_tree_location": location})
+        tree_summary[location] = summary_node.id_
+        nodes.append(summary_node)
+    paths = {""} | {" - ".join(leaf[:i + 1]) for leaf in leaves for i in range(len(leaf) - 1)}
+    tree_path_summary = {}
+    for path in sorted(paths):
+        summary_node = TextNode(id_=f"path-summary-{path}", text=random_text(rng, text_chars), metadata={"summary_for_tree_location": path})
+        tree_path_summary[path] = summary_node.id_
+        nodes.append(summary_node)
+
+    return {
+        "tree_schema": sorted(tree),
+        "tag_list": sorted(tags_nodes),
+        "tree_summary": tree_summary,
+        "tree_path_summary": tree_path_summary,
+        "tree": tree,
+        "tags": tags_nodes,
+        "types": [],
+        "types_prompt": {},
+        "nodes": [node.to_dict() for node in nodes],
+    }
+
+
+def time_call(fn: Callable[[], object], min_time: float, max_repeat: int) -> Tuple[float, int]:
+    """Median seconds per call and number of calls, repeated until `min_time` seconds."""
+    times = []
+    total = 0.0
+    while total < min_time and len(times) < max_repeat:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        times.append(elapsed)
+        total += elapsed
+    return statistics.median(times), len(times)
+
+
+def store_calls(store: ClassificationIndexStore, store_path: str, persist_path: str, args, rng: random.Random):
+    """(method, call, max repeats) of the benchmarked calls, the calls changing the store last."""
+    document_ids = [node_id for node_ids in store._tree.values() for node_id in node_ids]
+    locations = list(store._tree)
+    paths = list(store._tree_path_summary)
+    tags = list(store._tags)
+    leaves = tree_leaves(args.branching, args.depth)
+    tag_names = [f"Tag {i + 1}" for i in range(args.tags)]
+    new_nodes = [
+        document_node(len(document_ids) + i, rng, leaves, tag_names, len(document_ids), args.text_chars)
+        for i in range(args.max_repeat)
+    ]
+    new_summary_nodes = [
+        TextNode(id_=f"new-summary-{i}", text="summary", metadata={"summary_for_tree_location": rng.choice(locations)})
+        for i in range(args.max_repeat)
+    ]
+
+    def pick(values):
+        return lambda: values[rng.randrange(len(values))]
+
+    random_document, random_location, random_path, random_tag = pick(document_ids), pick(locations), pick(paths), pick(tags)
+    new_nodes_iter, new_summary_nodes_iter = iter(new_nodes), iter(new_summary_nodes)
+
+    def sub_category_tree(path):
+        # category of the API tree, "root" or "root - A - B"
+        return store.get_sub_category_tree(path.split(" - ")[-1], f"root - {path}") if path else store.get_sub_category_tree("root", "root")
+
+    return [
+        ("from_store_path", lambda: ClassificationIndexStore.from_store_path(store_path), args.max_repeat),
+        ("get_nodes", lambda: store.get_nodes([random_document() for _ in range(10)]), args.max_repeat),
+        ("get_node_text", lambda: store.get_node_text(random_document()), args.max_repeat),
+        ("get_node_id_summary", lambda: store.get_node_id_summary(random_location()), args.max_repeat),
+        ("get_path_summary_id", lambda: store.get_path_summary_id(random_path()), args.max_repeat),
+        ("get_nodes_id_from_tree_location", lambda: store.get_nodes_id_from_tree_location(random_location()), args.max_repeat),
+        ("get_tags", store.get_tags, args.max_repeat),
+        ("get_nodes_id_from_tag", lambda: store.get_nodes_id_from_tag(random_tag()), args.max_repeat),
+        ("get_similar_nodes_id", lambda: store.get_similar_nodes_id(random_document()), args.max_repeat),
+        ("get_node_filename", lambda: store.get_node_filename(random_document()), args.max_repeat),
+        ("get_node_url", lambda: store.get_node_url(random_document()), args.max_repeat),
+        ("get_urls_from_run", store.get_urls_from_run, args.max_repeat),
+        ("get_all_tree_paths", store.get_all_tree_paths, args.max_repeat),
+        ("get_tree_digraph_nodes_and_edges", store.get_tree_digraph_nodes_and_edges, args.max_repeat),
+        ("get_tags_digraph_nodes_and_edges", store.get_tags_digraph_nodes_and_edges, args.max_repeat),
+        ("get_sub_category_tree", lambda: sub_category_tree(random_path()), args.max_repeat),
+        ("get_category_tree", store.get_category_tree, args.max_repeat),
+        ("update_text_node", lambda: store.update_text_node(TextNode(id_=random_document(), text="updated text")), args.max_repeat),
+        ("insert_node", lambda: store.insert_node(next(new_nodes_iter)), len(new_nodes)),
+        ("update_summary_nodes", lambda: store.update_summary_nodes([next(new_summary_nodes_iter)]), len(new_summary_nodes)),
+        ("persist", store.persist, args.max_repeat),
+    ]
+
+
+def bench_size(nb_nodes: int, args, work_dir: str, skipped: Dict[str, float], history: Dict[str, List[Tuple[int, float]]]) -> List[dict]:
+    data = build_store_data(nb_nodes, args.branching, args.depth, args.tags, args.text_chars, args.seed)
+    store_path = os.path.join(work_dir, f"store_{nb_nodes}.json")
+    persist_path = os.path.join(work_dir, f"store_{nb_nodes}_persisted.json")
+    with open(store_path, "w") as f:
+        json.dump(data, f, indent=4)
+    store_size = os.path.getsize(store_path)
+    del data
+
+    start = time.perf_counter()
+    store = ClassificationIndexStore.from_store_path(store_path)
+    load_seconds = time.perf_counter() - start
+    store._persist_path = persist_path
+    rng = random.Random(args.seed)
+    rows = []
+    for method, call, max_repeat in store_calls(store, store_path, persist_path, args, rng):
+        row = {"nodes": nb_nodes, "method": method, "store_bytes": store_size, "seconds": None, "calls": 0, "skipped": False}
+        # expected time from the growth of the method on the smaller stores
+        points = history.get(method, [])
+        if method == "from_store_path" and load_seconds >= args.min_time:
+            # the store was just loaded, long enough to be timed once
+            row.update({"seconds": load_seconds, "calls": 1})
+            history.setdefault(method, []).append((nb_nodes, load_seconds))
+        elif method in ALWAYS_TIMED:
+            pass
+        elif method in skipped:
+            row.update({"skipped": True, "estimated_seconds": skipped[method]})
+        elif points:
+            exponent = fit_exponent([n for n, _ in points], [t for _, t in points]) if len(points) > 1 else None
+            last_nodes, last_seconds = points[-1]
+            estimated = last_seconds * (nb_nodes / last_nodes) ** max(exponent or DEFAULT_EXPONENT, 0)
+            if estimated > args.max_seconds:
+                skipped[method] = estimated
+                row.update({"skipped": True, "estimated_seconds": estimated})
+        if not row["skipped"] and row["seconds"] is None:
+            seconds, calls = time_call(call, args.min_time, max_repeat)
+            row.update({"seconds": seconds, "calls": calls})
+            history.setdefault(method, []).append((nb_nodes, seconds))
+        rows.append(row)
+        status = f"skipped, ~{row['estimated_seconds']:.0f}s expected" if row["skipped"] else f"{row['seconds'] * 1000:.3f}ms"
+        print(f"{nb_nodes} nodes, {method}: {status}", file=sys.stderr)
+    return rows
+
+
+def print_rows(rows: List[dict], sizes: List[int], exponents: Dict[str, float]) -> None:
+    methods = list(dict.fromkeys(row["method"] for row in rows))
+    by_key = {(row["nodes"], row["method"]): row for row in rows}
+    print(f"{'method':<36}" + "".join(f"{f'{size} nodes':>16}" for size in sizes) + f"{'growth':>10}")
+    for method in methods:
+        cells = []
+        for size in sizes:
+            row = by_key.get((size, method))
+            if row is None:
+                cells.append(f"{'-':>16}")
+            elif row["skipped"]:
+                cells.append(f"{'~' + format_seconds(row['estimated_seconds']):>16}")
+            else:
+                cells.append(f"{format_seconds(row['seconds']):>16}")
+        exponent = exponents.get(method)
+        growth = f"O(n^{exponent:.1f})" if exponent is not None else "-"
+        print(f"{method:<36}" + "".join(cells) + f"{growth:>10}")
+    store_sizes = {row["nodes"]: row["store_bytes"] for row in rows}
+    print("store file: " + ", ".join(f"{size} nodes {format_bytes(store_sizes[size])}" for size in sizes if size in store_sizes))
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds:.2f}s"
+
+
+def bench(args) -> int:
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+    work_dir = tempfile.mkdtemp(prefix="bench_classification_store_")
+    skipped: Dict[str, float] = {}
+    history: Dict[str, List[Tuple[int, float]]] = {}
+    rows = []
+    try:
+        for nb_nodes in sizes:
+            rows.extend(bench_size(nb_nodes, args, work_dir, skipped, history))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    exponents = {
+        method: fit_exponent([n for n, _ in points], [t for _, t in points])
+        for method, points in history.items()
+    }
+    exponents = {method: exponent for method, exponent in exponents.items() if exponent is not None}
+    print_rows(rows, sizes, exponents)
+    write_results(args.output, "classification_store", vars(args), rows, summary={"exponents": exponents})
+
+    if args.baseline is not None:
+        regressions = compare_results(
+            rows, read_results(args.baseline)["rows"], REGRESSION_KEYS, REGRESSION_METRICS,
+            tolerance=args.tolerance, min_value=args.min_value,
+        )
+        print_regressions(regressions, REGRESSION_KEYS)
+        return 1 if regressions else 0
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the ClassificationIndexStore methods on synthetic stores.")
+    parser.add_argument("--sizes", type=str, default="1000,10000,100000", help="comma separated numbers of documents")
+    parser.add_argument("--branching", type=int, default=8, help="sub categories per category")
+    parser.add_argument("--depth", type=int, default=3, help="levels of the classification tree")
+    parser.add_argument("--tags", type=int, default=50, help="number of tags")
+    parser.add_argument("--text_chars", type=int, default=500, help="characters of the texts of the nodes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min_time", type=float, default=0.2, help="seconds of calls timed per method and size")
+    parser.add_argument("--max_repeat", type=int, default=200, help="max calls timed per method and size")
+    parser.add_argument("--max_seconds", type=float, default=30, help="skip a call expected to take longer")
+    parser.add_argument("-o", "--output", type=str, default=os.path.join(RESULTS_DIR, "bench_classification_store.json"), help="JSON result file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative growth of a time reported as a regression")
+    parser.add_argument("--min_value", type=float, default=1e-4, help="baseline times under this one are not compared")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    sys.exit(bench(parse_args()))
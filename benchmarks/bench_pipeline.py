@@ -0,0 +1,319 @@
+"""End-to-end scaling benchmark of the pipeline steps against the fake Ollama server.
+
+For each corpus size, a synthetic corpus is built from the bundled stories,
+news and papers (`data/`), repeated with variations up to the size, or
+generated if the data is not there, with the document IDs of the loaders. Each step of `cli.pipeline_steps` then runs on it, in
+a fresh process with an empty cache, and is measured: wall time, CPU time,
+peak RSS, bytes written, requests and tokens received by the fake server,
+and calls served by the cache (from the ledger of the run).
+
+The results are written as JSON. With `--baseline`, the steps slower, more
+memory hungry or making more LLM calls than in a previous result file by
+more than `--tolerance` are reported and the benchmark exits with status 1.
+
+Usage:
+    python -m benchmarks.bench_pipeline [--sizes 100,1000,10000] [--steps 1-12] [--time_scale 0.1] \\
+        [-o bench_pipeline.json] [--baseline previous.json --tolerance 0.25]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import List, Tuple
+
+from benchmarks.common import (
+    RESULTS_DIR,
+    compare_results,
+    counters_delta,
+    fetch_json,
+    format_bytes,
+    measure,
+    print_regressions,
+    read_results,
+    write_results,
+)
+from benchmarks.fake_ollama import add_server_args, server_from_args
+
+logger = logging.getLogger(__name__)
+
+STORIES_PATH = "data/tiny_stories/TinyStoriesV2-GPT4-valid.txt"
+NEWS_PATH = "data/news_articles/news_articles.csv"
+PAPERS_DIR = "data/papers"
+RUN_ID = "bench"
+DEFAULT_QUERY = "What happened to the little girl in the forest?"
+# metrics compared to the baseline, and the keys of the compared rows
+REGRESSION_METRICS = ["wall_time", "cpu_time", "peak_rss", "bytes_written", "llm_requests"]
+REGRESSION_KEYS = ["size", "step"]
+
+NAMES = ["Lily", "Tom", "Mia", "Ben", "Sue", "Max", "Anna", "Tim"]
+ANIMALS = ["cat", "dog", "bird", "fox", "bear", "frog", "rabbit", "dragon"]
+PLACES = ["forest", "park", "garden", "castle", "river", "village", "school", "beach"]
+VERBS = ["play", "run", "sing", "jump", "read", "dance", "swim", "build"]
+INSTITUTIONS = ["government", "central bank", "ministry of health", "city council", "university", "court"]
+SUBJECTS = ["inflation", "the new budget", "the election", "the vaccine campaign", "the housing market", "the strike"]
+FIELDS = ["astrophysics", "genomics", "machine learning", "climate science", "quantum computing", "epidemiology"]
+METHODS = ["a transformer model", "a Bayesian analysis", "Monte Carlo simulations", "a randomized trial", "a new spectrometer"]
+
+
+def synthetic_story(rng: random.Random) -> str:
+    name, animal, place = rng.choice(NAMES), rng.choice(ANIMALS), rng.choice(PLACES)
+    sentences = [f"Once upon a time, there was a little {animal} named {name}."]
+    for _ in range(rng.randint(8, 25)):
+        sentences.append(rng.choice([
+            f"{name} liked to {rng.choice(VERBS)} in the {rng.choice(PLACES)}.",
+            f"One day, {name} met a {rng.choice(ANIMALS)} near the {place}.",
+            f"They wanted to {rng.choice(VERBS)} together, but it started to rain.",
+            f"The {rng.choice(ANIMALS)} said, \"Let's {rng.choice(VERBS)} tomorrow!\"",
+            f"{name} was happy and went back home to the {place}.",
+        ]))
+    return " ".join(sentences)
+
+
+def synthetic_news(rng: random.Random) -> str:
+    institution, subject = rng.choice(INSTITUTIONS), rng.choice(SUBJECTS)
+    paragraphs = [f"The {institution} reports on {subject}: The {institution} said on Monday that {subject} was its main concern."]
+    for _ in range(rng.randint(5, 20)):
+        paragraphs.append(rng.choice([
+            f"According to officials, {subject} rose by {rng.randint(1, 40)} percent over the last year.",
+            f"The minister reported that the {rng.choice(INSTITUTIONS)} would discuss {rng.choice(SUBJECTS)} next week.",
+            f"Critics said the decision on {subject} came too late for many families.",
+            f"Analysts expect {rng.choice(SUBJECTS)} to remain a key issue before the elections.",
+        ]))
+    return " ".join(paragraphs)
+
+
+def synthetic_paper(rng: random.Random) -> str:
+    field, method = rng.choice(FIELDS), rng.choice(METHODS)
+    sentences = [f"Abstract. We study open problems of {field} with {method}."]
+    for _ in range(rng.randint(8, 25)):
+        sentences.append(rng.choice([
+            f"Our results improve the state of the art of {field} by {rng.randint(2, 30)} percent.",
+            f"We compare {method} with {rng.choice(METHODS)} on {rng.randint(3, 12)} benchmarks.",
+            f"Previous work in {rng.choice(FIELDS)} did not account for the noise of the measures.",
+            f"The code and the data of the experiments are publicly available.",
+        ]))
+    return " ".join(sentences)
+
+
+def load_base_texts(sources: List[str]) -> List[Tuple[str, str, dict]]:
+    """Source, text and metadata of the bundled data of the sources, empty if the data is not there."""
+    texts = []
+    if "stories" in sources and os.path.exists(STORIES_PATH):
+        from src.document.stories import get_stories
+        texts.extend(("stories", document.text, {}) for document in get_stories(size=1000))
+    if "news" in sources and os.path.exists(NEWS_PATH):
+        from src.document.news import get_news
+        texts.extend(("news", document.text, {}) for document in get_news(size=1000))
+    if "papers" in sources and os.path.isdir(PAPERS_DIR):
+        from src.document.papers import read_papers
+        texts.extend(("papers", document.text, {"file_name": document.metadata["file_name"]}) for document in read_papers(size=1000))
+    return texts
+
+
+def build_corpus(size: int, sources: List[str], seed: int = 0):
+    """Documents of the corpus, the first documents of a larger corpus are those of a smaller one."""
+    from llama_index.core import Document
+    from src.document.ids import set_document_ids
+    from src.document.papers import pdf_source
+
+    base_texts = load_base_texts(sources)
+    generators = [
+        (source, generator)
+        for source, generator in [("stories", synthetic_story), ("news", synthetic_news), ("papers", synthetic_paper)]
+        if source in sources
+    ]
+    documents, id_sources = [], []
+    for i in range(size):
+        rng = random.Random(seed * 1_000_003 + i)
+        if base_texts:
+            source, text, metadata = base_texts[i % len(base_texts)]
+            if i >= len(base_texts):
+                # repeated texts get a variation, to be distinct documents for the cache
+                text = f"{text}\n\n{generators[i % len(generators)][1](rng) if generators else i}"
+        else:
+            source, generator = generators[i % len(generators)]
+            text, metadata = generator(rng), {}
+            if source == "papers":
+                metadata = {"file_name": f"paper_{i}.pdf"}
+        documents.append(Document(text=text, metadata=dict(metadata)))
+        # the sources of the IDs of load_samples_documents
+        id_sources.append(pdf_source(metadata["file_name"]) if source == "papers" else source)
+    set_document_ids(documents, id_sources)
+    return documents
+
+
+def expand_steps(steps: str) -> List[str]:
+    from cli import explode_int_range_with_minus_char_and_join
+    return [step for step in explode_int_range_with_minus_char_and_join(steps).split(",") if step]
+
+
+def run_size(args) -> List[dict]:
+    """Run the steps on a corpus of `args.size` documents, in the current process."""
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    documents = build_corpus(args.size, args.sources.split(","), args.seed)
+
+    # the modules read their configuration when imported
+    os.environ["OLLAMA_BASE_URL"] = args.server_url
+    os.environ["OLLAMA_BASE_URLS"] = args.server_url
+    os.environ["CACHES_DIR"] = os.path.join(work_dir, "cache")
+    os.environ["ENABLE_LEDGER"] = "true"
+    # some steps write to the default base directory, relative to the working directory
+    os.chdir(work_dir)
+    import cli
+    from src.cache import ledger
+    from src.run.utils import base_dir_for_run, save_nodes
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    cli.set_api_key("none")
+    run_dir = base_dir_for_run(RUN_ID, "output")
+    cli_args = argparse.Namespace(query=args.query)
+
+    rows = []
+    for step in expand_steps(args.steps):
+        function_name, _ = cli.pipeline_steps[step]
+        stats_before = fetch_json(f"{args.server_url}/fake/stats")
+        row = {"size": args.size, "step": step, "function": function_name, "error": None}
+        with measure(work_dir) as metrics:
+            try:
+                if step == "0":
+                    # the corpus is loaded instead of the samples of the data directory
+                    with ledger.recording(run_dir, function_name):
+                        save_nodes(documents, os.path.join(run_dir, "nodes_0_samples.json"))
+                else:
+                    cli.run_pipeline(RUN_ID, "output", step, args=cli_args)
+            except Exception as e:
+                logger.exception(f"step {step} failed")
+                row["error"] = f"{type(e).__name__}: {e}"
+        server_delta = counters_delta(stats_before, fetch_json(f"{args.server_url}/fake/stats"))
+        row.update(metrics)
+        row.update({
+            "llm_requests": server_delta.get("chat", 0),
+            "embed_requests": server_delta.get("embed", 0),
+            "embed_texts": server_delta.get("embed_texts", 0),
+            "prompt_tokens": server_delta.get("prompt_tokens", 0),
+            "eval_tokens": server_delta.get("eval_tokens", 0),
+            "server_errors": server_delta.get("errors", 0),
+        })
+        rows.append(row)
+        print(f"size {args.size} step {step} {function_name}: {metrics['wall_time']:.1f}s, {row['llm_requests']} llm requests", file=sys.stderr)
+        if row["error"] is not None:
+            # the next steps need the output of this one
+            break
+
+    ledger_path = os.path.join(run_dir, ledger.LEDGER_FILE_NAME)
+    if os.path.exists(ledger_path):
+        summary = ledger.summarize_ledger(ledger.read_ledger(ledger_path), group_by=["step"], top=None)
+        by_step = {group["step"]: group for group in summary}
+        for row in rows:
+            group = by_step.get(row["function"], {})
+            row["ledger_calls"] = group.get("calls", 0)
+            row["ledger_cached"] = group.get("cached", 0)
+            row["ledger_retries"] = group.get("retries", 0)
+    return rows
+
+
+def run_size_in_subprocess(args, size: int, server_url: str) -> List[dict]:
+    """Run a corpus size in a new process, for an empty cache and its own peak RSS."""
+    work_dir = os.path.join(args.work_dir, f"size_{size}")
+    rows_path = os.path.join(args.work_dir, f"rows_{size}.json")
+    command = [
+        sys.executable, "-m", "benchmarks.bench_pipeline", "--child",
+        "--size", str(size), "--server_url", server_url, "--work_dir", work_dir, "--rows_output", rows_path,
+        "--steps", args.steps, "--sources", args.sources, "--seed", str(args.seed), "--query", args.query,
+    ] + (["--verbose"] if args.verbose else [])
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [repo_dir, os.environ.get("PYTHONPATH")]))}
+    completed = subprocess.run(command, cwd=repo_dir, env=env)
+    if completed.returncode != 0 or not os.path.exists(rows_path):
+        logger.error(f"size {size}: benchmark process failed with status {completed.returncode}")
+        return [{"size": size, "step": None, "function": None, "error": f"process status {completed.returncode}"}]
+    with open(rows_path) as f:
+        return json.load(f)
+
+
+def print_rows(rows: List[dict]) -> None:
+    print(
+        f"{'size':>6} {'step':>4} {'function':<52} {'wall':>8} {'cpu':>8} {'peak rss':>9} {'written':>9} "
+        f"{'llm':>6} {'embed':>6} {'tokens':>9} {'cached':>6}"
+    )
+    for row in rows:
+        if row.get("step") is None:
+            print(f"{row['size']:>6} {row['error']}")
+            continue
+        error = f"  ERROR {row['error']}" if row.get("error") else ""
+        print(
+            f"{row['size']:>6} {row['step']:>4} {row['function']:<52} {row['wall_time']:>7.2f}s {row['cpu_time']:>7.2f}s "
+            f"{format_bytes(row['peak_rss']) if 'peak_rss' in row else '-':>9} {format_bytes(row.get('bytes_written', 0)):>9} "
+            f"{row['llm_requests']:>6} {row['embed_requests']:>6} {row['prompt_tokens'] + row['eval_tokens']:>9} "
+            f"{row.get('ledger_cached', 0):>6}{error}"
+        )
+
+
+def bench(args) -> int:
+    keep_work_dir = args.work_dir is not None
+    args.work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="bench_pipeline_"))
+    server = server_from_args(args).start()
+    logger.info(f"fake Ollama server on {server.url}, work directory {args.work_dir}")
+    try:
+        rows = []
+        for size in [int(size) for size in args.sizes.split(",")]:
+            rows.extend(run_size_in_subprocess(args, size, server.url))
+    finally:
+        server.stop()
+        if not keep_work_dir:
+            shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    print_rows(rows)
+    config = {key: value for key, value in vars(args).items() if key not in ["child", "size", "server_url", "rows_output", "work_dir"]}
+    write_results(args.output, "pipeline", config, rows)
+
+    status = 1 if any(row.get("error") for row in rows) else 0
+    if args.baseline is not None:
+        regressions = compare_results(
+            rows, read_results(args.baseline)["rows"], REGRESSION_KEYS, REGRESSION_METRICS,
+            tolerance=args.tolerance, min_value=args.min_value,
+        )
+        print_regressions(regressions, REGRESSION_KEYS)
+        status = status or (1 if regressions else 0)
+    return status
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline steps on synthetic corpora, against a fake LLM.")
+    parser.add_argument("--sizes", type=str, default="100,1000,10000", help="comma separated numbers of documents")
+    parser.add_argument("--steps", type=str, default="0-12", help="steps of cli.pipeline_steps, ex: 0-12 or 0,1,2")
+    parser.add_argument("--sources", type=str, default="stories,news", help="comma separated sources of the documents: stories, news, papers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-q", "--query", type=str, default=DEFAULT_QUERY, help="query of the query step")
+    parser.add_argument("-o", "--output", type=str, default=os.path.join(RESULTS_DIR, "bench_pipeline.json"), help="JSON result file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative growth of a metric reported as a regression")
+    parser.add_argument("--min_value", type=float, default=0.1, help="baseline values under this one are not compared")
+    parser.add_argument("--work_dir", type=str, default=None, help="directory of the runs and caches, kept if given")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the logs of the pipeline")
+    add_server_args(parser)
+    # run of a single size, in the process started by `run_size_in_subprocess`
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--server_url", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--rows_output", type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    args = parse_args()
+    if args.child:
+        rows = run_size(args)
+        with open(args.rows_output, "w") as f:
+            json.dump(rows, f)
+    else:
+        sys.exit(bench(args))
@@ -0,0 +1,261 @@
+"""Latency benchmark of the query path, per stage, against the fake Ollama server.
+
+Replays a query set on a prepared run, doing what `query_with_composed_retriever`
+does for each query: load `store_5.json`, open the classification index and
+the Chroma index, then retrieve with the composed retriever and synthesize
+the answer. Each stage is timed by wrapping the objects of the query path:
+
+    load_store, open_index, open_chroma, query_embedding, vector_search,
+    tree_prompt_and_lookup (classification retrieval without its LLM call),
+    routing_llm, synthesis, end_to_end
+
+At each `--concurrency` level, `--nb_queries` queries run on that many
+threads, and the p50/p95/p99 latencies of each stage and the throughput are
+reported. The LLM cache is disabled, unless `--cache`, so that every query
+reaches the model.
+
+Without `--run_id`, a run of `--size` synthetic documents is first prepared
+with the pipeline benchmark, against a fake server without delay.
+
+Usage:
+    python -m benchmarks.bench_query [--size 100 | -r RUN_ID -b BASE_DIR] [--concurrency 1,4,16] \\
+        [--nb_queries 50] [--queries queries.txt] [-o bench_query.json] [--baseline previous.json]
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from benchmarks import bench_pipeline
+from benchmarks.common import (
+    RESULTS_DIR,
+    compare_results,
+    latency_summary,
+    print_regressions,
+    read_results,
+    write_results,
+)
+from benchmarks.fake_ollama import add_server_args, server_process
+
+logger = logging.getLogger(__name__)
+
+STAGES = [
+    "load_store", "open_index", "open_chroma", "query_embedding", "vector_search",
+    "tree_prompt_and_lookup", "routing_llm", "synthesis", "end_to_end",
+]
+REGRESSION_KEYS = ["concurrency", "stage"]
+REGRESSION_METRICS = ["p50", "p95", "p99"]
+DEFAULT_QUERIES = [
+    "What happened to the little girl in the forest?",
+    "What did the government say about inflation?",
+    "Which stories are about a dragon?",
+    "What are the main concerns of the central bank?",
+    "Who went back home after the rain?",
+    "What do analysts expect before the elections?",
+    "Which animals met near the castle?",
+    "How did the housing market change last year?",
+]
+# the Chroma clients of the process are shared, it is not safe to open them from several threads at once
+global_chroma_lock = threading.Lock()
+
+
+class Timed:
+    """Proxy of an object timing the calls to one of its methods, in `timings[stage]`."""
+
+    def __init__(self, obj, method: str, timings: Dict[str, float], stage: str) -> None:
+        self._obj = obj
+        self._method = method
+        self._timings = timings
+        self._stage = stage
+
+    def __getattr__(self, name):
+        attribute = getattr(self._obj, name)
+        if name != self._method:
+            return attribute
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self._timings[self._stage] = self._timings.get(self._stage, 0.0) + time.perf_counter() - start
+        return timed
+
+
+def run_query(query_str: str, run_id: str, base_dir: str) -> Dict[str, float]:
+    """Seconds of each stage of the query."""
+    from llama_index.core import Settings
+    from llama_index.core.query_engine import RetrieverQueryEngine
+    from llama_index.core.schema import QueryBundle
+    from src.classification.classification_index import ClassificationIndex
+    from src.classification.classification_store import ClassificationIndexStore
+    from src.compose.compose_retriever import ComposeRetriever
+    from src.run.utils import base_dir_for_run
+    from src.vector.vector import get_vector_retriever
+
+    timings: Dict[str, float] = {}
+    run_dir = base_dir_for_run(run_id, base_dir)
+    start = time.perf_counter()
+
+    def stage(name, start_time):
+        timings[name] = time.perf_counter() - start_time
+        return time.perf_counter()
+
+    stage_start = time.perf_counter()
+    store = ClassificationIndexStore.from_store_path(persist_path=os.path.join(run_dir, "store_5.json"))
+    stage_start = stage("load_store", stage_start)
+    index = ClassificationIndex.from_store(llm=Settings.llm, store=store, log_dir=run_dir)
+    classification_retriever = index.as_retriever()
+    stage_start = stage("open_index", stage_start)
+    with global_chroma_lock:
+        embedding_retriever = get_vector_retriever(run_id, base_dir)
+    stage("open_chroma", stage_start)
+
+    embedding_retriever._embed_model = Timed(embedding_retriever._embed_model, "get_agg_embedding_from_queries", timings, "query_embedding")
+    classification_retriever._llm = Timed(classification_retriever._llm, "predict", timings, "routing_llm")
+    compose_retriever = ComposeRetriever(
+        embeddings_retriever=Timed(embedding_retriever, "_retrieve", timings, "embedding_retrieval"),
+        classification_retriever=Timed(classification_retriever, "_retrieve", timings, "classification_retrieval"),
+        log_dir=run_dir,
+    )
+    query_engine = RetrieverQueryEngine(retriever=compose_retriever)
+    query_bundle = QueryBundle(query_str)
+    nodes = query_engine.retrieve(query_bundle)
+    stage_start = time.perf_counter()
+    query_engine.synthesize(query_bundle, nodes)
+    stage("synthesis", stage_start)
+    timings["end_to_end"] = time.perf_counter() - start
+
+    timings["vector_search"] = timings.pop("embedding_retrieval") - timings.get("query_embedding", 0.0)
+    timings["tree_prompt_and_lookup"] = timings.pop("classification_retrieval") - timings.get("routing_llm", 0.0)
+    return timings
+
+
+def run_level(queries: List[str], concurrency: int, nb_queries: int, run_id: str, base_dir: str) -> List[dict]:
+    stage_latencies = defaultdict(list)
+    errors = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_query, queries[i % len(queries)], run_id, base_dir) for i in range(nb_queries)]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                for name, seconds in future.result().items():
+                    stage_latencies[name].append(seconds)
+            except Exception as e:
+                errors += 1
+                logger.error(f"query failed: {type(e).__name__}: {e}")
+    elapsed = time.perf_counter() - start
+
+    rows = []
+    for name in STAGES:
+        row = {"concurrency": concurrency, "stage": name, **latency_summary(stage_latencies.get(name, []))}
+        if name == "end_to_end":
+            row.update({"errors": errors, "queries_per_second": len(stage_latencies[name]) / elapsed if elapsed > 0 else 0.0})
+        rows.append(row)
+    return rows
+
+
+def prepare_run(args, work_dir: str) -> str:
+    """Base directory of a run of the pipeline on a synthetic corpus."""
+    prepare_args = argparse.Namespace(**{
+        **vars(args), "work_dir": work_dir, "steps": "0-11", "sources": "stories,news", "seed": 0,
+        "query": bench_pipeline.DEFAULT_QUERY, "time_scale": 0, "error_rate": 0,
+    })
+    with server_process(prepare_args) as url:
+        rows = bench_pipeline.run_size_in_subprocess(prepare_args, args.size, url)
+    failed = [row for row in rows if row.get("error")]
+    if failed:
+        raise RuntimeError(f"preparation of the run failed: {failed[0]['error']}")
+    return os.path.join(work_dir, f"size_{args.size}", "output")
+
+
+def print_rows(rows: List[dict]) -> None:
+    print(f"{'concurrency':>11} {'stage':<24} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for row in rows:
+        if not row["count"]:
+            continue
+        print(
+            f"{row['concurrency']:>11} {row['stage']:<24} {row['count']:>6} "
+            + " ".join(f"{row[key] * 1000:>7.1f}ms" for key in ["p50", "p95", "p99", "max"])
+            + (f"  {row['queries_per_second']:.2f} queries/s, {row['errors']} errors" if row["stage"] == "end_to_end" else "")
+        )
+
+
+def bench(args) -> int:
+    queries = DEFAULT_QUERIES
+    if args.queries is not None:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    work_dir = None
+    if args.run_id is None:
+        work_dir = tempfile.mkdtemp(prefix="bench_query_")
+        args.base_dir = prepare_run(args, work_dir)
+        args.run_id = bench_pipeline.RUN_ID
+    base_dir = os.path.abspath(args.base_dir)
+
+    try:
+        with server_process(args) as url:
+            # the modules read their configuration when imported
+            os.environ["OLLAMA_BASE_URL"] = url
+            os.environ["OLLAMA_BASE_URLS"] = url
+            if not args.cache:
+                os.environ["DISABLE_CACHE"] = "true"
+            elif work_dir is not None:
+                os.environ["CACHES_DIR"] = os.path.join(work_dir, "cache")
+            import cli
+            if not args.verbose:
+                logging.getLogger().setLevel(logging.WARNING)
+            cli.set_api_key("none")
+
+            rows = []
+            for concurrency in [int(level) for level in args.concurrency.split(",")]:
+                # warm up, the first query imports and opens what the next ones reuse
+                run_query(queries[0], args.run_id, base_dir)
+                rows.extend(run_level(queries, concurrency, args.nb_queries, args.run_id, base_dir))
+                print(f"concurrency {concurrency} done", file=sys.stderr)
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_rows(rows)
+    write_results(args.output, "query", vars(args), rows)
+    if args.baseline is not None:
+        regressions = compare_results(
+            rows, read_results(args.baseline)["rows"], REGRESSION_KEYS, REGRESSION_METRICS,
+            tolerance=args.tolerance, min_value=args.min_value,
+        )
+        print_regressions(regressions, REGRESSION_KEYS)
+        return 1 if regressions else 0
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the latency of the query path, per stage, against a fake LLM.")
+    parser.add_argument("-r", "--run_id", type=str, default=None, help="prepared run, instead of a synthetic one")
+    parser.add_argument("-b", "--base_dir", type=str, default="output")
+    parser.add_argument("--size", type=int, default=100, help="documents of the synthetic run")
+    parser.add_argument("--queries", type=str, default=None, help="file of queries, one per line")
+    parser.add_argument("--concurrency", type=str, default="1,4,16", help="comma separated numbers of concurrent queries")
+    parser.add_argument("--nb_queries", type=int, default=50, help="queries per concurrency level")
+    parser.add_argument("--cache", action="store_true", help="keep the LLM cache enabled")
+    parser.add_argument("-o", "--output", type=str, default=os.path.join(RESULTS_DIR, "bench_query.json"), help="JSON result file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative growth of a latency reported as a regression")
+    parser.add_argument("--min_value", type=float, default=0.005, help="baseline latencies under this one are not compared")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the logs of the query path")
+    add_server_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    sys.exit(bench(parse_args()))
@@ -0,0 +1,209 @@
+"""Helpers shared by the benchmarks: measures, percentiles and result files.
+
+Results are JSON files with the environment of the run and a list of rows,
+each with key fields (like the corpus size and the step) and metrics.
+`compare_results` finds the metrics of a run grown past a tolerance over a
+baseline run, so that a benchmark can fail on a regression.
+"""
+
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+from src.cache.limiter import percentile
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = [50, 95, 99]
+# default directory of the result files, ignored by git
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def latency_summary(latencies: Iterable[float]) -> Dict[str, float]:
+    """Count, mean, p50, p95, p99 and max of latencies in seconds."""
+    latencies = list(latencies)
+    if not latencies:
+        return {"count": 0}
+    summary = {"count": len(latencies), "mean": sum(latencies) / len(latencies)}
+    for q in PERCENTILES:
+        summary[f"p{q}"] = percentile(latencies, q)
+    summary["max"] = max(latencies)
+    return summary
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident memory of the process, only possible on Linux."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident memory since the last reset, or since the process start."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def io_bytes_written() -> Optional[int]:
+    """Bytes written by the process, None if unknown."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+@contextmanager
+def measure(written_dir: Optional[str] = None):
+    """Wall time, CPU time, peak RSS and bytes written of the block, set in the yielded dict.
+
+    Without a byte counter of the process, the bytes written are the growth of `written_dir`.
+    The peak RSS is only set if it could be reset, otherwise it is the peak of the whole process.
+    """
+    metrics = {}
+    peak_rss_reset = reset_peak_rss()
+    written_before = io_bytes_written()
+    dir_size_before = dir_size(written_dir) if written_dir else None
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics["wall_time"] = time.perf_counter() - start
+        metrics["cpu_time"] = time.process_time() - cpu_start
+        if peak_rss_reset:
+            metrics["peak_rss"] = peak_rss_bytes()
+        written_after = io_bytes_written()
+        if written_before is not None and written_after is not None:
+            metrics["bytes_written"] = written_after - written_before
+        elif written_dir:
+            metrics["bytes_written"] = dir_size(written_dir) - dir_size_before
+
+
+def fetch_json(url: str, timeout: float = 10) -> dict:
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def counters_delta(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, int]:
+    return {name: after.get(name, 0) - before.get(name, 0) for name in sorted(set(before) | set(after))}
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def write_results(path: str, benchmark: str, config: dict, rows: List[dict], summary: Optional[dict] = None) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    results = {"benchmark": benchmark, "environment": environment(), "config": config, "rows": rows}
+    if summary is not None:
+        results["summary"] = summary
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results written to {path}")
+
+
+def read_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(rows: List[dict], baseline_rows: List[dict], keys: List[str], metrics: List[str], tolerance: float, min_value: float = 0.0) -> List[dict]:
+    """Metrics of the rows more than `tolerance` (0.2 for 20%) over the baseline row with the same keys.
+
+    Baseline values under `min_value` are ignored, they are too small to be compared.
+    """
+    baseline_by_key = {tuple(row.get(key) for key in keys): row for row in baseline_rows}
+    regressions = []
+    for row in rows:
+        baseline = baseline_by_key.get(tuple(row.get(key) for key in keys))
+        if baseline is None:
+            continue
+        for metric in metrics:
+            value, baseline_value = row.get(metric), baseline.get(metric)
+            if value is None or baseline_value is None or baseline_value < min_value:
+                continue
+            if value > baseline_value * (1 + tolerance):
+                regressions.append({
+                    **{key: row.get(key) for key in keys},
+                    "metric": metric,
+                    "baseline": baseline_value,
+                    "value": value,
+                    "ratio": value / baseline_value if baseline_value else float("inf"),
+                })
+    return regressions
+
+
+def print_regressions(regressions: List[dict], keys: List[str]) -> None:
+    if not regressions:
+        print("no regression")
+        return
+    print(f"{len(regressions)} regressions:")
+    for regression in regressions:
+        key_str = " ".join(f"{key}={regression[key]}" for key in keys)
+        print(f"  {key_str} {regression['metric']}: {regression['baseline']:.3f} -> {regression['value']:.3f} ({regression['ratio']:.2f}x)")
+
+
+def fit_exponent(sizes: List[float], times: List[float]) -> Optional[float]:
+    """Exponent k of the best fit of times = c * sizes ** k, None with less than 2 points."""
+    points = [(math.log(size), math.log(t)) for size, t in zip(sizes, times) if size > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def format_bytes(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
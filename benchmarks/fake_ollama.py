@@ -0,0 +1,498 @@
+"""Deterministic stand-in for the Ollama server, for offline benchmarks.
+
+Speaks the Ollama HTTP API used by the wrappers (`/api/chat`, `/api/generate`,
+`/api/embeddings`, `/api/embed`, `/api/tags`, `/api/version`) and answers each
+prompt of the pipeline with a structurally valid answer: yaml classification
+systems and assignments, document types, JSON type cleaning, retriever
+locations and markdown summaries starting with a title. The same request
+always gets the same answer, and embeddings are hashed bags of words, so
+texts sharing words are close.
+
+Latency model: the server has `parallel` slots, like OLLAMA_NUM_PARALLEL,
+and a request holds a slot for `base_latency + prompt tokens / prefill_tps +
+answer tokens / decode_tps` seconds, times a deterministic jitter. Requests
+beyond the slots queue. `time_scale` multiplies all the delays (0 for no
+delay), and `error_rate` answers a random share of the requests with a 503.
+
+Usage:
+    python -m benchmarks.fake_ollama [--port 11434] [--parallel 4] [--decode_tps 50] ...
+    OLLAMA_BASE_URL=http://127.0.0.1:11434 python cli.py -r bench -s 0-11 --samples stories:20
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 1024
+CHARS_PER_TOKEN = 4
+
+# classification system answered to the classification extraction prompts
+CLASSIFICATION_TREE = {
+    "Fiction": ["Fairy Tales", "Adventure Stories"],
+    "News": ["Politics", "Economy"],
+    "Science": ["Physics", "Computer Science"],
+}
+CLASSIFICATION_TAGS = ["Children", "Research", "Current Events", "Animals"]
+# keywords of the document types, the first type whose keyword is in the text wins
+DOCUMENT_TYPE_KEYWORDS = [
+    ("story", ["once upon", "king", "princess", "little", "forest"]),
+    ("scientific-paper", ["abstract", "we propose", "experiment", "results", "model"]),
+    ("news", ["said", "reported", "government", "minister", "percent"]),
+]
+DEFAULT_DOCUMENT_TYPES = ["biography", "encyclopedic-article", "news", "story"]
+
+
+@dataclass
+class LatencyModel:
+    base_latency: float = 0.05
+    prefill_tps: float = 2000.0
+    decode_tps: float = 50.0
+    embed_latency: float = 0.005
+    jitter: float = 0.1
+    time_scale: float = 1.0
+    error_rate: float = 0.0
+
+    def chat_delay(self, prompt_tokens: int, answer_tokens: int, seed: int) -> float:
+        delay = self.base_latency + prompt_tokens / self.prefill_tps + answer_tokens / self.decode_tps
+        return delay * (1 + self.jitter * random.Random(seed).uniform(-1, 1)) * self.time_scale
+
+    def embed_delay(self, nb_texts: int) -> float:
+        return (self.base_latency + nb_texts * self.embed_latency) * self.time_scale
+
+
+def stable_seed(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+
+
+def nb_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def words(text: str) -> List[str]:
+    return re.findall(r"[a-z]+", text.lower())
+
+
+def section(prompt: str, start: str, end: str) -> str:
+    """Text of the prompt between two markers, empty if not found."""
+    start_index = prompt.find(start)
+    if start_index < 0:
+        return ""
+    start_index += len(start)
+    end_index = prompt.find(end, start_index)
+    return prompt[start_index:end_index if end_index >= 0 else len(prompt)]
+
+
+def choose(options: List[str], text: str) -> str:
+    """Option sharing the most words with text, ties broken by a hash of text."""
+    text_words = set(words(text))
+    rng = random.Random(stable_seed(text))
+    scored = [(len(set(words(option)) & text_words), rng.random(), option) for option in options]
+    return max(scored)[2]
+
+
+# answers to the pipeline prompts
+
+def classification_system_answer(prompt: str) -> str:
+    previous = section(prompt, "Here is the previous hierarchical classification system and the tags:\n", "\n\nIf the new documents")
+    if previous.strip():
+        return previous.strip()
+    lines = ["hierarchical_classification:"]
+    for branch, leaves in CLASSIFICATION_TREE.items():
+        lines.append(f"- {branch} ({len(leaves)})")
+        lines.extend(f"  - {leaf} (1)" for leaf in leaves)
+    lines.append("tags:")
+    lines.extend(f"- {tag} (1)" for tag in CLASSIFICATION_TAGS)
+    return "\n".join(lines)
+
+
+def parse_tree_leaves(tree_str: str) -> Tuple[List[List[str]], List[str]]:
+    """Paths of the leaves and tags of a yaml-like classification system."""
+    paths, tags = [], []
+    stack: List[Tuple[int, str]] = []
+    current_section = None
+    for line in tree_str.split("\n"):
+        if line.strip().startswith("hierarchical_classification"):
+            current_section = "tree"
+            continue
+        if line.strip().startswith("tags"):
+            current_section = "tags"
+            continue
+        match = re.match(r"^(\s*)- (.*?)\s*$", line)
+        if match is None or not match.group(2):
+            continue
+        if current_section == "tags":
+            tags.append(match.group(2))
+            continue
+        indent = len(match.group(1))
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        stack.append((indent, match.group(2)))
+        paths.append([name for _, name in stack])
+    leaves = [path for path in paths if not any(len(other) > len(path) and other[:len(path)] == path for other in paths)]
+    return leaves, tags
+
+
+def classification_assignment_answer(prompt: str) -> str:
+    context = section(prompt, "related to a document:\n", "\n\nHere is a classification system")
+    tree_str = section(prompt, "that can be used to classify this document:\n", "\n\nAssign the most relevant")
+    leaves, tags = parse_tree_leaves(tree_str)
+    if not leaves:
+        leaves = [[branch, leaf] for branch, leaves in CLASSIFICATION_TREE.items() for leaf in leaves]
+    leaf = choose([" - ".join(path) for path in leaves], context).split(" - ")
+    lines = ["hierarchical_classification:"]
+    lines.extend(f"{'  ' * depth}- {name}" for depth, name in enumerate(leaf))
+    lines.append("tags:")
+    tags = tags or CLASSIFICATION_TAGS
+    first_tag = choose(tags, context)
+    lines.extend(f"- {tag}" for tag in [first_tag] + [tag for tag in tags if tag != first_tag][:1])
+    return "\n".join(lines)
+
+
+def document_type_answer(prompt: str) -> str:
+    text = prompt.lower()
+    for document_type, keywords in DOCUMENT_TYPE_KEYWORDS:
+        if any(keyword in text for keyword in keywords):
+            return document_type
+    return DEFAULT_DOCUMENT_TYPES[stable_seed(prompt) % len(DEFAULT_DOCUMENT_TYPES)]
+
+
+def clean_types_answer(prompt: str) -> str:
+    types_str = section(prompt, "Here is a list of document types:\n\n", "\n\nClean this list")
+    try:
+        types = [str(t) for t in ast.literal_eval(types_str.strip())]
+    except (ValueError, SyntaxError):
+        types = [t.strip(" '\"") for t in types_str.strip("[] \n").split(",") if t.strip(" '\"")]
+    # types with the same first word are merged into the first one
+    mapping = defaultdict(list)
+    for document_type in sorted(set(types)):
+        group = next((cleaned for cleaned in mapping if cleaned.split("-")[0] == document_type.split("-")[0]), document_type)
+        mapping[group].append(document_type)
+    return json.dumps({"cleaned_types": list(mapping), "mapping": mapping}, indent=4)
+
+
+def type_summary_prompt_answer(prompt: str) -> str:
+    match = re.search(r"summary of a (.+?) document", prompt)
+    document_type = match.group(1) if match else "document"
+    return (
+        f"Summarize this {document_type} document in strict CommonMark format. "
+        f"Start with a '# ' title line, then give the key facts specific to a {document_type}: "
+        "who, what, when, where and the main outcome, in a few short paragraphs."
+    )
+
+
+def classification_questions_answer(prompt: str) -> str:
+    context = section(prompt, "Here is the context:\n", "\n\nProvide a title")
+    title = summary_title(context)
+    branch = choose(list(CLASSIFICATION_TREE), context)
+    leaves = CLASSIFICATION_TREE[branch]
+    lines = [f"Title: {title}"]
+    lines.extend(f"{i + 1}. {branch} > {leaves[i % len(leaves)]} > {title.split()[i % len(title.split())]}" for i in range(10))
+    return "\n".join(lines)
+
+
+def retriever_answer(prompt: str) -> str:
+    tree_str = section(prompt, "Here is a hierarchical classification system:\n\n", "\n\nHere is a classification tags system:")
+    tags_str = section(prompt, "Here is a classification tags system:\n\n", "\n\nHere is a query:")
+    query = section(prompt, "Here is a query:\n", "\n\nDefine where")
+    tree_lines = tree_str.split("\n")
+    locations = [tree_lines[i - 1].strip() for i, line in enumerate(tree_lines) if line.startswith("Location summary:") and i > 0]
+    try:
+        tags = [str(t) for t in ast.literal_eval(tags_str.strip())]
+    except (ValueError, SyntaxError):
+        tags = []
+    lines = ["hierarchical_classification_locations:"]
+    first_location = choose(locations, query) if locations else "Unknown"
+    lines.append(f"- {first_location}, score:90")
+    lines.extend([f"- {location}, score:40" for location in locations if location != first_location][:1])
+    lines.append("tags:")
+    first_tag = choose(tags, query) if tags else "Unknown"
+    lines.append(f"- {first_tag}, score:80")
+    return "\n".join(lines)
+
+
+def summary_title(text: str) -> str:
+    title_words = [word for word in words(text) if len(word) > 3][:5] or ["untitled"]
+    return " ".join(word.capitalize() for word in title_words)
+
+
+def summary_answer(prompt: str, nb_words: int) -> str:
+    # context of the llama-index summarize and question answering prompts
+    context = section(prompt, "---------------------\n", "\n---------------------") or prompt
+    sentences = re.split(r"(?<=[.!?])\s+", " ".join(context.split()))
+    summary_words = []
+    for sentence in sentences:
+        if len(summary_words) >= nb_words:
+            break
+        summary_words.extend(sentence.split())
+    return f"# {summary_title(context)}\n\n{' '.join(summary_words[:nb_words])}"
+
+
+# (marker of the prompt, kind of prompt, answer function), the first matching marker wins
+PROMPT_KINDS = [
+    ("Return the hierarchical classification and the tags in a yaml format", "classification_system", classification_system_answer),
+    ("Assign the most relevant location in the classification", "classification_assignment", classification_assignment_answer),
+    ("hierarchical_classification_locations:", "retriever", retriever_answer),
+    ("Clean this list of types", "clean_types", clean_types_answer),
+    ("What is the best prompt for creating a summary", "type_summary_prompt", type_summary_prompt_answer),
+    ("Provide a title and a list of 10 possible hiearchical classifications", "classification_questions", classification_questions_answer),
+    ("Return the type. Multiple types are not possible.", "document_type", document_type_answer),
+]
+
+
+def answer(prompt: str, summary_words: int = 120) -> Tuple[str, str]:
+    """Kind of prompt and deterministic answer."""
+    for marker, kind, answer_func in PROMPT_KINDS:
+        if marker in prompt:
+            return kind, answer_func(prompt)
+    return "summary", summary_answer(prompt, summary_words)
+
+
+def embedding(text: str, dim: int = EMBEDDING_DIM) -> List[float]:
+    """Normalized hashed bag of words."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in words(text) or [""]:
+        seed = stable_seed(word)
+        vector[seed % dim] += 1.0 if (seed >> 32) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm > 0 else vector).tolist()
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """Fake Ollama HTTP server, see the module docstring."""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, parallel: int = 4, latency: LatencyModel = None,
+                 embedding_dim: int = EMBEDDING_DIM, summary_words: int = 120) -> None:
+        super().__init__((host, port), FakeOllamaHandler)
+        self.latency = latency or LatencyModel()
+        self.embedding_dim = embedding_dim
+        self.summary_words = summary_words
+        self.slots = threading.Semaphore(parallel)
+        self.stats = defaultdict(int)
+        self.stats_lock = threading.Lock()
+        self.error_rng = random.Random(0)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.stats_lock:
+            self.stats[name] += value
+
+    def should_fail(self) -> bool:
+        with self.stats_lock:
+            return self.error_rng.random() < self.latency.error_rate
+
+    def start(self) -> "FakeOllamaServer":
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are written separately: without TCP_NODELAY, Nagle's algorithm and the delayed
+    # ACK of the client hold each reply of a keep-alive connection for ~40 ms
+    disable_nagle_algorithm = True
+    server: FakeOllamaServer
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, data, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_ndjson(self, chunks) -> None:
+        body = b"".join(json.dumps(chunk).encode() + b"\n" for chunk in chunks)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self.send_json({"version": "0.0.0-fake"})
+        elif self.path == "/api/tags":
+            self.send_json({"models": []})
+        elif self.path == "/fake/stats":
+            with self.server.stats_lock:
+                self.send_json(dict(self.server.stats))
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.server.should_fail():
+            self.server.count("errors")
+            self.send_json({"error": "server overloaded"}, 503)
+            return
+        if self.path in ["/api/chat", "/api/generate"]:
+            self.chat(request)
+        elif self.path in ["/api/embeddings", "/api/embed"]:
+            self.embed(request)
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def chat(self, request: dict) -> None:
+        if self.path == "/api/chat":
+            prompt = "\n".join(message.get("content") or "" for message in request.get("messages", []))
+        else:
+            prompt = request.get("prompt", "")
+        kind, content = answer(prompt, self.server.summary_words)
+        prompt_tokens, answer_tokens = nb_tokens(prompt), nb_tokens(content)
+        delay = self.server.latency.chat_delay(prompt_tokens, answer_tokens, stable_seed(prompt))
+        with self.server.slots:
+            time.sleep(delay)
+        self.server.count("chat")
+        self.server.count(f"chat_{kind}")
+        self.server.count("prompt_tokens", prompt_tokens)
+        self.server.count("eval_tokens", answer_tokens)
+
+        response = {
+            "model": request.get("model", "fake"),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": int(delay * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": answer_tokens,
+        }
+        if self.path == "/api/chat":
+            response["message"] = {"role": "assistant", "content": content}
+        else:
+            response["response"] = content
+        if request.get("stream", True):
+            # whole answer in the first chunk, then the final chunk with the counts
+            first_chunk = {**response, "done": False}
+            for key in ["done_reason", "total_duration", "prompt_eval_count", "eval_count"]:
+                first_chunk.pop(key)
+            last_chunk = {**response}
+            if "message" in last_chunk:
+                last_chunk["message"] = {"role": "assistant", "content": ""}
+            else:
+                last_chunk["response"] = ""
+            self.send_ndjson([first_chunk, last_chunk])
+        else:
+            self.send_json(response)
+
+    def embed(self, request: dict) -> None:
+        if self.path == "/api/embeddings":
+            texts = [request.get("prompt", "")]
+        else:
+            texts = request.get("input", "")
+            texts = [texts] if isinstance(texts, str) else texts
+        with self.server.slots:
+            time.sleep(self.server.latency.embed_delay(len(texts)))
+        self.server.count("embed")
+        self.server.count("embed_texts", len(texts))
+        embeddings = [embedding(text, self.server.embedding_dim) for text in texts]
+        if self.path == "/api/embeddings":
+            self.send_json({"embedding": embeddings[0]})
+        else:
+            self.send_json({"model": request.get("model", "fake"), "embeddings": embeddings})
+
+
+def add_server_args(parser: argparse.ArgumentParser) -> None:
+    """Arguments of the server and its latency model, shared by the benchmarks."""
+    parser.add_argument("--parallel", type=int, default=4, help="requests served at the same time, the others queue")
+    parser.add_argument("--base_latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument("--prefill_tps", type=float, default=2000.0, help="prompt tokens per second")
+    parser.add_argument("--decode_tps", type=float, default=50.0, help="answer tokens per second")
+    parser.add_argument("--embed_latency", type=float, default=0.005, help="seconds per embedded text")
+    parser.add_argument("--jitter", type=float, default=0.1, help="max relative latency variation")
+    parser.add_argument("--time_scale", type=float, default=1.0, help="multiplier of all the delays, 0 for none")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="share of the requests answered with a 503")
+    parser.add_argument("--embedding_dim", type=int, default=EMBEDDING_DIM)
+    parser.add_argument("--summary_words", type=int, default=120, help="words of the summaries")
+
+
+def server_from_args(args, host: str = "127.0.0.1", port: int = 0) -> FakeOllamaServer:
+    latency = LatencyModel(
+        base_latency=args.base_latency, prefill_tps=args.prefill_tps, decode_tps=args.decode_tps,
+        embed_latency=args.embed_latency, jitter=args.jitter, time_scale=args.time_scale, error_rate=args.error_rate,
+    )
+    return FakeOllamaServer(host, port, args.parallel, latency, args.embedding_dim, args.summary_words)
+
+
+def server_args_list(args) -> List[str]:
+    """Command line arguments of `add_server_args` with the values of args."""
+    names = ["parallel", "base_latency", "prefill_tps", "decode_tps", "embed_latency", "jitter", "time_scale", "error_rate", "embedding_dim", "summary_words"]
+    return [argument for name in names for argument in (f"--{name}", str(getattr(args, name)))]
+
+
+@contextmanager
+def server_process(args, startup_timeout: float = 30):
+    """Url of a fake server run in another process, not to share the GIL with the benchmarked code."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, "-m", "benchmarks.fake_ollama", "--port", str(port)] + server_args_list(args), cwd=repo_dir)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                urllib.request.urlopen(f"{url}/api/version", timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"fake Ollama server did not start on {url}")
+                time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deterministic fake Ollama server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    add_server_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    server = server_from_args(args, args.host, args.port)
+    logger.info(f"fake Ollama server on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
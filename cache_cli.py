@@ -0,0 +1,122 @@
+import sys
+import logging
+import argparse
+import os
+import time
+
+from src.cache.cache_backend import EVICTION_POLICIES, SqliteBackend, import_pickle_dir
+from src.cache.file_cache import CACHE_BACKEND, CACHES_DIR, get_cache_backend, global_live_source_hashes
+from src.cache.vector_cache import VECTORS_DIR_NAME
+# registers the cached functions and their live source hashes
+import src.cache.wrapper  # noqa: F401
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def format_size(nb_bytes: int) -> str:
+    return f"{nb_bytes / 1e6:.1f}MB"
+
+
+def get_sqlite_backend() -> SqliteBackend:
+    backend = get_cache_backend()
+    if not isinstance(backend, SqliteBackend):
+        logger.error(f"Cache maintenance needs the sqlite backend, CACHE_BACKEND is {CACHE_BACKEND}")
+        sys.exit(1)
+    return backend
+
+
+def dir_size(dir_path: str) -> int:
+    if not os.path.isdir(dir_path):
+        return 0
+    return sum(os.path.getsize(os.path.join(dir_path, file_name)) for file_name in os.listdir(dir_path))
+
+
+def stats(args):
+    backend = get_sqlite_backend()
+    rows = backend.stats()
+    print(f"{'function':<60} {'generation':<10} {'entries':>8} {'size':>10} {'accesses':>9} {'last access':>17}")
+    total_entries = 0
+    total_size = 0
+    orphan_size = 0
+    for func, source_hash, nb_entries, size, accessed_at, nb_accesses in rows:
+        is_live = source_hash in global_live_source_hashes.get(func, set())
+        if not is_live:
+            orphan_size += size
+        generation = "live" if is_live else "orphan" if func in global_live_source_hashes else "unknown"
+        last_access = time.strftime("%Y-%m-%d %H:%M", time.localtime(accessed_at)) if accessed_at else "-"
+        print(f"{func or '-':<60} {generation:<10} {nb_entries:>8} {format_size(size):>10} {nb_accesses:>9} {last_access:>17}")
+        total_entries += nb_entries
+        total_size += size
+    print(f"\ntotal: {total_entries} entries, {format_size(total_size)} of values, {format_size(orphan_size)} not live")
+    print(f"database: {backend.path}, {format_size(backend.file_size())} on disk")
+    vectors_dir = os.path.join(CACHES_DIR or "file_cache", VECTORS_DIR_NAME)
+    print(f"embeddings per text: {vectors_dir}, {format_size(dir_size(vectors_dir))} on disk")
+
+
+def prune(args):
+    backend = get_sqlite_backend()
+    nb_deleted = backend.prune(global_live_source_hashes, include_unknown=args.include_unknown)
+    print(f"pruned {nb_deleted} entries")
+    if args.compact:
+        compact(args)
+
+
+def evict(args):
+    backend = get_sqlite_backend()
+    max_bytes = int(args.max_mb * 1_000_000) if args.max_mb else 0
+    max_age = args.max_age_days * 24 * 3600 if args.max_age_days else 0
+    nb_deleted = backend.evict(max_bytes=max_bytes, max_age=max_age, policy=args.policy)
+    print(f"evicted {nb_deleted} entries")
+    if args.compact:
+        compact(args)
+
+
+def compact(args):
+    backend = get_sqlite_backend()
+    size_before = backend.file_size()
+    backend.compact()
+    print(f"compacted {backend.path}: {format_size(size_before)} -> {format_size(backend.file_size())}")
+
+
+def import_dir(args):
+    backend = get_cache_backend()
+    nb_imported = import_pickle_dir(args.pickle_dir, backend, overwrite=args.overwrite)
+    print(f"imported {nb_imported} entries")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Maintenance of the file cache in CACHES_DIR.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stats_parser = subparsers.add_parser("stats", help="size and number of entries per cached function")
+    stats_parser.set_defaults(func=stats)
+
+    prune_parser = subparsers.add_parser("prune", help="delete the entries of former versions of the cached functions")
+    prune_parser.add_argument("--include_unknown", action="store_true", help="also delete the entries of functions that are not cached anymore")
+    prune_parser.add_argument("--compact", action="store_true", help="compact the database afterwards")
+    prune_parser.set_defaults(func=prune)
+
+    evict_parser = subparsers.add_parser("evict", help="delete entries above a size or age limit")
+    evict_parser.add_argument("--max_mb", type=float, default=None, help="max total size of the cached values, in MB")
+    evict_parser.add_argument("--max_age_days", type=float, default=None, help="max number of days since the last access")
+    evict_parser.add_argument("--policy", choices=EVICTION_POLICIES, default="lru", help="entries evicted first: least recently or least frequently used")
+    evict_parser.add_argument("--compact", action="store_true", help="compact the database afterwards")
+    evict_parser.set_defaults(func=evict)
+
+    compact_parser = subparsers.add_parser("compact", help="give the space of deleted entries back to the disk")
+    compact_parser.set_defaults(func=compact)
+
+    import_parser = subparsers.add_parser("import", help="import a directory of pickle files")
+    import_parser.add_argument("pickle_dir", type=str)
+    import_parser.add_argument("--overwrite", action="store_true", help="overwrite the entries already in the cache")
+    import_parser.set_defaults(func=import_dir)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -38,6 +38,7 @@ from llama_index.core.schema import (
 
 from src.classification.cascade_summary_index import CascadeSummaryIndex
 from src.classification.cascade_summarize import CascadeSummarize
+from src.cache import ledger
 from src.cache.wrapper import (
     LLMWrapper, 
     EmbeddingWrapper, 
@@ -48,6 +49,7 @@ from src.classification.classification_index import ClassificationIndex
 from src.classification.classification_store import ClassificationIndexStore
 from src.classification.classification_assignment_extractor import ClassificationAssignementExtractor
 from src.classification.document_type_extractor import DocumentTypeExtractor
+from src.document.ids import chunk_id_func, stable_id
 from src.document.document import join_document_nodes, load_samples_documents, load_uploaded_files, load_urls, load_web_pages
 from src.run.utils import add_custom_metadata, base_dir_for_run, copy_metadata_from_node, create_folders_for_filepath, exclude_metadata_keys, load_nodes, save_nodes
 from src.trace.trace import save_llama_debug
@@ -61,6 +63,28 @@ logger = logging.getLogger(__name__)
 # load_dotenv()
 # NVIDIA_API_KEY = os.getenv('NVIDIA_API_KEY')
 
+# model of each llm tier, the small model defaults to the large one
+LARGE_LLM_MODEL = os.getenv('LARGE_LLM_MODEL', "Qwen2.5-14B-Instruct-IQ4_XS")
+SMALL_LLM_MODEL = os.getenv('SMALL_LLM_MODEL', LARGE_LLM_MODEL)
+
+# llm tier of the pipeline steps with short structured answers, the other steps use the large model
+STEP_LLM_TIERS = {
+    "classification_questions": "small",
+    "document_types": "small",
+    "clean_document_types": "small",
+    "type_summary_prompts": "small",
+}
+
+global_llm_tiers = {}
+
+# documents summarized at the same time by the summary index, the LLM calls are still bounded by LLM_MAX_CONCURRENCY
+SUMMARY_NUM_WORKERS = int(os.getenv('SUMMARY_NUM_WORKERS', "8"))
+
+
+def llm_for_step(step: str):
+    """LLM of a pipeline step, from STEP_LLM_TIERS."""
+    return global_llm_tiers.get(STEP_LLM_TIERS.get(step, "large"), Settings.llm)
+
 
 def set_api_key(api_key: str):
     os.environ["NVIDIA_API_KEY"] = api_key
@@ -68,15 +92,27 @@ def set_api_key(api_key: str):
         # model="meta/llama-3.1-70b-instruct", 
 
         # model="meta/llama3-70b-instruct",
-        model="Qwen2.5-14B-Instruct-IQ4_XS",
+        model=LARGE_LLM_MODEL,
 
         # model="meta/llama-3.2-3b-instruct", # timeout
         # model="nvidia/llama-3.1-nemotron-70b-instruct", 
         # model="meta/llama-3.2-3b-instruct",
         max_nb_calls=800, 
         # max_nb_calls_cache_miss=0,
-        kwargs={"temperature": 0}
+        kwargs={"temperature": 0},
+        tier="large",
     )
+    global_llm_tiers["large"] = Settings.llm
+    # a single backend when the small model falls back to the large one
+    if SMALL_LLM_MODEL == LARGE_LLM_MODEL:
+        global_llm_tiers["small"] = Settings.llm
+    else:
+        global_llm_tiers["small"] = LLMWrapper(
+            model=SMALL_LLM_MODEL,
+            max_nb_calls=800,
+            kwargs={"temperature": 0},
+            tier="small",
+        )
     Settings.embed_model = EmbeddingWrapper(
 
         # model="NV-Embed-QA", 
@@ -176,25 +212,35 @@ Prompt:
 def create_chunks_and_summaries(run_id: str, base_dir: str, args=None):
 
     nodes = load_nodes(os.path.join(base_dir_for_run(run_id, base_dir), "nodes_0.json"))
+    persist_dir = base_dir_for_run(run_id, base_dir) + "/summary_index"
 
     response_synthesizer = CascadeSummarize(
         llm=Settings.llm,
         callback_manager=CallbackManager([]),
         use_max_chunks=10,
+        embed_model=Settings.embed_model,
     )
-    index = CascadeSummaryIndex.from_documents(
-        nodes,
+    index_kwargs = dict(
         llm=Settings.llm,
         transformations=[
-            SentenceSplitter( chunk_size=350, chunk_overlap=50),
+            SentenceSplitter( chunk_size=350, chunk_overlap=50, id_func=chunk_id_func),
         ],
         response_synthesizer=response_synthesizer,
         embed_model=Settings.embed_model,
         show_progress=True,
         summary_query=DOCUMENT_SUMMARY,
-        embed_summaries=False,        
+        embed_summaries=False,
+        num_workers=SUMMARY_NUM_WORKERS,
     )
-    index.storage_context.persist(persist_dir=base_dir_for_run(run_id, base_dir) + "/summary_index")
+
+    # only summarize the documents added or changed since the last summary index of the run
+    index = CascadeSummaryIndex.from_persist_dir(persist_dir, **index_kwargs) if os.path.exists(persist_dir) else None
+    if index is None:
+        index = CascadeSummaryIndex.from_documents(nodes, **index_kwargs)
+    else:
+        index.refresh_documents(nodes)
+    index.storage_context.persist(persist_dir=persist_dir)
+    index.persist_manifest(persist_dir)
     logger.info(f"created summary index, {len(index.index_struct.summary_id_to_node_ids)} summaries, {len(index.index_struct.node_id_to_summary_id)} chunks")
 
 
@@ -239,7 +285,7 @@ def generate_classification_information_from_summaries(run_id: str=None, base_di
     summary_ids = [index_struct.doc_id_to_summary_id[doc.id_] for doc in document_nodes]
     summary_nodes = storage_context.docstore.get_nodes(summary_ids)
 
-    nodes = IngestionPipeline(transformations=[ClassificationQuestionsExtractor(llm=Settings.llm)]).run(documents=summary_nodes)
+    nodes = IngestionPipeline(transformations=[ClassificationQuestionsExtractor(llm=llm_for_step("classification_questions"))]).run(documents=summary_nodes)
 
     # remove the new metadata "classification_information" from the node text used in embeddings and llm
     for node in nodes:
@@ -283,7 +329,7 @@ def generate_document_types_information(run_id: str=None, base_dir: str="output"
     nodes = load_nodes(os.path.join(base_dir_for_run(run_id), "nodes_2.json"))
     nodes = IngestionPipeline(transformations=[
         DocumentTypeExtractor(
-            llm=Settings.llm, 
+            llm=llm_for_step("document_types"),
             use_fake_node_assignment=False,
             log_dir=base_dir_for_run(run_id)
         ),
@@ -313,7 +359,7 @@ def clean_and_regroup_document_types(run_id: str=None, base_dir: str="output", a
     nodes_types = list(sorted(set(nodes_types)))
     logger.info(f"raw nodes_types: {nodes_types}")
 
-    response = Settings.llm.predict(
+    response = llm_for_step("clean_document_types").predict(
         PromptTemplate(template=CLEAN_TYPES),
         types_str=nodes_types,
         timeout=10,
@@ -357,7 +403,7 @@ def clean_and_regroup_document_types(run_id: str=None, base_dir: str="output", a
     )
 
     for cleaned_type in iterable_with_progress:
-        prompt = Settings.llm.predict(
+        prompt = llm_for_step("type_summary_prompts").predict(
             PromptTemplate(template=GENERATE_SUMMARY_PROMPT_BY_TYPE_2),
             document_type=cleaned_type,
             timeout=10,
@@ -458,6 +504,7 @@ def generate_classification_summaries(run_id: str=None, base_dir: str="output",
     for branch in classification_index._store._tree_schema:
 
         branch_node = Document(
+            id_=stable_id("branch", branch),
             text="",
             metadata={
                 "summary_for_tree_location": branch,
@@ -566,6 +613,7 @@ def generate_sub_classification_summaries(run_id: str=None, base_dir: str="outpu
 
             # create the new node with the summary
             new_node = TextNode(
+                id_=stable_id("path_summary", path),
                 text=response,
                 metadata={"summary_for_tree_location": path},
             )
@@ -738,7 +786,8 @@ def run_pipeline(run_id: str, base_dir: str, steps: str, args=None):
     for step_id in args_steps:
         pipeline_function, _ = pipeline_steps[step_id]
         logger.info(f"-------------------- {step_id=} - {pipeline_function=} --------------------")
-        globals()[pipeline_function](run_id, base_dir, args)
+        with ledger.recording(base_dir_for_run(run_id, base_dir), pipeline_function):
+            globals()[pipeline_function](run_id, base_dir, args)
 
 
 if __name__ == "__main__":
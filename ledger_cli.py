@@ -0,0 +1,67 @@
+import sys
+import logging
+import argparse
+import os
+
+from src.cache.ledger import LEDGER_FILE_NAME, SUMMARY_SORT_KEYS, read_ledger, summarize_ledger
+from src.run.utils import base_dir_for_run
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def ledger_path(args) -> str:
+    if args.path is not None:
+        return args.path
+    return os.path.join(base_dir_for_run(args.run_id, args.base_dir), LEDGER_FILE_NAME)
+
+
+def print_summary(summary, group_by):
+    group_width = 40
+    print(
+        " ".join(f"{field:<{group_width}}" if field == "prompt_id" else f"{field:<20}" for field in group_by)
+        + f" {'calls':>7} {'cached':>7} {'tokens':>9} {'latency':>9} {'max':>8} {'retries':>7} {'errors':>6}"
+    )
+    for group in summary:
+        group_str = " ".join(
+            f"{(group.get('prompt') or group[field] or '-')[:group_width]:<{group_width}}" if field == "prompt_id"
+            else f"{str(group[field] or '-')[:20]:<20}"
+            for field in group_by
+        )
+        print(
+            f"{group_str} {group['calls']:>7} {group['cached']:>7} {group['tokens']:>9} "
+            f"{group['latency']:>8.1f}s {group['max_latency']:>7.1f}s {group['retries']:>7} {group['errors']:>6}"
+        )
+
+
+def summarize(args):
+    path = ledger_path(args)
+    if not os.path.exists(path):
+        logger.error(f"No ledger: {path}")
+        sys.exit(1)
+    records = read_ledger(path)
+    print(f"{len(records)} calls in {path}\n")
+
+    print("per step")
+    print_summary(summarize_ledger(records, group_by=["step", "kind"], sort_by=args.sort_by, top=None), ["step", "kind"])
+
+    print(f"\ntop {args.top} prompts by {args.sort_by}")
+    group_by = ["step", "kind", "prompt_id"]
+    print_summary(summarize_ledger(records, group_by=group_by, sort_by=args.sort_by, top=args.top), group_by)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=f"Summary of the {LEDGER_FILE_NAME} ledger of the LLM and embedding calls of a run.",
+    )
+    parser.add_argument("-r", "--run_id", type=str, default=None)
+    parser.add_argument("-b", "--base_dir", type=str, default="output")
+    parser.add_argument("-p", "--path", type=str, default=None, help="path of the ledger, instead of the one of the run")
+    parser.add_argument("--sort_by", choices=SUMMARY_SORT_KEYS, default="tokens", help="tokens sent to the model, total latency or number of calls")
+    parser.add_argument("--top", type=int, default=10, help="number of prompts shown")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summarize(args)
@@ -0,0 +1,425 @@
+"""Storage backends for the file cache.
+
+A backend stores opaque bytes under a string key. The file cache decorators
+take care of hashing the function inputs and serializing the results.
+
+- `SqliteBackend` keeps all entries in a single SQLite database in WAL mode,
+  with indexed lookups and batched commits. This is the default backend.
+- `PickleDirBackend` is the historical layout: one `{key}.pickle` file per
+  entry in a flat directory.
+
+`import_pickle_dir` copies an existing pickle directory (like the shipped
+`file_cache/`) into another backend.
+
+The SQLite backend records the access time and count of each entry, and can
+be bounded in size and in age: entries are evicted least recently used first
+("lru") or least frequently used first ("lfu"). `cache_cli.py` reports its
+content per function and prunes, evicts or compacts it.
+"""
+
+import atexit
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SQLITE_FILE_NAME = "cache.sqlite3"
+PICKLE_EXTENSION = ".pickle"
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_FLUSH_INTERVAL = 2.0
+# minimum number of seconds between two automatic evictions
+EVICTION_INTERVAL = 60.0
+EVICTION_POLICIES = ["lru", "lfu"]
+
+# legacy keys are "{module}_{function}_{arg_hash}", the arg hash being 3 md5 hex digests,
+# the last one is the hash of the function source code
+LEGACY_KEY_REGEX = re.compile(r"^(?P<func>.+)_(?P<arg_hash>[0-9a-f]{64}(?P<source_hash>[0-9a-f]{32}))$")
+
+
+def split_legacy_key(key: str) -> Tuple[str, str]:
+    """Get the function name and the function source hash from a legacy cache key."""
+    match = LEGACY_KEY_REGEX.match(key)
+    if match is None:
+        return "", ""
+    return match.group("func"), match.group("source_hash")
+
+
+class CacheBackend:
+    """Key-value storage of cached function results."""
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, func: str = "", source_hash: str = "") -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+
+class PickleDirBackend(CacheBackend):
+    """One pickle file per entry, in a flat directory."""
+
+    def __init__(self, cache_dir: str) -> None:
+        self._cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, f"{key}{PICKLE_EXTENSION}")
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def set(self, key: str, value: bytes, func: str = "", source_hash: str = "") -> None:
+        with open(self._path(key), "wb") as f:
+            f.write(value)
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+
+class SqliteBackend(CacheBackend):
+    """All entries in a single SQLite database.
+
+    Writes are kept in memory and committed in batches, either every
+    `batch_size` writes or every `flush_interval` seconds, and at exit.
+    Pending writes are visible to `get` before they are committed.
+
+    If `legacy_dir` is set, a missing key is also looked up as a
+    `{key}.pickle` file in this directory and imported on the fly.
+
+    Accesses are recorded with the writes. If `max_bytes` or `max_age`
+    (seconds since the last access) are set, entries are evicted with the
+    `eviction_policy` at startup and at most every `EVICTION_INTERVAL`
+    seconds when committing.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        legacy_dir: Optional[str] = None,
+        max_bytes: int = 0,
+        max_age: float = 0,
+        eviction_policy: str = "lru",
+    ) -> None:
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy: {eviction_policy}")
+        self._path = path
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._legacy_dir = legacy_dir
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._eviction_policy = eviction_policy
+        self._pending: Dict[str, Tuple[bytes, str, str, float]] = {}
+        # key -> (last access time, number of accesses) not committed yet
+        self._accesses: Dict[str, Tuple[float, int]] = {}
+        self._last_commit_time = time.monotonic()
+        self._last_eviction_time = time.monotonic()
+        self._lock = threading.RLock()
+
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " func TEXT NOT NULL,"
+            " source_hash TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL DEFAULT 0,"
+            " access_count INTEGER NOT NULL DEFAULT 0"
+            ")"
+        )
+        self._migrate()
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_func ON cache (func)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        atexit.register(self.close)
+        if self._max_bytes or self._max_age:
+            self.evict(self._max_bytes, self._max_age, self._eviction_policy)
+
+    def _migrate(self) -> None:
+        """Add the access columns to databases created without them."""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(cache)")}
+        if "accessed_at" not in columns:
+            self._conn.execute("ALTER TABLE cache ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+            self._conn.execute("UPDATE cache SET accessed_at = created_at")
+        if "access_count" not in columns:
+            self._conn.execute("ALTER TABLE cache ADD COLUMN access_count INTEGER NOT NULL DEFAULT 0")
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                value = pending[0]
+            else:
+                row = self._conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+                value = row[0] if row is not None else None
+            if value is not None:
+                _, nb_accesses = self._accesses.get(key, (0, 0))
+                self._accesses[key] = (time.time(), nb_accesses + 1)
+                self._flush_if_needed()
+                return value
+        return self._get_legacy(key)
+
+    def _get_legacy(self, key: str) -> Optional[bytes]:
+        if self._legacy_dir is None:
+            return None
+        path = os.path.join(self._legacy_dir, f"{key}{PICKLE_EXTENSION}")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            value = f.read()
+        func, source_hash = split_legacy_key(key)
+        self.set(key, value, func=func, source_hash=source_hash)
+        return value
+
+    def set(self, key: str, value: bytes, func: str = "", source_hash: str = "") -> None:
+        with self._lock:
+            self._pending[key] = (value, func, source_hash, time.time())
+            self._flush_if_needed()
+
+    def _flush_if_needed(self) -> None:
+        if (
+            len(self._pending) + len(self._accesses) >= self._batch_size
+            or time.monotonic() - self._last_commit_time >= self._flush_interval
+        ):
+            self.flush()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._pending.pop(key, None)
+            self._accesses.pop(key, None)
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._pending:
+                return True
+            row = self._conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def flush(self) -> None:
+        with self._lock:
+            self._last_commit_time = time.monotonic()
+            if self._pending or self._accesses:
+                self._commit()
+            if (
+                (self._max_bytes or self._max_age)
+                and time.monotonic() - self._last_eviction_time >= EVICTION_INTERVAL
+            ):
+                self._evict(self._max_bytes, self._max_age, self._eviction_policy)
+
+    def _commit(self) -> None:
+        rows = [
+            (key, func, source_hash, value, len(value), created_at, created_at)
+            for key, (value, func, source_hash, created_at) in self._pending.items()
+        ]
+        accesses = [
+            (accessed_at, nb_accesses, key)
+            for key, (accessed_at, nb_accesses) in self._accesses.items()
+        ]
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, func, source_hash, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.executemany(
+                "UPDATE cache SET accessed_at = ?, access_count = access_count + ? WHERE key = ?",
+                accesses,
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._pending = {}
+        self._accesses = {}
+        logger.debug(f"committed {len(rows)} cache entries and {len(accesses)} accesses to {self._path}")
+
+    def evict(self, max_bytes: int = 0, max_age: float = 0, policy: str = "lru") -> int:
+        """Delete the entries not accessed for `max_age` seconds, then the least recently
+        ("lru") or least frequently ("lfu") used entries above `max_bytes`.
+
+        Returns the number of deleted entries.
+        """
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        with self._lock:
+            self.flush()
+            return self._evict(max_bytes, max_age, policy)
+
+    def _evict(self, max_bytes: int, max_age: float, policy: str) -> int:
+        self._last_eviction_time = time.monotonic()
+        nb_deleted = 0
+        if max_age:
+            nb_deleted += self._conn.execute(
+                "DELETE FROM cache WHERE accessed_at < ?", (time.time() - max_age,)
+            ).rowcount
+        if max_bytes:
+            total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            if total_size > max_bytes:
+                order = "accessed_at" if policy == "lru" else "access_count, accessed_at"
+                keys = []
+                for key, size in self._conn.execute(f"SELECT key, size FROM cache ORDER BY {order}"):
+                    if total_size <= max_bytes:
+                        break
+                    keys.append((key,))
+                    total_size -= size
+                self._delete_keys(keys)
+                nb_deleted += len(keys)
+        if nb_deleted:
+            logger.info(f"evicted {nb_deleted} cache entries from {self._path}")
+        return nb_deleted
+
+    def _delete_keys(self, keys: List[Tuple[str]]) -> None:
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany("DELETE FROM cache WHERE key = ?", keys)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def prune(self, live_source_hashes: Dict[str, Set[str]], include_unknown: bool = False) -> int:
+        """Delete the entries of functions whose source hash is not in `live_source_hashes[func]`.
+
+        Entries of functions missing from `live_source_hashes` are kept, unless `include_unknown`.
+        Returns the number of deleted entries.
+        """
+        with self._lock:
+            self.flush()
+            nb_deleted = 0
+            generations = self._conn.execute("SELECT DISTINCT func, source_hash FROM cache").fetchall()
+            for func, source_hash in generations:
+                if func in live_source_hashes:
+                    if source_hash in live_source_hashes[func]:
+                        continue
+                elif not include_unknown:
+                    continue
+                nb_deleted += self._conn.execute(
+                    "DELETE FROM cache WHERE func = ? AND source_hash = ?", (func, source_hash)
+                ).rowcount
+            logger.info(f"pruned {nb_deleted} cache entries from {self._path}")
+            return nb_deleted
+
+    def compact(self) -> None:
+        """Give the space of deleted entries back to the file system."""
+        with self._lock:
+            self.flush()
+            self._conn.execute("VACUUM")
+            # in WAL mode the vacuumed database is in the log until a checkpoint
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def stats(self) -> List[Tuple[str, str, int, int, float, int]]:
+        """(func, source_hash, number of entries, total size, last access time, number of accesses)
+        of each generation of cached function, largest first."""
+        with self._lock:
+            self.flush()
+            return self._conn.execute(
+                "SELECT func, source_hash, COUNT(*), SUM(size), MAX(accessed_at), SUM(access_count) "
+                "FROM cache GROUP BY func, source_hash ORDER BY SUM(size) DESC"
+            ).fetchall()
+
+    def file_size(self) -> int:
+        """Size on disk of the database, with its write-ahead log."""
+        return sum(
+            os.path.getsize(path) for path in (self._path, f"{self._path}-wal") if os.path.exists(path)
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is None:
+                return
+            self.flush()
+            self._conn.close()
+            self._conn = None
+        atexit.unregister(self.close)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self.flush()
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+def import_pickle_dir(pickle_dir: str, backend: CacheBackend, overwrite: bool = False) -> int:
+    """Import all `{key}.pickle` files of a directory into a backend.
+
+    Returns the number of imported entries.
+    """
+    nb_imported = 0
+    for file_name in sorted(os.listdir(pickle_dir)):
+        if not file_name.endswith(PICKLE_EXTENSION):
+            continue
+        key = file_name[: -len(PICKLE_EXTENSION)]
+        if not overwrite and key in backend:
+            continue
+        with open(os.path.join(pickle_dir, file_name), "rb") as f:
+            value = f.read()
+        func, source_hash = split_legacy_key(key)
+        backend.set(key, value, func=func, source_hash=source_hash)
+        nb_imported += 1
+    backend.flush()
+    logger.info(f"imported {nb_imported} cache entries from {pickle_dir}")
+    return nb_imported
+
+
+def create_cache_backend(
+    cache_dir: str,
+    backend_name: str = "sqlite",
+    max_bytes: int = 0,
+    max_age: float = 0,
+    eviction_policy: str = "lru",
+) -> CacheBackend:
+    """Create a backend storing its data in `cache_dir`.
+
+    Size and age limits are only supported by the sqlite backend.
+    """
+    if backend_name == "sqlite":
+        return SqliteBackend(
+            os.path.join(cache_dir, SQLITE_FILE_NAME),
+            legacy_dir=cache_dir,
+            max_bytes=max_bytes,
+            max_age=max_age,
+            eviction_policy=eviction_policy,
+        )
+    if backend_name == "pickle":
+        if max_bytes or max_age:
+            logger.warning("Cache size and age limits are ignored by the pickle backend")
+        return PickleDirBackend(cache_dir)
+    raise ValueError(f"Unknown cache backend: {backend_name}")
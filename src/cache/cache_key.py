@@ -0,0 +1,147 @@
+"""Canonical hashing of function inputs for the file cache.
+
+Values are serialized into a type-tagged, length-prefixed byte stream, hashed
+with a single keyed blake2b hasher. Strings are hashed as their utf-8 bytes,
+without escaping or `repr`, and dict items are sorted, so the order of keyword
+arguments does not change the key.
+
+Objects are serialized through canonicalizers registered by type with
+`register_canonical` (for example a chat message is reduced to its role and
+content), or else through their `__dict__`. Reference cycles are written as
+back references instead of being cut at a maximum depth.
+"""
+
+import enum
+import hashlib
+from typing import Any, Callable, Dict, List
+
+CACHE_KEY_VERSION = b"themagicshelf-cache-key-v1"
+DIGEST_SIZE = 16
+# strings larger than this are hashed directly instead of being buffered
+BUFFER_SIZE = 1 << 16
+
+_canonicalizers: Dict[type, Callable[[Any], Any]] = {}
+
+
+def register_canonical(cls: type, canonicalizer: Callable[[Any], Any]) -> None:
+    """Hash instances of `cls` (and subclasses) as `canonicalizer(instance)`."""
+    _canonicalizers[cls] = canonicalizer
+
+
+def _get_canonicalizer(cls: type):
+    for base in cls.__mro__:
+        canonicalizer = _canonicalizers.get(base)
+        if canonicalizer is not None:
+            return canonicalizer
+    return None
+
+
+def _type_name(value: Any) -> str:
+    value_type = type(value)
+    return f"{value_type.__module__}.{value_type.__qualname__}"
+
+
+class _CanonicalWriter:
+    """Write values as a type-tagged, length-prefixed byte stream into a hasher."""
+
+    def __init__(self, hasher) -> None:
+        self._hasher = hasher
+        self._parts: List[bytes] = []
+        self._path: Dict[int, int] = {}
+
+    def flush(self) -> None:
+        if self._parts:
+            self._hasher.update(b"".join(self._parts))
+            self._parts = []
+
+    def _write_str(self, value: str) -> None:
+        data = value.encode("utf-8", "surrogatepass")
+        self._parts.append(b"s%d:" % len(data))
+        if len(data) >= BUFFER_SIZE:
+            self.flush()
+            self._hasher.update(data)
+        else:
+            self._parts.append(data)
+
+    def write(self, value: Any) -> None:
+        # exact types first, they are the bulk of the function inputs
+        value_type = type(value)
+        if value_type is str:
+            self._write_str(value)
+        elif value is None:
+            self._parts.append(b"N")
+        elif value_type is bool:
+            self._parts.append(b"T" if value else b"F")
+        elif value_type is int:
+            self._parts.append(b"i%d;" % value)
+        elif value_type is float:
+            self._parts.append(b"f%s;" % repr(value).encode())
+        elif value_type is list or value_type is tuple or value_type is dict:
+            self._write_container(value)
+        elif isinstance(value, enum.Enum):
+            self._parts.append(b"e%s;" % _type_name(value).encode())
+            self.write(value.value)
+        elif isinstance(value, str):
+            self._write_str(str(value))
+        elif isinstance(value, bool):
+            self._parts.append(b"T" if value else b"F")
+        elif isinstance(value, int):
+            self._parts.append(b"i%d;" % value)
+        elif isinstance(value, float):
+            self._parts.append(b"f%s;" % repr(float(value)).encode())
+        elif isinstance(value, (bytes, bytearray)):
+            self._parts.append(b"b%d:" % len(value))
+            self._parts.append(bytes(value))
+        else:
+            self._write_container(value)
+
+    def _write_container(self, value: Any) -> None:
+        value_id = id(value)
+        if value_id in self._path:
+            # reference cycle: refer to the depth of the first occurrence
+            self._parts.append(b"R%d;" % self._path[value_id])
+            return
+        self._path[value_id] = len(self._path)
+        try:
+            if isinstance(value, (list, tuple)):
+                self._parts.append(b"l%d:" % len(value))
+                for item in value:
+                    if type(item) is str:
+                        self._write_str(item)
+                    else:
+                        self.write(item)
+            elif isinstance(value, dict):
+                self._parts.append(b"d%d:" % len(value))
+                if all(type(key) is str for key in value):
+                    for key in sorted(value):
+                        self._write_str(key)
+                        self.write(value[key])
+                else:
+                    for key_hash, key in sorted((canonical_hash(key), key) for key in value):
+                        self._parts.append(key_hash.encode())
+                        self.write(value[key])
+            elif isinstance(value, (set, frozenset)):
+                self._parts.append(b"S%d:" % len(value))
+                for item_hash in sorted(canonical_hash(item) for item in value):
+                    self._parts.append(item_hash.encode())
+            else:
+                self._parts.append(b"o%s;" % _type_name(value).encode())
+                canonicalizer = _get_canonicalizer(type(value))
+                if canonicalizer is not None:
+                    self.write(canonicalizer(value))
+                elif hasattr(value, "__dict__"):
+                    self.write(vars(value))
+                else:
+                    # no way to look inside: the representation at least avoids collisions
+                    self._write_str(repr(value))
+        finally:
+            del self._path[value_id]
+
+
+def canonical_hash(*values: Any) -> str:
+    """Hash values into a hex digest, with a keyed blake2b over their canonical serialization."""
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE, key=CACHE_KEY_VERSION)
+    writer = _CanonicalWriter(hasher)
+    writer.write(values)
+    writer.flush()
+    return hasher.hexdigest()
@@ -0,0 +1,183 @@
+"""Routing of the model requests over several Ollama servers.
+
+Each request goes to the healthy endpoint with the least requests in flight,
+or with the lowest expected latency (latency average times requests in
+flight). An endpoint failing with timeouts, connection errors, 429 or 5xx
+responses several times in a row is ejected for a while, then gets a single
+probe request: a success brings it back, a failure ejects it for twice as
+long. If all the endpoints are ejected, requests go to the one whose
+ejection ends first.
+
+The cache keys do not depend on the endpoint: replicas are expected to
+serve the same models.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from dotenv import load_dotenv
+
+from src.cache.ollama_clients import OLLAMA_BASE_URL
+from src.cache.retry import is_retryable_error
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# comma separated urls of the Ollama servers serving the same models
+OLLAMA_BASE_URLS = [url.strip() for url in os.getenv('OLLAMA_BASE_URLS', OLLAMA_BASE_URL).split(",") if url.strip()]
+# "least_outstanding" or "latency"
+OLLAMA_ROUTING = os.getenv('OLLAMA_ROUTING', "least_outstanding")
+# consecutive failures before an endpoint is ejected, and first ejection duration (seconds)
+OLLAMA_EJECTION_FAILURES = int(os.getenv('OLLAMA_EJECTION_FAILURES', "3"))
+OLLAMA_EJECTION_SECONDS = float(os.getenv('OLLAMA_EJECTION_SECONDS', "30"))
+ROUTING_POLICIES = ["least_outstanding", "latency"]
+# weight of the last request in the latency average
+LATENCY_EWMA_ALPHA = 0.2
+MAX_EJECTION_DOUBLINGS = 4
+
+
+class Endpoint:
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.outstanding = 0
+        self.latency = None
+        self.consecutive_failures = 0
+        self.nb_ejections = 0
+        self.ejected_until = 0.0
+        self.probing = False
+        self.nb_requests = 0
+        self.nb_failures = 0
+
+    def is_ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    def stats_str(self, now: float) -> str:
+        latency_str = f"{self.latency:.2f}s" if self.latency is not None else "-"
+        ejected_str = ", ejected" if self.is_ejected(now) else ""
+        return f"{self.url} [requests:{self.nb_requests}, failures:{self.nb_failures}, latency:{latency_str}{ejected_str}]"
+
+
+class EndpointPool:
+    """Pool of endpoints serving the same models, see the module docstring."""
+
+    def __init__(
+        self,
+        name: str,
+        urls: List[str],
+        policy: str = OLLAMA_ROUTING,
+        ejection_failures: int = OLLAMA_EJECTION_FAILURES,
+        ejection_seconds: float = OLLAMA_EJECTION_SECONDS,
+    ) -> None:
+        if not urls:
+            raise ValueError(f"No endpoint in pool {name}")
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown routing policy: {policy}, available: {ROUTING_POLICIES}")
+        self.name = name
+        self.endpoints = [Endpoint(url) for url in urls]
+        self._policy = policy
+        self._ejection_failures = ejection_failures
+        self._ejection_seconds = ejection_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def urls(self) -> List[str]:
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def _score(self, endpoint: Endpoint) -> Tuple[float, int]:
+        if self._policy == "latency":
+            # endpoints without latency yet are tried first
+            latency = endpoint.latency if endpoint.latency is not None else 0.0
+            return latency * (endpoint.outstanding + 1), endpoint.nb_requests
+        return endpoint.outstanding, endpoint.nb_requests
+
+    def acquire(self) -> Endpoint:
+        """Pick the endpoint of a request, to `release` when the request is done."""
+        with self._lock:
+            now = time.monotonic()
+            # an endpoint at the end of its ejection gets a single probe request
+            for endpoint in self.endpoints:
+                if endpoint.nb_ejections > 0 and not endpoint.is_ejected(now) and not endpoint.probing:
+                    endpoint.probing = True
+                    break
+            else:
+                available = [e for e in self.endpoints if not e.is_ejected(now) and not e.probing]
+                if available:
+                    endpoint = min(available, key=self._score)
+                else:
+                    endpoint = min(self.endpoints, key=lambda e: e.ejected_until)
+            endpoint.outstanding += 1
+            endpoint.nb_requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, latency: float, error: BaseException = None) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            was_probing = endpoint.probing
+            endpoint.probing = False
+            if error is None or not is_retryable_error(error):
+                if endpoint.nb_ejections > 0:
+                    logger.info(f"{self.name} endpoint {endpoint.url} is back")
+                endpoint.consecutive_failures = 0
+                endpoint.nb_ejections = 0
+                endpoint.ejected_until = 0.0
+                if error is None:
+                    if endpoint.latency is None:
+                        endpoint.latency = latency
+                    else:
+                        endpoint.latency += LATENCY_EWMA_ALPHA * (latency - endpoint.latency)
+                return
+            endpoint.nb_failures += 1
+            endpoint.consecutive_failures += 1
+            if was_probing or endpoint.consecutive_failures >= self._ejection_failures:
+                ejection_time = self._ejection_seconds * 2 ** min(endpoint.nb_ejections, MAX_EJECTION_DOUBLINGS)
+                endpoint.nb_ejections += 1
+                endpoint.ejected_until = time.monotonic() + ejection_time
+                logger.warning(
+                    f"{self.name} endpoint {endpoint.url} ejected for {ejection_time:.0f}s: {type(error).__name__}: {error}"
+                )
+
+    def call(self, fn):
+        """Call `fn(url)` on an endpoint of the pool."""
+        endpoint = self.acquire()
+        start_time = time.monotonic()
+        try:
+            result = fn(endpoint.url)
+        except BaseException as e:
+            self.release(endpoint, time.monotonic() - start_time, e)
+            raise
+        self.release(endpoint, time.monotonic() - start_time)
+        return result
+
+    async def acall(self, afn):
+        """Await `afn(url)` on an endpoint of the pool."""
+        endpoint = self.acquire()
+        start_time = time.monotonic()
+        try:
+            result = await afn(endpoint.url)
+        except BaseException as e:
+            self.release(endpoint, time.monotonic() - start_time, e)
+            raise
+        self.release(endpoint, time.monotonic() - start_time)
+        return result
+
+    def stats_str(self) -> str:
+        now = time.monotonic()
+        return ", ".join(endpoint.stats_str(now) for endpoint in self.endpoints)
+
+
+global_endpoint_pools: Dict[Tuple[str, Tuple[str, ...]], EndpointPool] = {}
+global_endpoint_pools_lock = threading.Lock()
+
+
+def get_endpoint_pool(name: str, urls: List[str]) -> EndpointPool:
+    """Endpoint pool of these urls, kept with its health state across wrappers."""
+    with global_endpoint_pools_lock:
+        pool = global_endpoint_pools.get((name, tuple(urls)))
+        if pool is None:
+            pool = EndpointPool(name, urls)
+            global_endpoint_pools[(name, tuple(urls))] = pool
+        return pool
@@ -1,23 +1,106 @@
 # from https://docs.sweep.dev/blogs/file-cache
 
 from dotenv import load_dotenv
+import asyncio
+import functools
 import hashlib
 import inspect
 import os
-import pickle
 import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from src.cache.cache_backend import CacheBackend, create_cache_backend
+from src.cache.cache_key import canonical_hash
+from src.cache.memory_cache import MISSING, MemoryLRUCache
+from src.cache import ledger, serialization
+from src.cache.single_flight import SingleFlight
+from src.cache.vector_cache import VectorCache
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 CACHES_DIR = os.getenv('CACHES_DIR')
 DISABLE_CACHE = os.getenv('DISABLE_CACHE', "false") in ["true", "True", "TRUE"]
+# "sqlite" (single file database) or "pickle" (one file per entry)
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', "sqlite")
+# in-process LRU cache in front of the backend, 0 entries to disable it
+MEMORY_CACHE_MAX_ENTRIES = int(os.getenv('MEMORY_CACHE_MAX_ENTRIES', "10000"))
+MEMORY_CACHE_MAX_BYTES = int(os.getenv('MEMORY_CACHE_MAX_MB', "256")) * 1_000_000
+# limits of the sqlite backend, 0 for no limit; "lru" or "lfu" eviction
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_MB', "0")) * 1_000_000
+CACHE_MAX_AGE = float(os.getenv('CACHE_MAX_AGE_DAYS', "0")) * 24 * 3600
+CACHE_EVICTION_POLICY = os.getenv('CACHE_EVICTION_POLICY', "lru")
+# compression of the cached values: "zstd" (if installed), "zlib" or "none"
+CACHE_COMPRESSION = os.getenv('CACHE_COMPRESSION', serialization.default_codec())
+# "float32" or "float16" storage of the cached embeddings
+CACHE_EMBEDDINGS_DTYPE = os.getenv('CACHE_EMBEDDINGS_DTYPE', "float32")
 print(f"\nDISABLE_CACHE: {DISABLE_CACHE}\n")
 
 MAX_DEPTH = 6
 if DISABLE_CACHE:
     logger.info("File cache is disabled.")
 
+global_cache_backend = None
+global_cache_backend_lock = threading.Lock()
+
+global_vector_caches = {}
+
+# single thread doing the backend reads and writes of the async decorator, in submission order
+global_cache_io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file_cache_io")
+
+# calls in flight, shared by concurrent callers with the same cache key
+global_single_flight = SingleFlight()
+
+global_memory_cache = MemoryLRUCache(MEMORY_CACHE_MAX_ENTRIES, MEMORY_CACHE_MAX_BYTES)
+
+# source hashes of the decorated functions, current and legacy, other generations are orphans
+global_live_source_hashes = defaultdict(set)
+
+# per function counters of "memory_hits", "disk_hits", "misses" and "coalesced"
+global_cache_stats = defaultdict(lambda: defaultdict(int))
+
+
+def get_cache_backend() -> CacheBackend:
+    """Get the process-wide cache backend, created on first use."""
+    global global_cache_backend
+    with global_cache_backend_lock:
+        if global_cache_backend is None:
+            global_cache_backend = create_cache_backend(
+                CACHES_DIR or "file_cache",
+                CACHE_BACKEND,
+                max_bytes=CACHE_MAX_BYTES,
+                max_age=CACHE_MAX_AGE,
+                eviction_policy=CACHE_EVICTION_POLICY,
+            )
+            logger.info(f"File cache backend: {CACHE_BACKEND} in {CACHES_DIR}")
+        return global_cache_backend
+
+
+def get_vector_cache(model_key) -> VectorCache:
+    """Get the per-text embedding cache of a model, created on first use."""
+    name = canonical_hash(model_key)
+    with global_cache_backend_lock:
+        if name not in global_vector_caches:
+            global_vector_caches[name] = VectorCache(CACHES_DIR or "file_cache", model_key)
+        return global_vector_caches[name]
+
+
+def register_live_source_hashes(func_name, func_source_code_hash, legacy_source_hash=None):
+    global_live_source_hashes[func_name].add(func_source_code_hash)
+    if legacy_source_hash is not None:
+        global_live_source_hashes[func_name].add(legacy_source_hash)
+
+
+def get_cache_stats(func_names):
+    """Get the sum of the cache counters of the given functions."""
+    stats = defaultdict(int)
+    for func_name in func_names:
+        for counter, value in global_cache_stats[func_name].items():
+            stats[counter] += value
+    return stats
+
 
 def recursive_hash(value, depth=0, ignore_params=[]):
     """Hash primitives recursively with maximum depth."""
@@ -53,123 +136,212 @@ def hash_code(code):
     return hashlib.md5(code.encode()).hexdigest()
 
 
-def file_cache(ignore_params=[], verbose=False):
+def call_arguments(func, args, kwargs, ignore_params=[]):
+    """Get the arguments of a function call, as a dict of positional arguments and a dict of keyword arguments."""
+
+    # Convert args to a dictionary based on the function's signature
+    args_names = func.__code__.co_varnames[: func.__code__.co_argcount]
+    args_dict = dict(zip(args_names, args))
+
+    # Remove ignored params
+    kwargs_clone = kwargs.copy()
+    for param in ignore_params:
+        args_dict.pop(param, None)
+        kwargs_clone.pop(param, None)
+    return args_dict, kwargs_clone
+
+
+def cache_key(func, func_source_code_hash, args, kwargs, ignore_params=[], key_func=None):
+    """Get the cache key of a function call.
+
+    The key is a hash of the function source code and of the arguments, or of
+    `key_func(*args, **kwargs)` if set.
+    """
+    if key_func is not None:
+        key_value = key_func(*args, **kwargs)
+    else:
+        key_value = call_arguments(func, args, kwargs, ignore_params)
+    return f"{func.__module__}_{func.__name__}_{canonical_hash(key_value, func_source_code_hash)}"
+
+
+def legacy_cache_key(func, func_source_code_hash, args, kwargs, ignore_params=[]):
+    """Get the cache key of a function call, as computed before `cache_key`."""
+    args_dict, kwargs_clone = call_arguments(func, args, kwargs, ignore_params)
+
+    # Create hash based on argument names, argument values, and function source code
+    arg_hash = (
+        recursive_hash(args_dict, ignore_params=ignore_params)
+        + recursive_hash(kwargs_clone, ignore_params=ignore_params)
+        + func_source_code_hash
+    )
+    return f"{func.__module__}_{func.__name__}_{arg_hash}"
+
+
+def get_legacy_key_func(func, legacy_source_hash, use_legacy, args, kwargs, ignore_params=[]):
+    """Function computing the legacy key of a call, None if the legacy entries are not reused for it.
+
+    Called in the thread of the caller, `use_legacy` can depend on its context.
+    """
+    if legacy_source_hash is None or (use_legacy is not None and not use_legacy(*args, **kwargs)):
+        return None
+    return lambda: legacy_cache_key(func, legacy_source_hash, args, kwargs, ignore_params)
+
+
+def get_cached(func_name, func_source_code_hash, key, verbose=False, legacy_key_func=None):
+    """Get a cached result from the memory cache or the backend, MISSING if not cached."""
+
+    # If result is in memory, return it
+    result = global_memory_cache.get(key, MISSING)
+    if result is not MISSING:
+        global_cache_stats[func_name]["memory_hits"] += 1
+        ledger.note(cache="memory")
+        return result
+    return get_backend_cached(func_name, func_source_code_hash, key, verbose, legacy_key_func)
+
+
+def get_backend_cached(func_name, func_source_code_hash, key, verbose=False, legacy_key_func=None):
+    """Get a cached result from the backend, MISSING if not cached."""
+    backend = get_cache_backend()
+    try:
+        # If cache exists, load and return it
+        data = backend.get(key)
+        if data is None and legacy_key_func is not None:
+            # entries written with the previous keys are moved to the current key
+            data = backend.get(legacy_key_func())
+            if data is not None:
+                backend.set(key, data, func=func_name, source_hash=func_source_code_hash)
+        if data is not None:
+            if verbose:
+                logger.info("Used cache for function: " + func_name)
+            result = serialization.loads(data)
+            global_memory_cache.set(key, result, len(data))
+            global_cache_stats[func_name]["disk_hits"] += 1
+            # no-op in the cache I/O thread, noted by afile_cache
+            ledger.note(cache="disk")
+            return result
+    except Exception:
+        logger.info("Unpickling failed")
+    global_cache_stats[func_name]["misses"] += 1
+    return MISSING
+
+
+def set_cached(func_name, func_source_code_hash, key, result):
+    """Save a result in the backend and in the memory cache."""
+    try:
+        data = serialization.dumps(result, CACHE_COMPRESSION, CACHE_EMBEDDINGS_DTYPE)
+        get_cache_backend().set(key, data, func=func_name, source_hash=func_source_code_hash)
+        global_memory_cache.set(key, result, len(data))
+    except Exception as e:
+        logger.info(f"Pickling failed: {e}")
+
+
+def file_cache(ignore_params=[], verbose=False, key_func=None, legacy_source_hash=None, use_legacy=None):
     """Decorator to cache function output based on its inputs, ignoring specified parameters.
     Ignore parameters are used to avoid caching on non-deterministic inputs, such as timestamps.
     We can also ignore parameters that are slow to serialize/constant across runs, such as large objects.
+
+    `key_func` returns the value to hash instead of the arguments, it takes the same arguments as the function.
+    If `legacy_source_hash` is set, results cached with the former keys for this function source hash are reused,
+    for the calls where `use_legacy`, if set, returns True; it takes the same arguments as the function.
+    Concurrent calls with the same key share a single call, even if the cache is disabled.
     """
 
     def decorator(func):
-        if DISABLE_CACHE:
-            if verbose:
-                logger.info("Cache is disabled for function: " + func.__name__)
-            return func
+        if DISABLE_CACHE and verbose:
+            logger.info("Cache is disabled for function: " + func.__name__)
         func_source_code_hash = hash_code(inspect.getsource(func))
+        func_name = f"{func.__module__}_{func.__name__}"
+        register_live_source_hashes(func_name, func_source_code_hash, legacy_source_hash)
 
-        def wrapper(*args, **kwargs):
-            cache_dir = CACHES_DIR
-            os.makedirs(cache_dir, exist_ok=True)
-
-            # Convert args to a dictionary based on the function's signature
-            args_names = func.__code__.co_varnames[: func.__code__.co_argcount]
-            args_dict = dict(zip(args_names, args))
-
-            # Remove ignored params
-            kwargs_clone = kwargs.copy()
-            for param in ignore_params:
-                args_dict.pop(param, None)
-                kwargs_clone.pop(param, None)
-
-            # Create hash based on argument names, argument values, and function source code
-            arg_hash = (
-                recursive_hash(args_dict, ignore_params=ignore_params)
-                + recursive_hash(kwargs_clone, ignore_params=ignore_params)
-                + func_source_code_hash
-            )
-            cache_file = os.path.join(
-                cache_dir, f"{func.__module__}_{func.__name__}_{arg_hash}.pickle"
-            )
+        def get_cached_result(*args, **kwargs):
+            """Get the key and the cached result of a call, MISSING if not cached."""
+            key = cache_key(func, func_source_code_hash, args, kwargs, ignore_params, key_func)
+            if DISABLE_CACHE:
+                return key, MISSING
+            legacy_key_func = get_legacy_key_func(func, legacy_source_hash, use_legacy, args, kwargs, ignore_params)
+            return key, get_cached(func_name, func_source_code_hash, key, verbose, legacy_key_func)
 
-            try:
-                # If cache exists, load and return it
-                if os.path.exists(cache_file):
-                    if verbose:
-                        logger.info("Used cache for function: " + func.__name__)
-                    with open(cache_file, "rb") as f:
-                        return pickle.load(f)
-            except Exception:
-                logger.info("Unpickling failed")
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key, result = get_cached_result(*args, **kwargs)
+            if result is not MISSING:
+                return result
 
             # Otherwise, call the function and save its result to the cache
-            result = func(*args, **kwargs)
-            try:
-                with open(cache_file, "wb") as f:
-                    pickle.dump(result, f)
-            except Exception as e:
-                logger.info(f"Pickling failed: {e}")
+            def call():
+                ledger.note(cache="miss")
+                result = func(*args, **kwargs)
+                if not DISABLE_CACHE:
+                    set_cached(func_name, func_source_code_hash, key, result)
+                return result
+
+            result, shared = global_single_flight.do(key, call)
+            if shared:
+                global_cache_stats[func_name]["coalesced"] += 1
+                ledger.note(cache="coalesced")
             return result
 
+        # lookup only, for callers that compute the missing results themselves
+        wrapper.get_cached = lambda *args, **kwargs: get_cached_result(*args, **kwargs)[1]
         return wrapper
 
     return decorator
 
 
-def afile_cache(ignore_params=[], verbose=False):
+def afile_cache(ignore_params=[], verbose=False, key_func=None, legacy_source_hash=None, use_legacy=None):
     """Decorator to cache function output based on its inputs, ignoring specified parameters.
     Ignore parameters are used to avoid caching on non-deterministic inputs, such as timestamps.
     We can also ignore parameters that are slow to serialize/constant across runs, such as large objects.
+
+    `key_func` returns the value to hash instead of the arguments, it takes the same arguments as the function.
+    If `legacy_source_hash` is set, results cached with the former keys for this function source hash are reused,
+    for the calls where `use_legacy`, if set, returns True; it takes the same arguments as the function.
+    Concurrent calls with the same key share a single call, even if the cache is disabled.
     """
 
     def decorator(func):
-        if DISABLE_CACHE:
-            if verbose:
-                logger.info("Cache is disabled for function: " + func.__name__)
-            return func
+        if DISABLE_CACHE and verbose:
+            logger.info("Cache is disabled for function: " + func.__name__)
         func_source_code_hash = hash_code(inspect.getsource(func))
+        func_name = f"{func.__module__}_{func.__name__}"
+        register_live_source_hashes(func_name, func_source_code_hash, legacy_source_hash)
 
+        @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            cache_dir = CACHES_DIR
-            os.makedirs(cache_dir, exist_ok=True)
-
-            # Convert args to a dictionary based on the function's signature
-            args_names = func.__code__.co_varnames[: func.__code__.co_argcount]
-            args_dict = dict(zip(args_names, args))
-
-            # Remove ignored params
-            kwargs_clone = kwargs.copy()
-            for param in ignore_params:
-                args_dict.pop(param, None)
-                kwargs_clone.pop(param, None)
-
-            # Create hash based on argument names, argument values, and function source code
-            arg_hash = (
-                recursive_hash(args_dict, ignore_params=ignore_params)
-                + recursive_hash(kwargs_clone, ignore_params=ignore_params)
-                + func_source_code_hash
-            )
-            cache_file = os.path.join(
-                cache_dir, f"{func.__module__}_{func.__name__}_{arg_hash}.pickle"
-            )
+            key = cache_key(func, func_source_code_hash, args, kwargs, ignore_params, key_func)
+            if not DISABLE_CACHE:
+                result = global_memory_cache.get(key, MISSING)
+                if result is not MISSING:
+                    global_cache_stats[func_name]["memory_hits"] += 1
+                    ledger.note(cache="memory")
+                    return result
 
-            try:
-                # If cache exists, load and return it
-                if os.path.exists(cache_file):
-                    if verbose:
-                        logger.info("Used cache for function: " + func.__name__)
-                    with open(cache_file, "rb") as f:
-                        return pickle.load(f)
-            except Exception:
-                logger.info("Unpickling failed")
+                legacy_key_func = get_legacy_key_func(func, legacy_source_hash, use_legacy, args, kwargs, ignore_params)
+
+                # the backend is read in the cache I/O thread, not to block the event loop
+                result = await asyncio.get_running_loop().run_in_executor(
+                    global_cache_io_executor,
+                    get_backend_cached, func_name, func_source_code_hash, key, verbose, legacy_key_func,
+                )
+                if result is not MISSING:
+                    ledger.note(cache="disk")
+                    return result
 
             # Otherwise, call the function and save its result to the cache
-            result = await func(*args, **kwargs)
-            try:
-                with open(cache_file, "wb") as f:
-                    pickle.dump(result, f)
-            except Exception as e:
-                logger.info(f"Pickling failed: {e}")
+            async def call():
+                ledger.note(cache="miss")
+                result = await func(*args, **kwargs)
+                if not DISABLE_CACHE:
+                    # written in the background, reads of the cache I/O thread come after this write
+                    global_cache_io_executor.submit(set_cached, func_name, func_source_code_hash, key, result)
+                return result
+
+            result, shared = await global_single_flight.ado(key, call)
+            if shared:
+                global_cache_stats[func_name]["coalesced"] += 1
+                ledger.note(cache="coalesced")
             return result
 
         return wrapper
 
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,177 @@
+"""Per-call ledger of the LLM and embedding traffic of a run.
+
+While a run step is recorded, each call to the wrappers appends a JSON line
+to the `ledger.jsonl` file of the run directory, with the step, the prompt
+template, the token counts, the latency, how the cache served the call and
+the retries. `summarize_ledger` aggregates the records, to find the prompts
+costing the most tokens or time.
+
+The current ledger, step and call record are context variables, they follow
+the calls into the coroutines and the hedged calls threads.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+ENABLE_LEDGER = os.getenv('ENABLE_LEDGER', "true") in ["true", "True", "TRUE"]
+LEDGER_FILE_NAME = "ledger.jsonl"
+# sort keys of the summaries
+SUMMARY_SORT_KEYS = ["tokens", "latency", "calls"]
+
+
+class Ledger:
+    """Append-only JSONL file, shared by the threads of the process."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def append(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+global_ledgers: Dict[str, Ledger] = {}
+global_ledgers_lock = threading.Lock()
+global_current_ledger = contextvars.ContextVar("current_ledger", default=None)
+global_current_step = contextvars.ContextVar("current_step", default=None)
+global_current_record = contextvars.ContextVar("current_record", default=None)
+
+
+def get_ledger(path: str) -> Ledger:
+    with global_ledgers_lock:
+        ledger = global_ledgers.get(path)
+        if ledger is None:
+            ledger = Ledger(path)
+            global_ledgers[path] = ledger
+        return ledger
+
+
+@contextmanager
+def recording(run_dir: str, step: str):
+    """Record the calls made in this context to the ledger of a run directory."""
+    if not ENABLE_LEDGER:
+        yield
+        return
+    ledger_token = global_current_ledger.set(get_ledger(os.path.join(run_dir, LEDGER_FILE_NAME)))
+    step_token = global_current_step.set(step)
+    try:
+        yield
+    finally:
+        global_current_step.reset(step_token)
+        global_current_ledger.reset(ledger_token)
+
+
+@contextmanager
+def record_call(kind: str, **fields):
+    """Record of a model call, appended to the current ledger when the call is done.
+
+    Calls made inside a recorded call, like `achat` called by `apredict`,
+    share the record of the outer call.
+    """
+    ledger = global_current_ledger.get()
+    if ledger is None or global_current_record.get() is not None:
+        yield
+        return
+    record = {
+        "time": round(time.time(), 3),
+        "step": global_current_step.get(),
+        "kind": kind,
+        **fields,
+        "cache": None,
+        "prompt_tokens": None,
+        "completion_tokens": None,
+        "retries": 0,
+        "hedged": False,
+    }
+    record_token = global_current_record.set(record)
+    start_time = time.monotonic()
+    try:
+        yield
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["latency"] = round(time.monotonic() - start_time, 4)
+        global_current_record.reset(record_token)
+        try:
+            ledger.append(record)
+        except Exception as e:
+            logger.warning(f"Ledger write failed: {e}")
+
+
+def note(**fields) -> None:
+    """Set fields of the current call record, if any."""
+    record = global_current_record.get()
+    if record is not None:
+        record.update(fields)
+
+
+def note_count(field: str, count: int = 1) -> None:
+    record = global_current_record.get()
+    if record is not None:
+        record[field] = (record.get(field) or 0) + count
+
+
+def note_tokens(raw) -> None:
+    """Token counts of an Ollama response."""
+    if isinstance(raw, dict):
+        note(prompt_tokens=raw.get("prompt_eval_count"), completion_tokens=raw.get("eval_count"))
+
+
+def read_ledger(path: str) -> List[dict]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def summarize_ledger(records: List[dict], group_by: List[str] = ["step", "kind", "prompt_id"], sort_by: str = "tokens", top: Optional[int] = 10) -> List[dict]:
+    """Aggregate the records by group, sorted by decreasing tokens, latency or number of calls.
+
+    Tokens are those of the calls sent to the model, not served by the cache.
+    """
+    if sort_by not in SUMMARY_SORT_KEYS:
+        raise ValueError(f"Unknown sort key: {sort_by}, available: {SUMMARY_SORT_KEYS}")
+    groups = defaultdict(lambda: {"calls": 0, "cached": 0, "tokens": 0, "latency": 0.0, "max_latency": 0.0, "retries": 0, "errors": 0})
+    for record in records:
+        key = tuple(record.get(field) for field in group_by)
+        group = groups[key]
+        group["calls"] += 1
+        if record.get("cache") not in [None, "miss"]:
+            group["cached"] += 1
+        else:
+            group["tokens"] += (record.get("prompt_tokens") or 0) + (record.get("completion_tokens") or 0)
+        latency = record.get("latency") or 0.0
+        group["latency"] += latency
+        group["max_latency"] = max(group["max_latency"], latency)
+        group["retries"] += record.get("retries") or 0
+        group["errors"] += 1 if record.get("error") else 0
+        if "prompt" in record and "prompt" not in group:
+            group["prompt"] = record["prompt"]
+    summary = [{**dict(zip(group_by, key)), **group} for key, group in groups.items()]
+    summary.sort(key=lambda group: group[sort_by], reverse=True)
+    return summary[:top] if top is not None else summary
@@ -0,0 +1,325 @@
+"""Process-wide limits of the requests sent to the model backend.
+
+All the LLM calls share one pool and all the embedding calls another one,
+whatever the caller: extractor jobs, cascade summaries, pipeline threads of
+the API or queries. A pool bounds the number of requests in flight and,
+optionally, their rate with a token bucket.
+
+Pools work across threads and event loops: a waiting thread blocks on a
+future, a waiting coroutine awaits it, and a released slot is handed over
+to the oldest waiter.
+
+The number of slots of a pool is adapted to the backend by an AIMD
+controller: one more slot when the pool is saturated and the p95 latency of
+the last requests is under target, half the slots on timeouts, 429 and 5xx
+responses, or when the p95 latency goes over target.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# max number of requests in flight, and max requests per second (0 for no rate limit)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', "8"))
+LLM_RATE_LIMIT = float(os.getenv('LLM_RATE_LIMIT', "0"))
+EMBED_MAX_CONCURRENCY = int(os.getenv('EMBED_MAX_CONCURRENCY', "4"))
+EMBED_RATE_LIMIT = float(os.getenv('EMBED_RATE_LIMIT', "0"))
+# adapt the number of requests in flight, up to the max, to keep the p95 latency (seconds) under target
+ADAPTIVE_CONCURRENCY = os.getenv('ADAPTIVE_CONCURRENCY', "true") in ["true", "True", "TRUE"]
+LLM_TARGET_LATENCY = float(os.getenv('LLM_TARGET_LATENCY', "20"))
+EMBED_TARGET_LATENCY = float(os.getenv('EMBED_TARGET_LATENCY', "5"))
+
+OVERLOAD_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """Whether an error means the backend is overloaded: timeout, 429 or 5xx response."""
+    if isinstance(error, (httpx.TimeoutException, TimeoutError, asyncio.TimeoutError)):
+        return True
+    # ollama.ResponseError has a status code, httpx.HTTPStatusError a response
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code in OVERLOAD_STATUS_CODES or (isinstance(status_code, int) and status_code >= 500)
+
+
+def percentile(values, q: float) -> float:
+    """q-th percentile (0-100) of values, nearest rank."""
+    sorted_values = sorted(values)
+    rank = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+class TokenBucket:
+    """Token bucket of `rate` tokens per second, up to `burst` tokens."""
+
+    def __init__(self, rate: float, burst: float = 1.0) -> None:
+        self._rate = rate
+        self._burst = max(burst, 1.0)
+        self._tokens = self._burst
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returns the number of seconds to wait before using it."""
+        if self._rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last_time) * self._rate)
+            self._last_time = now
+            # tokens can go negative: the next callers wait for the reserved ones
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+
+
+class Limiter:
+    """Pool of `max_concurrency` slots, each acquired slot also takes a token of the rate limit."""
+
+    def __init__(self, name: str, max_concurrency: int, rate: float = 0, burst: float = 1.0) -> None:
+        self.name = name
+        self._limit = max(max_concurrency, 1)
+        self._bucket = TokenBucket(rate, burst)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waiters = deque()
+        self.nb_acquired = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.controller: Optional["AIMDController"] = None
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _try_acquire(self):
+        """Get a slot now (None), or a future resolved when a slot is handed over."""
+        with self._lock:
+            if self._in_use < self._limit and not self._waiters:
+                self._in_use += 1
+                return None
+            future = concurrent.futures.Future()
+            self._waiters.append(future)
+            return future
+
+    def release(self) -> None:
+        with self._lock:
+            # above a lowered limit, slots are not handed over
+            if self._in_use <= self._limit and self._hand_over():
+                return
+            self._in_use -= 1
+
+    def _hand_over(self) -> bool:
+        while self._waiters:
+            future = self._waiters.popleft()
+            # cancelled waiters are skipped, the slot goes to the next one
+            if future.set_running_or_notify_cancel():
+                future.set_result(None)
+                return True
+        return False
+
+    def set_limit(self, limit: int) -> None:
+        with self._lock:
+            self._limit = max(limit, 1)
+            while self._in_use < self._limit and self._hand_over():
+                self._in_use += 1
+
+    def _record_wait(self, start_time: float) -> None:
+        wait_time = time.monotonic() - start_time
+        with self._lock:
+            self.nb_acquired += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def acquire(self) -> None:
+        start_time = time.monotonic()
+        future = self._try_acquire()
+        if future is not None:
+            future.result()
+        delay = self._bucket.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        self._record_wait(start_time)
+
+    async def aacquire(self) -> None:
+        start_time = time.monotonic()
+        future = self._try_acquire()
+        if future is not None:
+            try:
+                await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                # the slot may have been handed over just before the cancellation
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        try:
+            delay = self._bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        self._record_wait(start_time)
+
+    def is_saturated(self) -> bool:
+        return self._in_use >= self._limit or len(self._waiters) > 0
+
+    def _record_request(self, start_time: float, error: Optional[BaseException]) -> None:
+        if self.controller is None:
+            return
+        if error is None:
+            self.controller.record_success(time.monotonic() - start_time)
+        else:
+            self.controller.record_failure(error)
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        start_time = time.monotonic()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # recorded before the release, while the slot still counts in flight
+            self._record_request(start_time, error)
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self.aacquire()
+        start_time = time.monotonic()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record_request(start_time, error)
+            self.release()
+
+    def stats_str(self) -> str:
+        mean_wait = self.total_wait_time / self.nb_acquired if self.nb_acquired > 0 else 0
+        stats_str = (
+            f"in flight:{self._in_use}/{self._limit}, queued:{len(self._waiters)}, "
+            f"requests:{self.nb_acquired}, wait mean:{mean_wait:.2f}s max:{self.max_wait_time:.2f}s"
+        )
+        if self.controller is not None:
+            stats_str += f", {self.controller.stats_str()}"
+        return stats_str
+
+
+class AIMDController:
+    """Additive increase, multiplicative decrease of the slots of a limiter.
+
+    Every `window` successful requests, the limit grows by one if the pool
+    was saturated and the p95 latency of these requests is under
+    `target_latency`. It is multiplied by `decrease_factor` on overload
+    errors or when the p95 latency is over target, at most once per
+    `target_latency` seconds, so that the requests started with the former
+    limit do not cut it again.
+    """
+
+    def __init__(
+        self,
+        limiter: Limiter,
+        min_limit: int,
+        max_limit: int,
+        target_latency: float,
+        window: int = 20,
+        decrease_factor: float = 0.5,
+    ) -> None:
+        self._limiter = limiter
+        self._min_limit = max(min_limit, 1)
+        self._max_limit = max(max_limit, self._min_limit)
+        self._target_latency = target_latency
+        self._window = window
+        self._decrease_factor = decrease_factor
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._nb_samples = 0
+        self._saturated = False
+        self._last_decrease_time = None
+        self.nb_increases = 0
+        self.nb_decreases = 0
+        self.nb_overloads = 0
+        limiter.controller = self
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+            self._nb_samples += 1
+            self._saturated = self._saturated or self._limiter.is_saturated()
+            if self._nb_samples < self._window:
+                return
+            p95 = percentile(self._latencies, 95)
+            if p95 > self._target_latency:
+                self._decrease(f"p95 latency {p95:.1f}s over target {self._target_latency:.1f}s")
+            elif self._saturated and self._limiter.limit < self._max_limit:
+                self._limiter.set_limit(self._limiter.limit + 1)
+                self.nb_increases += 1
+                logger.debug(f"{self._limiter.name} pool: limit increased to {self._limiter.limit}, p95 latency {p95:.1f}s")
+            self._nb_samples = 0
+            self._saturated = False
+
+    def record_failure(self, error: BaseException) -> None:
+        if not is_overload_error(error):
+            return
+        with self._lock:
+            self.nb_overloads += 1
+            self._decrease(f"{type(error).__name__}: {error}")
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        if self._last_decrease_time is not None and now - self._last_decrease_time < self._target_latency:
+            return
+        self._last_decrease_time = now
+        new_limit = max(self._min_limit, int(self._limiter.limit * self._decrease_factor))
+        if new_limit < self._limiter.limit:
+            self._limiter.set_limit(new_limit)
+            self.nb_decreases += 1
+            logger.info(f"{self._limiter.name} pool: limit decreased to {new_limit}, {reason}")
+        self._latencies.clear()
+        self._nb_samples = 0
+        self._saturated = False
+
+    def stats_str(self) -> str:
+        return f"adaptive limit:+{self.nb_increases}/-{self.nb_decreases}, overloads:{self.nb_overloads}"
+
+
+def create_limiter(name: str, max_concurrency: int, rate: float, target_latency: float) -> Limiter:
+    """Limiter of `max_concurrency` requests in flight, or adapted up to it if ADAPTIVE_CONCURRENCY."""
+    if not ADAPTIVE_CONCURRENCY:
+        return Limiter(name, max_concurrency, rate)
+    # slow start: half of the max, grown while the backend keeps up
+    limiter = Limiter(name, max(1, max_concurrency // 2), rate)
+    AIMDController(limiter, min_limit=1, max_limit=max_concurrency, target_latency=target_latency)
+    return limiter
+
+
+chat_limiter = create_limiter("chat", LLM_MAX_CONCURRENCY, LLM_RATE_LIMIT, LLM_TARGET_LATENCY)
+embed_limiter = create_limiter("embed", EMBED_MAX_CONCURRENCY, EMBED_RATE_LIMIT, EMBED_TARGET_LATENCY)
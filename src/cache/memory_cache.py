@@ -0,0 +1,68 @@
+"""In-process LRU cache, in front of the persistent file cache.
+
+Entries are bounded both in number and in total size. The size of an entry
+is given by the caller, the file cache uses the size of the serialized value.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Tuple
+
+MISSING = object()
+
+
+class MemoryLRUCache:
+    """Thread-safe LRU cache bounded in entries and in bytes."""
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self._nb_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, MISSING)
+            if entry is MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, value: Any, size: int) -> None:
+        if self._max_entries <= 0 or size > self._max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._nb_bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._nb_bytes += size
+            while len(self._entries) > self._max_entries or self._nb_bytes > self._max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._nb_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nb_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def nb_bytes(self) -> int:
+        return self._nb_bytes
+
+    def stats_str(self) -> str:
+        return (
+            f"entries:{len(self._entries)}/{self._max_entries}, "
+            f"size:{self._nb_bytes / 1e6:.1f}/{self._max_bytes / 1e6:.0f}MB, "
+            f"hits:{self.hits}, evictions:{self.evictions}"
+        )
@@ -0,0 +1,144 @@
+"""Long-lived HTTP clients of the Ollama backend.
+
+The native models share one keep-alive connection pool per host: a sync
+client used by all the threads, and an async client per event loop (httpx
+connections can not move from a loop to another). The native models are
+also reused while their model, host and parameters do not change, so
+calling `set_api_key` on each API request keeps the open connections.
+"""
+
+import asyncio
+import importlib.util
+import logging
+import os
+import threading
+import weakref
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+from dotenv import load_dotenv
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse
+from llama_index.embeddings.ollama import OllamaEmbedding
+from llama_index.llms.ollama import Ollama
+from ollama import AsyncClient, Client
+
+from src.cache import ledger
+from src.cache.cache_key import canonical_hash
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', "https://chat.darwin-x.com")
+OLLAMA_REQUEST_TIMEOUT = float(os.getenv('OLLAMA_REQUEST_TIMEOUT', "30"))
+# connections kept per host, and seconds an idle connection is kept open
+OLLAMA_MAX_CONNECTIONS = int(os.getenv('OLLAMA_MAX_CONNECTIONS', "32"))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OLLAMA_MAX_KEEPALIVE_CONNECTIONS', "16"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv('OLLAMA_KEEPALIVE_EXPIRY', "60"))
+# HTTP/2 is only used if the h2 package is installed
+OLLAMA_HTTP2 = os.getenv('OLLAMA_HTTP2', "true") in ["true", "True", "TRUE"]
+
+global_clients: Dict[Tuple[str, float], Client] = {}
+global_async_clients: Dict[Tuple[str, float], "weakref.WeakKeyDictionary"] = {}
+global_native_models: Dict[str, Any] = {}
+global_clients_lock = threading.Lock()
+
+
+def http_client_kwargs() -> dict:
+    kwargs = {
+        "limits": httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+        ),
+    }
+    if OLLAMA_HTTP2 and importlib.util.find_spec("h2") is not None:
+        kwargs["http2"] = True
+    return kwargs
+
+
+def get_client(host: str, timeout: float) -> Client:
+    """Sync client of a host, shared by all the threads."""
+    with global_clients_lock:
+        client = global_clients.get((host, timeout))
+        if client is None:
+            client = Client(host=host, timeout=timeout, **http_client_kwargs())
+            global_clients[(host, timeout)] = client
+        return client
+
+
+def get_async_client(host: str, timeout: float) -> AsyncClient:
+    """Async client of a host, shared by the coroutines of the running event loop."""
+    loop = asyncio.get_running_loop()
+    with global_clients_lock:
+        loop_clients = global_async_clients.setdefault((host, timeout), weakref.WeakKeyDictionary())
+        client = loop_clients.get(loop)
+        if client is None:
+            client = AsyncClient(host=host, timeout=timeout, **http_client_kwargs())
+            loop_clients[loop] = client
+        return client
+
+
+class PooledOllama(Ollama):
+    """Ollama llm using the shared clients of its host."""
+
+    @property
+    def client(self) -> Client:
+        return get_client(self.base_url, self.request_timeout)
+
+    @property
+    def async_client(self) -> AsyncClient:
+        return get_async_client(self.base_url, self.request_timeout)
+
+    # token counts of the responses, for the ledger of the calls
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        response = super().chat(messages, **kwargs)
+        ledger.note_tokens(response.raw)
+        return response
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        response = await super().achat(messages, **kwargs)
+        ledger.note_tokens(response.raw)
+        return response
+
+
+class PooledOllamaEmbedding(OllamaEmbedding):
+    """Ollama embedding model using the shared clients of its host."""
+
+    def get_general_text_embedding(self, texts: str) -> List[float]:
+        result = get_client(self.base_url, OLLAMA_REQUEST_TIMEOUT).embeddings(
+            model=self.model_name, prompt=texts, options=self.ollama_additional_kwargs
+        )
+        return result["embedding"]
+
+    async def aget_general_text_embedding(self, prompt: str) -> List[float]:
+        result = await get_async_client(self.base_url, OLLAMA_REQUEST_TIMEOUT).embeddings(
+            model=self.model_name, prompt=prompt, options=self.ollama_additional_kwargs
+        )
+        return result["embedding"]
+
+
+def _get_native_model(model_class, **kwargs: Any):
+    key = f"{model_class.__name__}_{canonical_hash(kwargs)}"
+    with global_clients_lock:
+        native_model = global_native_models.get(key)
+        if native_model is None:
+            native_model = model_class(**kwargs)
+            global_native_models[key] = native_model
+            logger.info(f"Created native model {model_class.__name__}: {kwargs.get('model') or kwargs.get('model_name')}")
+        return native_model
+
+
+def get_native_llm(model: str, base_url: Optional[str] = None, kwargs: Optional[dict] = None) -> Ollama:
+    """Native llm of a model, reused while its host and parameters do not change."""
+    return _get_native_model(
+        PooledOllama, model=model, base_url=base_url or OLLAMA_BASE_URL,
+        request_timeout=OLLAMA_REQUEST_TIMEOUT, kwargs=kwargs,
+    )
+
+
+def get_native_embed_model(model: str, base_url: Optional[str] = None, ollama_additional_kwargs: Optional[dict] = None, kwargs: Optional[dict] = None) -> OllamaEmbedding:
+    """Native embedding model of a model, reused while its host and parameters do not change."""
+    return _get_native_model(
+        PooledOllamaEmbedding, model_name=model, base_url=base_url or OLLAMA_BASE_URL,
+        ollama_additional_kwargs=ollama_additional_kwargs, kwargs=kwargs,
+    )
@@ -0,0 +1,193 @@
+"""Retries and hedged requests of the calls to the model backend.
+
+A call failing with a transient error (timeout, connection error, 429 or
+5xx response) is retried after a jittered exponential backoff, instead of
+aborting the pipeline step.
+
+A call slower than a percentile of the recent latencies of the same
+operation is hedged: a duplicate request is sent and the first response is
+used. The calls are made inside the cached functions, so only the winning
+response is cached.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+
+import httpx
+from dotenv import load_dotenv
+
+from src.cache import ledger
+from src.cache.limiter import is_overload_error, percentile
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# retries of the failed calls, with a random backoff up to base * 2 ** attempt seconds, capped to max
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', "30"))
+# hedge the calls slower than this percentile of the recent latencies (0 to disable), once there are enough samples
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', "0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', "20"))
+LATENCY_WINDOW = 200
+
+# the hedged sync calls and their duplicates run in these threads
+global_hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm_hedge")
+
+# per operation counters of "calls", "retries", "hedges", "hedge_wins" and "failures"
+global_retry_stats = defaultdict(lambda: defaultdict(int))
+global_latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+global_latencies_lock = threading.Lock()
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """Whether a call failing with this error can succeed if retried."""
+    return is_overload_error(error) or isinstance(error, (httpx.TransportError, ConnectionError))
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full jitter backoff before the retry following the given attempt (0 for the first one)."""
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def record_latency(name: str, latency: float) -> None:
+    with global_latencies_lock:
+        global_latencies[name].append(latency)
+
+
+def hedge_delay(name: str):
+    """Seconds after which a call is hedged, None if the call is not hedged."""
+    if LLM_HEDGE_PERCENTILE <= 0:
+        return None
+    with global_latencies_lock:
+        latencies = list(global_latencies[name])
+    if len(latencies) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return percentile(latencies, LLM_HEDGE_PERCENTILE)
+
+
+def retry_stats_str(names) -> str:
+    counters = defaultdict(int)
+    for name in names:
+        for counter, value in global_retry_stats[name].items():
+            counters[counter] += value
+    return (
+        f"retries:{counters['retries']}, hedges:{counters['hedges']}"
+        f"(won:{counters['hedge_wins']}), failures:{counters['failures']}"
+    )
+
+
+def _timed_call(name, fn):
+    start_time = time.monotonic()
+    result = fn()
+    record_latency(name, time.monotonic() - start_time)
+    return result
+
+
+def _hedged_call(name, fn, hedge):
+    delay = hedge_delay(name) if hedge else None
+    if delay is None:
+        return _timed_call(name, fn)
+
+    # the context is copied so that the calls see the context variables of the caller
+    def submit():
+        return global_hedge_executor.submit(contextvars.copy_context().run, _timed_call, name, fn)
+
+    primary = submit()
+    done, _ = concurrent.futures.wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+    global_retry_stats[name]["hedges"] += 1
+    ledger.note(hedged=True)
+    logger.debug(f"{name}: no response after {delay:.1f}s, hedged")
+    pending = {primary, submit()}
+    first_error = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    global_retry_stats[name]["hedge_wins"] += 1
+                # the response of the other request, if any, is dropped
+                return future.result()
+            first_error = first_error or future.exception()
+    raise first_error
+
+
+async def _ahedged_call(name, afn, hedge):
+    delay = hedge_delay(name) if hedge else None
+
+    async def timed_call():
+        start_time = time.monotonic()
+        result = await afn()
+        record_latency(name, time.monotonic() - start_time)
+        return result
+
+    if delay is None:
+        return await timed_call()
+
+    primary = asyncio.ensure_future(timed_call())
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return primary.result()
+        global_retry_stats[name]["hedges"] += 1
+        ledger.note(hedged=True)
+        logger.debug(f"{name}: no response after {delay:.1f}s, hedged")
+        pending.add(asyncio.ensure_future(timed_call()))
+        first_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        global_retry_stats[name]["hedge_wins"] += 1
+                    return task.result()
+                first_error = first_error or task.exception()
+        raise first_error
+    finally:
+        # the slower request is cancelled
+        for task in pending:
+            task.cancel()
+
+
+def call_with_retry(name: str, fn, hedge: bool = True):
+    """Call `fn()`, retried on transient errors and hedged if slow."""
+    global_retry_stats[name]["calls"] += 1
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return _hedged_call(name, fn, hedge)
+        except Exception as e:
+            if attempt >= LLM_MAX_RETRIES or not is_retryable_error(e):
+                global_retry_stats[name]["failures"] += 1
+                raise
+            delay = backoff_delay(attempt)
+            global_retry_stats[name]["retries"] += 1
+            ledger.note_count("retries")
+            logger.warning(f"{name}: {type(e).__name__}: {e}, retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+async def acall_with_retry(name: str, afn, hedge: bool = True):
+    """Await `afn()`, retried on transient errors and hedged if slow."""
+    global_retry_stats[name]["calls"] += 1
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return await _ahedged_call(name, afn, hedge)
+        except Exception as e:
+            if attempt >= LLM_MAX_RETRIES or not is_retryable_error(e):
+                global_retry_stats[name]["failures"] += 1
+                raise
+            delay = backoff_delay(attempt)
+            global_retry_stats[name]["retries"] += 1
+            ledger.note_count("retries")
+            logger.warning(f"{name}: {type(e).__name__}: {e}, retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
@@ -0,0 +1,160 @@
+"""Serialization of cached values.
+
+Values are stored in a compact, versioned format instead of pickles:
+
+    magic (3 bytes) | version (1 byte) | kind (1 byte) | codec (1 byte) | payload
+
+- "str": the utf-8 text, for predict results
+- "embeddings": a list of float vectors of the same size, packed as a float32
+  (or float16) array after a small header
+- "json": values registered with `register_json_kind`, like chat responses,
+  reduced to a JSON document of their text and minimal metadata
+- "pickle": any other value
+
+The payload is compressed with zstd if the zstandard package is installed,
+with zlib otherwise. Loading only needs the decoder of a registered kind, not
+the classes of the cached objects: without a decoder a "json" value is
+loaded as a dict. Data without the magic header are legacy pickles.
+"""
+
+import json
+import logging
+import pickle
+import struct
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"TMS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<3sBBB")
+
+KIND_PICKLE = 0
+KIND_STR = 1
+KIND_EMBEDDINGS = 2
+KIND_JSON = 3
+
+CODEC_NONE = 0
+CODEC_ZSTD = 1
+CODEC_ZLIB = 2
+CODECS = {"none": CODEC_NONE, "zstd": CODEC_ZSTD, "zlib": CODEC_ZLIB}
+# payloads smaller than this are not worth compressing
+MIN_COMPRESSED_SIZE = 256
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+EMBEDDINGS_HEADER = struct.Struct("<IIB")
+EMBEDDINGS_DTYPES = {"float32": (0, np.float32), "float16": (1, np.float16)}
+EMBEDDINGS_DTYPES_BY_ID = {dtype_id: dtype for dtype_id, dtype in EMBEDDINGS_DTYPES.values()}
+
+# JSON kinds: type name -> (class, encoder to a JSON value, decoder from a JSON value)
+_json_kinds: Dict[str, tuple] = {}
+
+
+def register_json_kind(name: str, cls: type, encoder: Callable[[Any], Any], decoder: Callable[[Any], Any]) -> None:
+    """Store instances of `cls` as `encoder(instance)` in JSON, loaded with `decoder`."""
+    _json_kinds[name] = (cls, encoder, decoder)
+
+
+def default_codec() -> str:
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def _compress(payload: bytes, codec: str) -> Tuple[int, bytes]:
+    if codec == "none" or len(payload) < MIN_COMPRESSED_SIZE:
+        return CODEC_NONE, payload
+    if codec == "zstd" and zstandard is not None:
+        return CODEC_ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    return CODEC_ZLIB, zlib.compress(payload, ZLIB_LEVEL)
+
+
+def _decompress(payload: bytes, codec_id: int) -> bytes:
+    if codec_id == CODEC_NONE:
+        return payload
+    if codec_id == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    if codec_id == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Cache value compressed with zstd, the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown cache value codec: {codec_id}")
+
+
+def _is_embeddings(value: Any) -> bool:
+    if not isinstance(value, list) or not value:
+        return False
+    first = value[0]
+    if not isinstance(first, list) or not first or type(first[0]) is not float:
+        return False
+    dim = len(first)
+    return all(isinstance(vector, list) and len(vector) == dim for vector in value)
+
+
+def _encode_embeddings(value: list, dtype_name: str) -> bytes:
+    dtype_id, dtype = EMBEDDINGS_DTYPES[dtype_name]
+    array = np.asarray(value, dtype=dtype)
+    return EMBEDDINGS_HEADER.pack(array.shape[0], array.shape[1], dtype_id) + array.tobytes()
+
+
+def _decode_embeddings(payload: bytes) -> list:
+    nb_rows, dim, dtype_id = EMBEDDINGS_HEADER.unpack_from(payload)
+    array = np.frombuffer(payload, dtype=EMBEDDINGS_DTYPES_BY_ID[dtype_id], offset=EMBEDDINGS_HEADER.size)
+    return array.reshape(nb_rows, dim).tolist()
+
+
+def _encode_json_kind(value: Any) -> Optional[bytes]:
+    for name, (cls, encoder, _) in _json_kinds.items():
+        if isinstance(value, cls):
+            try:
+                document = {"type": name, "value": encoder(value)}
+                return json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            except (TypeError, ValueError) as e:
+                logger.debug(f"{name} value not serializable to JSON, pickled: {e}")
+                return None
+    return None
+
+
+def dumps(value: Any, codec: Optional[str] = None, embeddings_dtype: str = "float32") -> bytes:
+    """Serialize a value to bytes."""
+    if isinstance(value, str):
+        kind, payload = KIND_STR, value.encode("utf-8", "surrogatepass")
+    elif _is_embeddings(value):
+        kind, payload = KIND_EMBEDDINGS, _encode_embeddings(value, embeddings_dtype)
+    else:
+        payload = _encode_json_kind(value)
+        if payload is not None:
+            kind = KIND_JSON
+        else:
+            kind, payload = KIND_PICKLE, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    # packed floats barely compress, they are stored as is for faster loads
+    codec_id, payload = _compress(payload, "none" if kind == KIND_EMBEDDINGS else codec or default_codec())
+    return HEADER.pack(MAGIC, FORMAT_VERSION, kind, codec_id) + payload
+
+
+def loads(data: bytes) -> Any:
+    """Deserialize a value from bytes written by `dumps`, or from a legacy pickle."""
+    if data[:len(MAGIC)] != MAGIC:
+        return pickle.loads(data)
+    _, version, kind, codec_id = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unknown cache value format version: {version}")
+    payload = _decompress(data[HEADER.size:], codec_id)
+    if kind == KIND_STR:
+        return payload.decode("utf-8", "surrogatepass")
+    if kind == KIND_EMBEDDINGS:
+        return _decode_embeddings(payload)
+    if kind == KIND_JSON:
+        document = json.loads(payload)
+        _, _, decoder = _json_kinds.get(document["type"], (None, None, None))
+        return decoder(document["value"]) if decoder is not None else document
+    if kind == KIND_PICKLE:
+        return pickle.loads(payload)
+    raise ValueError(f"Unknown cache value kind: {kind}")
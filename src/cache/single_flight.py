@@ -0,0 +1,78 @@
+"""Coalescing of concurrent identical calls.
+
+While a call for a key is in flight, other callers with the same key wait for
+its result instead of calling again. The in-flight calls are shared futures
+in a dict guarded by a thread lock, so callers can be threads, coroutines of
+one event loop or coroutines of loops running in different threads.
+
+Sync and async calls must use different keys: a sync caller blocks its thread
+until the result is ready, which would block the event loop of an async call.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class SingleFlight:
+    """Run a single call at a time per key, sharing its result with concurrent callers."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[str, concurrent.futures.Future] = {}
+
+    def _join(self, key: str) -> Tuple[concurrent.futures.Future, bool]:
+        """Get the future of the call in flight for key, and whether the caller has to run it."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = concurrent.futures.Future()
+            # a running future can not be cancelled by a cancelled follower
+            future.set_running_or_notify_cancel()
+            self._calls[key] = future
+            return future, True
+
+    def _leave(self, key: str) -> None:
+        with self._lock:
+            del self._calls[key]
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Call `fn` unless a call for key is in flight.
+
+        Returns the result and whether it was shared with another caller.
+        """
+        future, is_leader = self._join(key)
+        if not is_leader:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._leave(key)
+        future.set_result(result)
+        return result, False
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Await `fn()` unless a call for key is in flight.
+
+        Returns the result and whether it was shared with another caller.
+        """
+        future, is_leader = self._join(key)
+        if not is_leader:
+            return await asyncio.wrap_future(future), True
+        try:
+            result = await fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._leave(key)
+        future.set_result(result)
+        return result, False
+
+    def __len__(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,162 @@
+"""Per-text cache of embeddings.
+
+Embeddings of a model are stored as the rows of an append-only float32
+matrix file, read through a memory map. A SQLite table maps the hash of each
+text to its row, so a batch only needs to embed the texts that were never
+embedded before, whatever the batch boundaries are.
+
+Files of a model, in the `vectors` directory of the cache directory:
+- `{model_hash}.f32`: the float32 matrix, one row per text
+- `{model_hash}.sqlite3`: the text hash -> row index table
+"""
+
+import atexit
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.cache.cache_key import canonical_hash
+
+logger = logging.getLogger(__name__)
+
+VECTORS_DIR_NAME = "vectors"
+MATRIX_EXTENSION = ".f32"
+INDEX_EXTENSION = ".sqlite3"
+# maximum number of sqlite parameters in a single lookup query
+LOOKUP_BATCH_SIZE = 500
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+class VectorCache:
+    """Embeddings of a single model, indexed by the hash of the embedded text."""
+
+    def __init__(self, cache_dir: str, model_key) -> None:
+        self._name = canonical_hash(model_key)
+        vectors_dir = os.path.join(cache_dir, VECTORS_DIR_NAME)
+        os.makedirs(vectors_dir, exist_ok=True)
+        self._matrix_path = os.path.join(vectors_dir, f"{self._name}{MATRIX_EXTENSION}")
+        self._lock = threading.RLock()
+        self._matrix = None
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(
+            os.path.join(vectors_dir, f"{self._name}{INDEX_EXTENSION}"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vectors (text_hash TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            "INSERT OR IGNORE INTO meta (name, value) VALUES ('model', ?)", (repr(model_key),)
+        )
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self._dim = int(row[0]) if row is not None else None
+        atexit.register(self.close)
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self._dim
+
+    def _nb_rows(self) -> int:
+        if self._dim is None or not os.path.exists(self._matrix_path):
+            return 0
+        # rows of a failed index commit stay in the file, they are never read
+        return os.path.getsize(self._matrix_path) // (self._dim * 4)
+
+    def _get_matrix(self, min_nb_rows: int) -> np.ndarray:
+        """Memory map of the matrix, mapped again if it does not contain `min_nb_rows` rows."""
+        if self._matrix is None or len(self._matrix) < min_nb_rows:
+            nb_rows = self._nb_rows()
+            self._matrix = np.memmap(self._matrix_path, dtype=np.float32, mode="r", shape=(nb_rows, self._dim))
+        return self._matrix
+
+    def _lookup_rows(self, hashes: Sequence[str]) -> Dict[str, int]:
+        rows = {}
+        for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+            batch = hashes[start:start + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows.update(
+                self._conn.execute(
+                    f"SELECT text_hash, row FROM vectors WHERE text_hash IN ({placeholders})", batch
+                ).fetchall()
+            )
+        return rows
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Get the cached embedding of each text, None for the texts not cached."""
+        hashes = [text_hash(text) for text in texts]
+        with self._lock:
+            rows = self._lookup_rows(list(set(hashes)))
+            result: List[Optional[List[float]]] = [None] * len(texts)
+            hit_positions = [i for i, h in enumerate(hashes) if h in rows]
+            if hit_positions:
+                hit_rows = [rows[hashes[i]] for i in hit_positions]
+                matrix = self._get_matrix(max(hit_rows) + 1)
+                for i, embedding in zip(hit_positions, matrix[hit_rows].tolist()):
+                    result[i] = embedding
+            self.hits += len(hit_positions)
+            self.misses += len(texts) - len(hit_positions)
+        return result
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[Sequence[float]]) -> List[List[float]]:
+        """Append the embeddings of texts, returns them as stored (rounded to float32)."""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(texts):
+            raise ValueError(f"Expected {len(texts)} embeddings, got an array of shape {vectors.shape}")
+        hashes = [text_hash(text) for text in texts]
+        with self._lock:
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                self._conn.execute("INSERT INTO meta (name, value) VALUES ('dim', ?)", (str(self._dim),))
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f"Expected embeddings of dimension {self._dim}, got {vectors.shape[1]}")
+
+            # the same text may appear several times in a batch, or have been added since the lookup
+            existing = self._lookup_rows(list(set(hashes)))
+            new_positions = {}
+            for i, h in enumerate(hashes):
+                if h not in existing and h not in new_positions:
+                    new_positions[h] = i
+            if new_positions:
+                first_row = self._nb_rows()
+                # the matrix is written before the index, so that every indexed row exists
+                with open(self._matrix_path, "ab") as f:
+                    f.write(vectors[list(new_positions.values())].tobytes())
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(
+                        "INSERT INTO vectors (text_hash, row) VALUES (?, ?)",
+                        [(h, first_row + n) for n, h in enumerate(new_positions)],
+                    )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        return vectors.tolist()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.close()
+            self._conn = None
+            self._matrix = None
+        atexit.unregister(self.close)
+
+    def stats_str(self) -> str:
+        return f"texts:{self.hits + self.misses}, hits:{self.hits}, misses:{self.misses}"
@@ -1,6 +1,12 @@
+import asyncio
+import contextvars
+import functools
 import logging
-from typing import Any, List
-from llama_index.core.bridge.pydantic import Field
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
 from llama_index.llms.nvidia import NVIDIA
 from llama_index.embeddings.nvidia import NVIDIAEmbedding
 from llama_index.core.base.llms.types import ChatMessage, ChatResponse, CompletionResponse, LLMMetadata
@@ -8,13 +14,29 @@ from llama_index.core.prompts import BasePromptTemplate
 from llama_index.llms.ollama import Ollama
 from llama_index.embeddings.ollama import OllamaEmbedding
 
-from src.cache.file_cache import file_cache, afile_cache
+from src.cache import ledger
+from src.cache.cache_key import canonical_hash, register_canonical
+from src.cache.serialization import register_json_kind
+from src.cache.file_cache import DISABLE_CACHE, file_cache, afile_cache, get_cache_stats, get_vector_cache, global_memory_cache
+from src.cache.endpoints import OLLAMA_BASE_URLS, get_endpoint_pool
+from src.cache.limiter import chat_limiter, embed_limiter, percentile
+from src.cache.memory_cache import MISSING
+from src.cache.ollama_clients import get_native_embed_model, get_native_llm
+from src.cache.retry import acall_with_retry, call_with_retry, retry_stats_str
 
 
 logger = logging.getLogger(__name__)
 
+# native models of the first endpoint, used for the cache keys, and of each endpoint
 global_native_llm = None
 global_native_embed_model = None
+global_native_embed_models = {}
+global_embed_endpoints = None
+
+# llm of each tier, and llm of the current call
+DEFAULT_LLM_TIER = "large"
+global_llm_backends: Dict[str, "LLMBackend"] = {}
+global_current_llm_backend = contextvars.ContextVar("current_llm_backend", default=None)
 
 global_nb_llm_calls = 0
 global_nb_embed_calls = 0
@@ -22,49 +44,236 @@ global_nb_embed_calls = 0
 global_nb_llm_calls_cache_miss = 0
 global_nb_embed_calls_cache_miss = 0
 
-global_max_nb_llm_calls = None
+# the llm budgets are per tier, in LLMBackend
 global_max_nb_embed_calls = None
-
-global_max_nb_llm_calls_cache_miss = None
 global_max_nb_embed_calls_cache_miss = None
 
 
+LLM_CACHED_FUNCTIONS = [
+    f"{__name__}_chat_with_cache",
+    f"{__name__}_achat_with_cache",
+    f"{__name__}_predict_with_cache",
+]
+EMBED_CACHED_FUNCTIONS = [
+    f"{__name__}__get_text_embeddings_with_cache",
+]
+
+
+class LLMBackend:
+    """Native llms of a tier on each endpoint, with the statistics and the call budget of the tier."""
+
+    def __init__(self, tier: str, model: str, kwargs: dict, base_urls: List[str], max_nb_calls: int=None, max_nb_calls_cache_miss: int=None):
+        self.tier = tier
+        self.model = model
+        self.native_llms = {url: get_native_llm(model=model, base_url=url, kwargs=kwargs) for url in base_urls}
+        # the cache keys use the parameters of the first endpoint model
+        self.native_llm = self.native_llms[base_urls[0]]
+        self.endpoints = get_endpoint_pool("llm", base_urls)
+        self.max_nb_calls = max_nb_calls
+        self.max_nb_calls_cache_miss = max_nb_calls_cache_miss
+        self.nb_calls = 0
+        self.nb_calls_cache_miss = 0
+        self.latencies = deque(maxlen=1000)
+
+    def continue_from(self, previous: "LLMBackend") -> None:
+        """Keep the counts of the former backend of the tier, replaced when `set_api_key` runs again."""
+        self.nb_calls = previous.nb_calls
+        self.nb_calls_cache_miss = previous.nb_calls_cache_miss
+        self.latencies = previous.latencies
+
+    def stats_str(self) -> str:
+        latency_str = ""
+        if self.latencies:
+            mean_latency = sum(self.latencies) / len(self.latencies)
+            latency_str = f", latency mean:{mean_latency:.2f}s p95:{percentile(self.latencies, 95):.2f}s"
+        return f"{self.tier} ({self.model}) [calls:{self.nb_calls}, missed:{self.nb_calls_cache_miss}{latency_str}]"
+
+
+def current_llm_backend() -> LLMBackend:
+    """Backend of the LLMWrapper making the current call, the default tier otherwise."""
+    backend = global_current_llm_backend.get()
+    if backend is None:
+        backend = global_llm_backends.get(DEFAULT_LLM_TIER) or next(iter(global_llm_backends.values()))
+    return backend
+
+
 def wrapper_stats_str():
-    def call_stats_str(nb_calls, nb_calls_cache_miss):
+    def call_stats_str(nb_calls, nb_calls_cache_miss, cache_stats):
         nb_cached = nb_calls - nb_calls_cache_miss
         pc_cached = nb_cached / nb_calls * 100 if nb_calls > 0 else 0
-        return f"calls:{nb_calls}, missed:{nb_calls_cache_miss}, cached:{nb_cached}({pc_cached:.0f}%)"
-    llm_str = call_stats_str(global_nb_llm_calls, global_nb_llm_calls_cache_miss)
-    embed_str = call_stats_str(global_nb_embed_calls, global_nb_embed_calls_cache_miss)
-    return f"LLM: {llm_str}, Embedding: {embed_str}"
+        tiers_str = f"memory:{cache_stats['memory_hits']}, disk:{cache_stats['disk_hits']}, coalesced:{cache_stats['coalesced']}"
+        return f"calls:{nb_calls}, missed:{nb_calls_cache_miss}, cached:{nb_cached}({pc_cached:.0f}%) [{tiers_str}]"
+    llm_str = call_stats_str(global_nb_llm_calls, global_nb_llm_calls_cache_miss, get_cache_stats(LLM_CACHED_FUNCTIONS))
+    embed_str = call_stats_str(global_nb_embed_calls, global_nb_embed_calls_cache_miss, get_cache_stats(EMBED_CACHED_FUNCTIONS))
+    if global_native_embed_model is not None and not DISABLE_CACHE:
+        embed_str += f", Embedding texts: {get_vector_cache(embeddings_model_key()).stats_str()}"
+    llm_str += f", {retry_stats_str(['chat', 'achat', 'predict'])}"
+    embed_str += f", {retry_stats_str(['embed'])}"
+    if len(global_llm_backends) > 1:
+        llm_str += f", Tiers: {', '.join(backend.stats_str() for backend in global_llm_backends.values())}"
+    limiters_str = f"Chat pool: {chat_limiter.stats_str()}, Embed pool: {embed_limiter.stats_str()}"
+    if global_llm_backends and len(current_llm_backend().endpoints.endpoints) > 1:
+        limiters_str += f", LLM endpoints: {current_llm_backend().endpoints.stats_str()}"
+    if global_embed_endpoints is not None and len(global_embed_endpoints.endpoints) > 1:
+        limiters_str += f", Embed endpoints: {global_embed_endpoints.stats_str()}"
+    return f"LLM: {llm_str}, Embedding: {embed_str}, Memory cache: {global_memory_cache.stats_str()}, {limiters_str}"
+
+
+# cache keys
+register_canonical(ChatMessage, lambda message: (message.role.value, message.content, message.additional_kwargs))
+register_canonical(BasePromptTemplate, lambda prompt: (prompt.get_template(), prompt.kwargs, prompt.template_var_mappings))
+
+
+# cache values
+# keys of the raw ollama response kept in the cache, used to count tokens
+CACHED_RAW_KEYS = ["model", "done_reason", "prompt_eval_count", "eval_count", "usage"]
+
+
+def chat_response_to_json(response: ChatResponse) -> dict:
+    raw = response.raw if isinstance(response.raw, dict) else {}
+    return {
+        "role": response.message.role.value,
+        "content": response.message.content,
+        "additional_kwargs": response.message.additional_kwargs,
+        "raw": {key: raw[key] for key in CACHED_RAW_KEYS if key in raw},
+        "response_additional_kwargs": response.additional_kwargs,
+    }
+
+
+def chat_response_from_json(value: dict) -> ChatResponse:
+    return ChatResponse(
+        message=ChatMessage(role=value["role"], content=value["content"], additional_kwargs=value["additional_kwargs"]),
+        raw=value["raw"] or None,
+        additional_kwargs=value["response_additional_kwargs"],
+    )
+
+
+register_json_kind("chat_response", ChatResponse, chat_response_to_json, chat_response_from_json)
+
+
+def llm_key_context(llm: Ollama) -> dict:
+    """Model name and generation parameters of an llm, part of the cache keys."""
+    return {
+        "model": llm.model,
+        "temperature": llm.temperature,
+        "context_window": llm.context_window,
+        "json_mode": llm.json_mode,
+        "additional_kwargs": llm.additional_kwargs,
+    }
+
+
+def prompt_ledger_fields(prompt: BasePromptTemplate) -> dict:
+    """Id and beginning of a prompt template, for the ledger of the calls."""
+    template = prompt.get_template()
+    return {"prompt_id": canonical_hash(template)[:12], "prompt": " ".join(template.split())[:80]}
+
+
+def chat_cache_key(messages: List[ChatMessage]):
+    return llm_key_context(current_llm_backend().native_llm), messages
+
+
+def predict_cache_key(prompt: BasePromptTemplate, **prompt_args: Any):
+    # the rendered messages, as sent to the model
+    native_llm = current_llm_backend().native_llm
+    return llm_key_context(native_llm), prompt.format_messages(llm=native_llm, **prompt_args)
+
+
+def embeddings_model_key() -> dict:
+    """Model name and parameters of the embedding model, part of the cache keys."""
+    return {
+        "model": global_native_embed_model.model_name,
+        "additional_kwargs": global_native_embed_model.ollama_additional_kwargs,
+    }
+
+
+def embeddings_cache_key(texts: List[str]):
+    return embeddings_model_key(), texts
+
+
+# the legacy keys do not hold the model, the legacy entries were written by the former default models
+LEGACY_LLM_MODEL = "Qwen2.5-14B-Instruct-IQ4_XS"
+LEGACY_LLM_KWARGS = {"temperature": 0}
+LEGACY_EMBED_MODEL_KEY = {"model": "mxbai-embed-large:latest", "additional_kwargs": {"mirostat": 0}}
+
+
+@functools.lru_cache(maxsize=None)
+def legacy_llm_key_context() -> dict:
+    return llm_key_context(Ollama(model=LEGACY_LLM_MODEL, kwargs=LEGACY_LLM_KWARGS))
+
+
+def use_legacy_llm_cache(*args, **kwargs) -> bool:
+    """Whether the current llm is the one of the legacy entries, which can then be reused."""
+    return llm_key_context(current_llm_backend().native_llm) == legacy_llm_key_context()
+
+
+def use_legacy_embeddings_cache(*args, **kwargs) -> bool:
+    """Whether the embedding model is the one of the legacy entries, which can then be reused."""
+    return embeddings_model_key() == LEGACY_EMBED_MODEL_KEY
+
+
+# native calls, each attempt takes a slot of the pool and goes to an endpoint, a retry can go to another one
+@contextmanager
+def record_llm_call(backend: LLMBackend):
+    backend.nb_calls_cache_miss += 1
+    start_time = time.monotonic()
+    yield
+    backend.latencies.append(time.monotonic() - start_time)
+
+def native_chat(messages: List[ChatMessage]) -> ChatResponse:
+    backend = current_llm_backend()
+    def call():
+        with chat_limiter.slot():
+            return backend.endpoints.call(lambda url: backend.native_llms[url].chat(messages))
+    with record_llm_call(backend):
+        return call_with_retry("chat", call)
+
+async def native_achat(messages: List[ChatMessage]) -> ChatResponse:
+    backend = current_llm_backend()
+    async def call():
+        async with chat_limiter.aslot():
+            return await backend.endpoints.acall(lambda url: backend.native_llms[url].achat(messages))
+    with record_llm_call(backend):
+        return await acall_with_retry("achat", call)
+
+def native_predict(prompt: BasePromptTemplate, **prompt_args: Any) -> str:
+    backend = current_llm_backend()
+    def call():
+        with chat_limiter.slot():
+            return backend.endpoints.call(lambda url: backend.native_llms[url].predict(prompt, **prompt_args))
+    with record_llm_call(backend):
+        return call_with_retry("predict", call)
+
+def native_embeddings(texts: List[str]) -> List[List[float]]:
+    # embeddings are fast and regular, they are retried but not hedged
+    def call():
+        with embed_limiter.slot():
+            return global_embed_endpoints.call(lambda url: global_native_embed_models[url]._get_text_embeddings(texts))
+    return call_with_retry("embed", call, hedge=False)
 
 
 # llm cache call
-@file_cache(verbose=True)
+@file_cache(verbose=True, key_func=chat_cache_key, legacy_source_hash="8eb7d743d2b9066b6de773abc1c61bc7", use_legacy=use_legacy_llm_cache)
 def chat_with_cache(messages: List[ChatMessage]) -> ChatResponse:
-    global global_native_llm
     global global_nb_llm_calls_cache_miss
     global_nb_llm_calls_cache_miss += 1
-    result = global_native_llm.chat(messages)
+    result = native_chat(messages)
     return result
 
-@afile_cache(verbose=True)
+@afile_cache(verbose=True, key_func=chat_cache_key, legacy_source_hash="f6a0203e9f3cdf0b9c2c0bf65bf6abbf", use_legacy=use_legacy_llm_cache)
 async def achat_with_cache(messages: List[ChatMessage]) -> ChatResponse:
-    global global_native_llm
     global global_nb_llm_calls_cache_miss
     global_nb_llm_calls_cache_miss += 1
-    result = await global_native_llm.achat(messages)
+    result = await native_achat(messages)
     return result
 
-@file_cache(verbose=True)
+@file_cache(verbose=True, key_func=predict_cache_key, legacy_source_hash="de680d0d74f9c63cd59f4586cd1876ec", use_legacy=use_legacy_llm_cache)
 def predict_with_cache(
     prompt: BasePromptTemplate,
     **prompt_args: Any,
 ) -> str:
-    global global_native_llm
     global global_nb_llm_calls_cache_miss
     global_nb_llm_calls_cache_miss += 1
-    result = global_native_llm.predict(prompt, **prompt_args)
+    result = native_predict(prompt, **prompt_args)
     return result
 
 # llm cache class
@@ -74,60 +283,120 @@ class LLMWrapper(Ollama):
     max_nb_calls: int = Field(default=None)
     max_nb_calls_cache_miss: int = Field(default=None)
 
-    def __init__(self, model: str, max_nb_calls: int=None, max_nb_calls_cache_miss: int=None, kwargs: dict=None):
-        super().__init__(model=model, base_url="https://chat.darwin-x.com", kwargs=kwargs)
-        global global_native_llm
-        global_native_llm = Ollama(model=model, base_url="https://chat.darwin-x.com", kwargs=kwargs)
-        global global_max_nb_llm_calls
-        global_max_nb_llm_calls = max_nb_calls
-        global global_max_nb_llm_calls_cache_miss
-        global_max_nb_llm_calls_cache_miss = max_nb_calls_cache_miss
+    _backend: LLMBackend = PrivateAttr()
+
+    def __init__(self, model: str, max_nb_calls: int=None, max_nb_calls_cache_miss: int=None, kwargs: dict=None, base_urls: List[str]=None, tier: str=DEFAULT_LLM_TIER):
+        base_urls = base_urls or OLLAMA_BASE_URLS
+        super().__init__(model=model, base_url=base_urls[0], kwargs=kwargs)
+        self._backend = LLMBackend(tier, model, kwargs, base_urls, max_nb_calls, max_nb_calls_cache_miss)
+        if tier in global_llm_backends:
+            self._backend.continue_from(global_llm_backends[tier])
+        global_llm_backends[tier] = self._backend
+        if tier == DEFAULT_LLM_TIER:
+            global global_native_llm
+            global_native_llm = self._backend.native_llm
+
+    @contextmanager
+    def _use_backend(self):
+        # the cached calls get the native llm of this tier from the context
+        token = global_current_llm_backend.set(self._backend)
+        try:
+            yield
+        finally:
+            global_current_llm_backend.reset(token)
 
     def _update_and_check_nb_calls(self) -> bool:
         global global_nb_llm_calls
         global_nb_llm_calls += 1
+        backend = self._backend
+        backend.nb_calls += 1
 
-        global global_max_nb_llm_calls
-        if global_max_nb_llm_calls is not None and global_nb_llm_calls > global_max_nb_llm_calls:
-            error_msg = f"Maximum number of calls to the LLM reached: {global_max_nb_llm_calls}"
+        if backend.max_nb_calls is not None and backend.nb_calls > backend.max_nb_calls:
+            error_msg = f"Maximum number of calls to the {backend.tier} LLM reached: {backend.max_nb_calls}"
             logger.error(error_msg)
             raise Exception(error_msg)
-        
-        global global_nb_llm_calls_cache_miss
-        global global_max_nb_llm_calls_cache_miss
-        if global_max_nb_llm_calls_cache_miss is not None and global_nb_llm_calls_cache_miss > global_max_nb_llm_calls_cache_miss:
-            error_msg = f"Maximum number of calls cache miss to the LLM reached: {global_max_nb_llm_calls_cache_miss}"
+
+        if backend.max_nb_calls_cache_miss is not None and backend.nb_calls_cache_miss > backend.max_nb_calls_cache_miss:
+            error_msg = f"Maximum number of calls cache miss to the {backend.tier} LLM reached: {backend.max_nb_calls_cache_miss}"
             logger.error(error_msg)
             raise Exception(error_msg)
 
+    def _ledger_fields(self) -> dict:
+        return {"tier": self._backend.tier, "model": self._backend.model}
+
     def chat(
         self, messages: List[ChatMessage]
     ) -> ChatResponse:
-        self._update_and_check_nb_calls()
-        return chat_with_cache(messages)
+        with ledger.record_call("chat", **self._ledger_fields()):
+            self._update_and_check_nb_calls()
+            with self._use_backend():
+                response = chat_with_cache(messages)
+            ledger.note_tokens(response.raw)
+            return response
     
     async def achat(
         self, messages: List[ChatMessage]
     ) -> ChatResponse:
-        self._update_and_check_nb_calls()
-        return await achat_with_cache(messages)
+        with ledger.record_call("chat", **self._ledger_fields()):
+            self._update_and_check_nb_calls()
+            with self._use_backend():
+                response = await achat_with_cache(messages)
+            ledger.note_tokens(response.raw)
+            return response
     
     def predict(
         self,
         prompt: BasePromptTemplate,
         **prompt_args: Any,
     ) -> str:
-        self._update_and_check_nb_calls()
-        return predict_with_cache(prompt, **prompt_args)
+        with ledger.record_call("predict", **self._ledger_fields(), **prompt_ledger_fields(prompt)):
+            self._update_and_check_nb_calls()
+            with self._use_backend():
+                return predict_with_cache(prompt, **prompt_args)
+
+    async def apredict(
+        self,
+        prompt: BasePromptTemplate,
+        **prompt_args: Any,
+    ) -> str:
+        # the base apredict calls achat, which shares this record
+        with ledger.record_call("predict", **self._ledger_fields(), **prompt_ledger_fields(prompt)):
+            return await super().apredict(prompt, **prompt_args)
 
 
-# embedding cache call
-@file_cache(verbose=True)
+# embedding cache call, per batch of texts
+# new embeddings are cached per text, this cache is only read to reuse the embeddings cached per batch
+@file_cache(verbose=True, key_func=embeddings_cache_key, legacy_source_hash="0a331ff0de321c3cbd7994861048844a", use_legacy=use_legacy_embeddings_cache)
 def _get_text_embeddings_with_cache(texts: List[str]) -> List[List[float]]:
-    global global_native_embed_model
     global global_nb_embed_calls_cache_miss
     global_nb_embed_calls_cache_miss += 1
-    return global_native_embed_model._get_text_embeddings(texts)
+    return native_embeddings(texts)
+
+# embedding cache call, per text
+def _get_text_embeddings_with_vector_cache(texts: List[str]) -> List[List[float]]:
+    global global_nb_embed_calls_cache_miss
+    if DISABLE_CACHE:
+        return _get_text_embeddings_with_cache(texts)
+
+    vector_cache = get_vector_cache(embeddings_model_key())
+    embeddings = vector_cache.get_many(texts)
+    missing_positions = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing_positions:
+        ledger.note(cache="vector")
+        return embeddings
+
+    # only the texts never embedded are sent to the embedding model
+    missing_texts = [texts[i] for i in missing_positions]
+    missing_embeddings = _get_text_embeddings_with_cache.get_cached(missing_texts)
+    ledger.note(missing_texts=len(missing_texts))
+    if missing_embeddings is MISSING:
+        ledger.note(cache="miss")
+        global_nb_embed_calls_cache_miss += 1
+        missing_embeddings = native_embeddings(missing_texts)
+    missing_embeddings = vector_cache.put_many(missing_texts, missing_embeddings)
+    for i, embedding in zip(missing_positions, missing_embeddings):
+        embeddings[i] = embedding
+    return embeddings
 
 # embedding cache class
 class EmbeddingWrapper(OllamaEmbedding):
@@ -136,10 +405,16 @@ class EmbeddingWrapper(OllamaEmbedding):
     max_nb_calls: int = Field(default=None)
     max_nb_calls_cache_miss: int = Field(default=None)
 
-    def __init__(self, model: str, max_nb_calls: int=None, max_nb_calls_cache_miss: int=None, kwargs: dict=None):
-        super().__init__(model_name=model, base_url="https://chat.darwin-x.com", ollama_additional_kwargs={"mirostat": 0}, kwargs=kwargs)
-        global global_native_embed_model
-        global_native_embed_model = OllamaEmbedding(model_name=model, base_url="https://chat.darwin-x.com", ollama_additional_kwargs={"mirostat": 0},kwargs=kwargs)
+    def __init__(self, model: str, max_nb_calls: int=None, max_nb_calls_cache_miss: int=None, kwargs: dict=None, base_urls: List[str]=None):
+        base_urls = base_urls or OLLAMA_BASE_URLS
+        super().__init__(model_name=model, base_url=base_urls[0], ollama_additional_kwargs={"mirostat": 0}, kwargs=kwargs)
+        global global_native_embed_model, global_native_embed_models, global_embed_endpoints
+        global_native_embed_models = {
+            url: get_native_embed_model(model=model, base_url=url, ollama_additional_kwargs={"mirostat": 0}, kwargs=kwargs)
+            for url in base_urls
+        }
+        global_native_embed_model = global_native_embed_models[base_urls[0]]
+        global_embed_endpoints = get_endpoint_pool("embed", base_urls)
         # truncate to the end of chunks if needed to avoid context window exceptions raised by the embedding model
         # global_native_embed_model.truncate = "END"
         global global_max_nb_embed_calls
@@ -169,5 +444,17 @@ class EmbeddingWrapper(OllamaEmbedding):
         # for text in texts:
         #     print('text:')
         #     print(text)
-        self._update_and_check_nb_calls()
-        return _get_text_embeddings_with_cache(texts)
+        with ledger.record_call("embed", model=self.model_name, texts=len(texts), chars=sum(len(text) for text in texts)):
+            self._update_and_check_nb_calls()
+            return _get_text_embeddings_with_vector_cache(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # a single batch through the pools, the thread gets a copy of the context for the ledger
+        return await asyncio.to_thread(self._get_text_embeddings, texts)
+
+    # query embeddings and single texts, instead of the client of the base class
+    def get_general_text_embedding(self, texts: str) -> List[float]:
+        return self._get_text_embeddings([texts])[0]
+
+    async def aget_general_text_embedding(self, prompt: str) -> List[float]:
+        return (await self._aget_text_embeddings([prompt]))[0]
@@ -1,9 +1,13 @@
 import asyncio
+import contextvars
+import heapq
 import logging
-import random
-from typing import Any, List, Optional, Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
+import numpy as np
 from llama_index.core.async_utils import run_async_tasks
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.core.callbacks.base import CallbackManager
 from llama_index.core.indices.prompt_helper import PromptHelper
 from llama_index.core.llms import LLM
@@ -43,14 +47,70 @@ from llama_index.core.schema import (
 )
 import llama_index.core.instrumentation as instrument
 
+from src.document.ids import summary_id
+
 dispatcher = instrument.get_dispatcher(__name__)
 
 logger = logging.getLogger(__name__)
 
-def take_random_max_chunks(node_chunks: Sequence[NodeWithScore], use_max_chunks: Optional[int]):
-    if use_max_chunks is not None:
-        return random.sample(node_chunks, min(use_max_chunks, len(node_chunks)))
-    return node_chunks
+# weight of the relevance to the whole document against the redundancy with the chunks already selected
+DEFAULT_MMR_LAMBDA = 0.5
+
+
+def evenly_spaced_positions(nb_chunks: int, max_chunks: int) -> List[int]:
+    return sorted(set(int(round(i)) for i in np.linspace(0, nb_chunks - 1, max_chunks)))
+
+
+def select_representative_chunks(
+    node_chunks: Sequence[NodeWithScore],
+    use_max_chunks: Optional[int],
+    embed_model: Optional[BaseEmbedding] = None,
+    mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+) -> List[NodeWithScore]:
+    """At most `use_max_chunks` chunks covering the document, in their order, the same on every run.
+
+    The first and the last chunks are always kept, the others are picked by maximal marginal
+    relevance on the chunk embeddings: close to the mean of the document and far from the chunks
+    already picked. Without embedding model, the chunks are evenly spaced.
+    """
+    if use_max_chunks is None or len(node_chunks) <= use_max_chunks:
+        return list(node_chunks)
+    if embed_model is None or use_max_chunks <= 2:
+        return [node_chunks[i] for i in evenly_spaced_positions(len(node_chunks), use_max_chunks)]
+
+    # same texts as the chunk embeddings of the vector index, so that they come from the cache
+    texts = [n.node.get_content(metadata_mode=MetadataMode.EMBED) for n in node_chunks]
+    embeddings = np.array(embed_model.get_text_embedding_batch(texts), dtype=np.float64)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.where(norms > 0, norms, 1.0)
+    centroid = embeddings.mean(axis=0)
+    relevance = embeddings @ (centroid / (np.linalg.norm(centroid) or 1.0))
+    similarity = embeddings @ embeddings.T
+
+    selected = [0, len(node_chunks) - 1]
+    while len(selected) < use_max_chunks:
+        candidates = [i for i in range(len(node_chunks)) if i not in selected]
+        scores = mmr_lambda * relevance[candidates] - (1 - mmr_lambda) * similarity[candidates][:, selected].max(axis=1)
+        # argmax takes the first of equal scores, the earliest chunk
+        selected.append(candidates[int(np.argmax(scores))])
+    return [node_chunks[i] for i in sorted(selected)]
+
+
+class DocumentCascade:
+    """State of the cascade of a document in `CascadeSummarize.synthesize_documents`: its current level."""
+
+    def __init__(self, index: int, query: QueryBundle) -> None:
+        self.index = index
+        self.query = query
+        self.summary_template: Optional[BasePromptTemplate] = None
+        self.text_chunks: List[str] = []
+        self.summary_node_chunks: List[NodeWithScore] = []
+        self.additional_source_nodes: Optional[List[NodeWithScore]] = None
+        self.summaries: List[Any] = []
+        self.pending = 0
+        # own copy of the context of the caller, so that the callback events of the documents do not interleave
+        self.context = contextvars.copy_context()
+        self.event_id: Optional[str] = None
 
 
 class CascadeSummarize(TreeSummarize):
@@ -73,6 +133,9 @@ class CascadeSummarize(TreeSummarize):
     use_max_chunks: Optional[int] = Field(
         default=None, description="The maximum number of chunks to use for the summary. All if None."
     )
+    mmr_lambda: float = Field(
+        default=DEFAULT_MMR_LAMBDA, description="Relevance against diversity of the chunks selected with the embeddings."
+    )
 
     def __init__(
         self,
@@ -85,6 +148,8 @@ class CascadeSummarize(TreeSummarize):
         use_async: bool = False,
         verbose: bool = False,
         use_max_chunks: int = None,
+        embed_model: Optional[BaseEmbedding] = None,
+        mmr_lambda: float = DEFAULT_MMR_LAMBDA,
     ) -> None:
         super().__init__(
             llm=llm,
@@ -97,21 +162,29 @@ class CascadeSummarize(TreeSummarize):
             verbose=verbose,
         )
         self.use_max_chunks = use_max_chunks
+        self.mmr_lambda = mmr_lambda
+        self._embed_model = embed_model
 
-    def get_response_for_nodes(
+    @property
+    def chunk_selection(self) -> str:
+        """How the chunks are selected when a level has more than `use_max_chunks` of them."""
+        if self._embed_model is None:
+            return "evenly_spaced"
+        return f"mmr:{self.mmr_lambda}:{self._embed_model.model_name}"
+
+    def _prepare_level(
         self,
         query_str: str,
         node_chunks: Sequence[NodeWithScore],
         additional_source_nodes: Optional[Sequence[NodeWithScore]] = None,
-        **response_kwargs: Any,
-    ) -> RESPONSE_TEXT_TYPE:
-        """Get tree summarize response."""
+    ) -> Tuple[BasePromptTemplate, List[str], List[NodeWithScore], List[NodeWithScore]]:
+        """Prompt, repacked text chunks and empty summary nodes of a level of the cascade."""
         summary_template = self._summary_template.partial_format(query_str=query_str)
 
         # repack text_chunks so that each chunk fills the context window
         text_chunks=[
             n.node.get_content(metadata_mode=MetadataMode.LLM) 
-            for n in take_random_max_chunks(node_chunks, self.use_max_chunks)
+            for n in select_representative_chunks(node_chunks, self.use_max_chunks, self._embed_model, self.mmr_lambda)
         ]
         logger.info(f"repacking {len(text_chunks)} chunks")
         text_chunks = self._prompt_helper.repack(
@@ -122,10 +195,13 @@ class CascadeSummarize(TreeSummarize):
         # if no additional source nodes from previous recursive calls, no need to keep track of the children
         summary_children = [n.id_ for n in node_chunks] if additional_source_nodes is not None else []
 
-        # create new nodes with relationships to the original nodes
+        # create new nodes with relationships to the original nodes,
+        # with IDs derived from the summarized nodes to be the same from one run to another
+        node_chunks_ids = [n.id_ for n in node_chunks]
         summary_node_chunks = [
             NodeWithScore(
                 node=TextNode(
+                    id_=summary_id(node_chunks_ids, i),
                     text="", 
                     metadata={
                         'summary_children': summary_children,
@@ -134,7 +210,7 @@ class CascadeSummarize(TreeSummarize):
                     excluded_embed_metadata_keys=['summary_children'],
                 ),
                 score=1.0
-            ) for text_chunk in text_chunks
+            ) for i, text_chunk in enumerate(text_chunks)
         ]
 
         if additional_source_nodes is None:
@@ -142,6 +218,39 @@ class CascadeSummarize(TreeSummarize):
         else:
             additional_source_nodes.extend(node_chunks)
 
+        return summary_template, text_chunks, summary_node_chunks, additional_source_nodes
+
+    def _predict(self, summary_template: BasePromptTemplate, text_chunk: str, **response_kwargs: Any) -> Any:
+        if self._output_cls is None:
+            return self._llm.predict(summary_template, context_str=text_chunk, **response_kwargs)
+        return self._llm.structured_predict(  # type: ignore
+            self._output_cls, summary_template, context_str=text_chunk, **response_kwargs
+        )
+
+    @staticmethod
+    def _link_summaries(summary_node_chunks: List[NodeWithScore], summaries: Sequence[str]) -> None:
+        """Set the texts of the summary nodes of a level and chain them."""
+        for i, summary in enumerate(summaries):
+            summary_node_chunks[i].node.text = summary
+            if i > 0:
+                prev_node = RelatedNodeInfo(node_id=summary_node_chunks[i-1].node.id_)
+                summary_node_chunks[i].node.relationships[NodeRelationship.PREVIOUS] = prev_node
+            if i < len(summaries) - 1:
+                next_node = RelatedNodeInfo(node_id=summary_node_chunks[i+1].node.id_)
+                summary_node_chunks[i].node.relationships[NodeRelationship.NEXT] = next_node
+
+    def get_response_for_nodes(
+        self,
+        query_str: str,
+        node_chunks: Sequence[NodeWithScore],
+        additional_source_nodes: Optional[Sequence[NodeWithScore]] = None,
+        **response_kwargs: Any,
+    ) -> RESPONSE_TEXT_TYPE:
+        """Get tree summarize response."""
+        summary_template, text_chunks, summary_node_chunks, additional_source_nodes = self._prepare_level(
+            query_str, node_chunks, additional_source_nodes
+        )
+
         if self._verbose:
             logger.info(f"{len(text_chunks)} text chunks after repacking")
 
@@ -225,14 +334,7 @@ class CascadeSummarize(TreeSummarize):
                     ]
                     summaries = [summary.model_dump_json() for summary in summaries]
 
-            for i, summary in enumerate(summaries):
-                summary_node_chunks[i].node.text = summary
-                if i > 0:
-                    prev_node = RelatedNodeInfo(node_id=summary_node_chunks[i-1].node.id_)
-                    summary_node_chunks[i].node.relationships[NodeRelationship.PREVIOUS] = prev_node
-                if i < len(summaries) - 1:
-                    next_node = RelatedNodeInfo(node_id=summary_node_chunks[i+1].node.id_)
-                    summary_node_chunks[i].node.relationships[NodeRelationship.NEXT] = next_node
+            self._link_summaries(summary_node_chunks, summaries)
 
             # recursively summarize the summaries
             return self.get_response_for_nodes(
@@ -304,3 +406,104 @@ class CascadeSummarize(TreeSummarize):
         
 
         return response
+
+    def synthesize_documents(
+        self,
+        query: QueryType,
+        documents: Sequence[List[NodeWithScore]],
+        num_workers: int,
+        **response_kwargs: Any,
+    ) -> Iterator[RESPONSE_TYPE]:
+        """Summaries of several documents, in their order, as `synthesize` does for each one.
+
+        The summary calls of all the levels of all the documents go through a single queue
+        served by `num_workers` threads: a document starts its next level as soon as its
+        current level is done, without waiting for the other documents, and the calls of
+        the first documents go first so that their responses come as early as possible.
+        """
+        if isinstance(query, str):
+            query = QueryBundle(query_str=query)
+        if self._streaming or self._use_async:
+            for nodes in documents:
+                yield self.synthesize(query, nodes, **response_kwargs)
+            return
+
+        responses: Dict[int, RESPONSE_TYPE] = {}
+        # pending summary calls, by document then chunk
+        queue: List[Tuple[int, int, DocumentCascade]] = []
+
+        def end_document(cascade: DocumentCascade, response: RESPONSE_TYPE) -> None:
+            cascade.context.run(
+                self._callback_manager.on_event_end,
+                CBEventType.SYNTHESIZE, payload={EventPayload.RESPONSE: response}, event_id=cascade.event_id,
+            )
+            dispatcher.event(SynthesizeEndEvent(query=cascade.query, response=response))
+            responses[cascade.index] = response
+
+        def start_level(cascade: DocumentCascade, node_chunks: Sequence[NodeWithScore]) -> None:
+            cascade.summary_template, cascade.text_chunks, cascade.summary_node_chunks, cascade.additional_source_nodes = (
+                self._prepare_level(cascade.query.query_str, node_chunks, cascade.additional_source_nodes)
+            )
+            if len(cascade.text_chunks) == 0:
+                # nothing left to summarize once repacked, no call would ever end the level
+                end_document(cascade, Response("Empty Response"))
+                return
+            cascade.summaries = [None] * len(cascade.text_chunks)
+            cascade.pending = len(cascade.text_chunks)
+            for i in range(len(cascade.text_chunks)):
+                heapq.heappush(queue, (cascade.index, i, cascade))
+
+        def end_level(cascade: DocumentCascade) -> None:
+            if len(cascade.text_chunks) == 1:
+                # final response, as in get_response_for_nodes
+                response_str = cascade.summaries[0]
+                cascade.summary_node_chunks[0].node.text = response_str
+                source_nodes = cascade.summary_node_chunks + cascade.additional_source_nodes
+                end_document(cascade, self._prepare_response_output(response_str, source_nodes))
+                return
+            summaries = cascade.summaries
+            if self._output_cls is not None:
+                summaries = [summary.model_dump_json() for summary in summaries]
+            self._link_summaries(cascade.summary_node_chunks, summaries)
+            start_level(cascade, cascade.summary_node_chunks)
+
+        for index, nodes in enumerate(documents):
+            cascade = DocumentCascade(index, query)
+            dispatcher.event(SynthesizeStartEvent(query=query))
+            if len(nodes) == 0:
+                responses[index] = Response("Empty Response")
+                dispatcher.event(SynthesizeEndEvent(query=query, response=responses[index]))
+            else:
+                cascade.event_id = cascade.context.run(
+                    self._callback_manager.on_event_start,
+                    CBEventType.SYNTHESIZE, payload={EventPayload.QUERY_STR: query.query_str},
+                )
+                start_level(cascade, nodes)
+
+        executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="cascade_summarize")
+        running = {}
+        next_index = 0
+        try:
+            while next_index < len(documents):
+                while queue and len(running) < num_workers:
+                    _, i, cascade = heapq.heappop(queue)
+                    # each call gets a copy of the context of its document, for the ledger step and the LLM tier
+                    # of the caller and the parent callback event
+                    future = executor.submit(
+                        cascade.context.copy().run,
+                        self._predict, cascade.summary_template, cascade.text_chunks[i], **response_kwargs,
+                    )
+                    running[future] = (cascade, i)
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        cascade, i = running.pop(future)
+                        cascade.summaries[i] = future.result()
+                        cascade.pending -= 1
+                        if cascade.pending == 0:
+                            end_level(cascade)
+                while next_index in responses:
+                    yield responses.pop(next_index)
+                    next_index += 1
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
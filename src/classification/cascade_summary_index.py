@@ -7,18 +7,24 @@ This summary can be used for retrieval.
 
 """
 
+import contextvars
+import json
 import logging
+import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import re
-from typing import Any, Dict, List, Optional, Sequence, Union, cast
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union, cast
 
+from llama_index.core.async_utils import DEFAULT_NUM_WORKERS
 from llama_index.core.base.base_retriever import BaseRetriever
 from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.core.base.response.schema import Response
 from llama_index.core.data_structs.document_summary import IndexDocumentSummary
 from llama_index.core.indices.document_summary.base import DocumentSummaryIndex
 from llama_index.core.indices.utils import embed_nodes
+from llama_index.core.ingestion import run_transformations
 from llama_index.core.llms.llm import LLM
 from llama_index.core.response_synthesizers import (
     BaseSynthesizer,
@@ -27,6 +33,7 @@ from llama_index.core.response_synthesizers import (
 )
 from llama_index.core.schema import (
     BaseNode,
+    Document,
     IndexNode,
     NodeRelationship,
     NodeWithScore,
@@ -39,11 +46,16 @@ from llama_index.core.storage.storage_context import StorageContext
 from llama_index.core.utils import get_tqdm_iterable
 from llama_index.core.vector_stores.types import BasePydanticVectorStore
 
+from src.classification.cascade_summarize import CascadeSummarize
+from src.document.ids import content_hash
 from src.run.utils import add_custom_metadata, copy_metadata_from_node
 
 logger = logging.getLogger(__name__)
 
 
+# documents of a persisted index: content hash, summary ID and IDs of all their nodes
+MANIFEST_FILE = "manifest.json"
+
 DEFAULT_SUMMARY_QUERY = (
     "Describe what the provided text is about. "
     "Also describe some of the questions that this text can answer. "
@@ -74,6 +86,7 @@ class CascadeSummaryIndex(DocumentSummaryIndex):
 
     Args:
         same as DocumentSummaryIndex
+        num_workers: number of summary calls at the same time
 
     """
 
@@ -89,9 +102,14 @@ class CascadeSummaryIndex(DocumentSummaryIndex):
         summary_query: str = DEFAULT_SUMMARY_QUERY,
         show_progress: bool = False,
         embed_summaries: bool = True,
+        num_workers: int = DEFAULT_NUM_WORKERS,
         **kwargs: Any,
     ) -> None:
         """Initialize params."""
+        # set before the parent init, which builds the index
+        self._num_workers = num_workers
+        # chunks and summaries of each document, to remove them with the document
+        self._document_node_ids: Dict[str, List[str]] = {}
         super().__init__(
             nodes=nodes,
             objects=objects,
@@ -106,6 +124,41 @@ class CascadeSummaryIndex(DocumentSummaryIndex):
             **kwargs,
         )
 
+    def _summarize_document(self, nodes: Sequence[BaseNode]) -> Response:
+        nodes_with_scores = [NodeWithScore(node=n) for n in nodes]
+        return self._response_synthesizer.synthesize(
+            query=self._summary_query,
+            nodes=nodes_with_scores,
+        )
+
+    def _summarize_documents(self, items: Sequence[Tuple[str, Sequence[BaseNode]]]) -> Iterator[Response]:
+        """Summary responses of the documents, in their order, `num_workers` summary calls at once."""
+        if self._num_workers <= 1 or len(items) <= 1:
+            for _, nodes in items:
+                yield self._summarize_document(nodes)
+            return
+
+        if isinstance(self._response_synthesizer, CascadeSummarize):
+            # the levels of all the documents share a single queue of summary calls
+            yield from self._response_synthesizer.synthesize_documents(
+                query=self._summary_query,
+                documents=[[NodeWithScore(node=n) for n in nodes] for _, nodes in items],
+                num_workers=self._num_workers,
+            )
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self._num_workers, thread_name_prefix="cascade_summary")
+        # each document gets a copy of the context, for the ledger step and the LLM tier of the caller
+        futures = [
+            executor.submit(contextvars.copy_context().run, self._summarize_document, nodes)
+            for _, nodes in items
+        ]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
     def _add_nodes_to_index(
         self,
         index_struct: IndexDocumentSummary,
@@ -123,18 +176,14 @@ class CascadeSummaryIndex(DocumentSummaryIndex):
             doc_id_to_nodes[node.ref_doc_id].append(node)
 
         summary_node_dict = {}
-        items = doc_id_to_nodes.items()
+        items = list(doc_id_to_nodes.items())
         iterable_with_progress = get_tqdm_iterable(
             items, show_progress, "Summarizing documents"
         )
 
-        for doc_id, nodes in iterable_with_progress:
-            nodes_with_scores = [NodeWithScore(node=n) for n in nodes]
-            # get the summary for each doc_id
-            summary_response = self._response_synthesizer.synthesize(
-                query=self._summary_query,
-                nodes=nodes_with_scores,
-            )
+        # the summaries are added in the order of the documents, whatever the order they are done;
+        # the progress iterator goes first so that it is exhausted, and the bar closed, at the end
+        for (doc_id, nodes), summary_response in zip(iterable_with_progress, self._summarize_documents(items)):
             summary_response = cast(Response, summary_response)
             docid_first_node = doc_id_to_nodes.get(doc_id, [TextNode()])[0]
 
@@ -154,6 +203,7 @@ class CascadeSummaryIndex(DocumentSummaryIndex):
 
             source_nodes = [n.node for n in summary_response.source_nodes]
             self.docstore.add_documents(source_nodes)
+            self._document_node_ids[doc_id] = [n.node_id for n in nodes] + [n.node_id for n in source_nodes]
             logger.info(f"> Generated root summary for doc {doc_id}: " f"{summary_response.response}")
             logger.info(f"> Generated {len(summary_response.source_nodes)-1} intermediate summaries for doc {doc_id}")
 
@@ -173,3 +223,94 @@ class CascadeSummaryIndex(DocumentSummaryIndex):
                 summary_nodes_with_embedding.append(node_with_embedding)
             self._vector_store.add(summary_nodes_with_embedding)
 
+    def _insert(self, nodes: Sequence[BaseNode], **insert_kwargs: Any) -> None:
+        self._add_nodes_to_index(self._index_struct, nodes, self._show_progress)
+
+    def settings_hash(self) -> str:
+        """Hash of what the summaries depend on besides the documents, a change invalidates all of them."""
+        settings = {
+            "summary_query": self._summary_query,
+            "transformations": [transformation.to_dict() for transformation in self._transformations],
+            "response_synthesizer": type(self._response_synthesizer).__name__,
+            "use_max_chunks": getattr(self._response_synthesizer, "use_max_chunks", None),
+            "chunk_selection": getattr(self._response_synthesizer, "chunk_selection", None),
+            "llm": getattr(self._response_synthesizer._llm, "model", None),
+        }
+        return content_hash(json.dumps(settings, sort_keys=True, default=str))
+
+    def delete_document(self, doc_id: str) -> None:
+        """Remove a document, its chunks and all its summaries."""
+        if self._embed_summaries:
+            self._vector_store.delete(doc_id)
+        self._index_struct.delete(doc_id)
+        for node_id in self._document_node_ids.pop(doc_id, []):
+            self.docstore.delete_document(node_id, raise_error=False)
+        self.docstore.delete_ref_doc(doc_id, raise_error=False)
+        # the hash of the document, left by delete_ref_doc if the document has no chunk left in the docstore,
+        # would make a document added again look unchanged
+        self.docstore.delete_document(doc_id, raise_error=False)
+        self._storage_context.index_store.add_index_struct(self._index_struct)
+
+    def refresh_documents(self, documents: Sequence[Document]) -> Tuple[List[str], List[str]]:
+        """Summarize the new and changed documents, remove the others that are not in `documents` anymore.
+
+        Returns the IDs of the summarized documents and of the removed ones.
+        """
+        doc_id_to_document = {document.id_: document for document in documents}
+        removed = [
+            doc_id for doc_id in self._index_struct.doc_id_to_summary_id
+            if doc_id not in doc_id_to_document
+            or self.docstore.get_document_hash(doc_id) != doc_id_to_document[doc_id].hash
+        ]
+        for doc_id in removed:
+            self.delete_document(doc_id)
+
+        new_documents = [
+            document for document in doc_id_to_document.values()
+            if document.id_ not in self._index_struct.doc_id_to_summary_id
+        ]
+        if len(new_documents) > 0:
+            nodes = run_transformations(new_documents, self._transformations, show_progress=self._show_progress)
+            self.insert_nodes(nodes)
+            self.docstore.set_document_hashes({document.id_: document.hash for document in new_documents})
+
+        removed = [doc_id for doc_id in removed if doc_id not in doc_id_to_document]
+        logger.info(f"refreshed summary index: {len(new_documents)} documents summarized, {len(removed)} removed, {len(documents) - len(new_documents)} unchanged")
+        return [document.id_ for document in new_documents], removed
+
+    def persist_manifest(self, persist_dir: str) -> None:
+        documents = {
+            doc_id: {
+                "hash": self.docstore.get_document_hash(doc_id),
+                "summary_id": summary_id,
+                "node_ids": self._document_node_ids.get(doc_id, []),
+            }
+            for doc_id, summary_id in self._index_struct.doc_id_to_summary_id.items()
+        }
+        with open(os.path.join(persist_dir, MANIFEST_FILE), "w") as f:
+            json.dump({"settings": self.settings_hash(), "documents": documents}, f, indent=2)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, **kwargs: Any) -> Optional["CascadeSummaryIndex"]:
+        """Index persisted with its manifest in `persist_dir`, None if there is none or if its settings changed."""
+        manifest_path = os.path.join(persist_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            logger.info(f"no summary index manifest in {persist_dir}")
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+        index_structs = [
+            index_struct for index_struct in storage_context.index_store.index_structs()
+            if isinstance(index_struct, IndexDocumentSummary)
+        ]
+        if not index_structs:
+            logger.info(f"no summary index in {persist_dir}")
+            return None
+        index = cls(index_struct=index_structs[0], storage_context=storage_context, **kwargs)
+        if manifest["settings"] != index.settings_hash():
+            logger.info(f"summary index settings changed since {manifest_path}")
+            return None
+        index._document_node_ids = {doc_id: document["node_ids"] for doc_id, document in manifest["documents"].items()}
+        return index
@@ -7,8 +7,9 @@ from llama_index.readers.web import SimpleWebPageReader
 from llama_index.core.schema import BaseNode, Document
 from duckduckgo_search import DDGS
 
+from src.document.ids import set_document_ids
 from src.document.news import get_news
-from src.document.papers import read_all_pdf_content, read_first_page_of_pdf, read_papers
+from src.document.papers import pdf_source, read_all_pdf_content, read_first_page_of_pdf, read_papers
 from src.run.utils import base_dir_for_run, load_nodes, save_nodes
 from src.document.stories import get_stories
 
@@ -36,20 +37,28 @@ def load_samples_documents(run_id: str, base_dir: str, counts: str, shuffle: boo
         data_sources[source] = size
 
     documents = []
+    sources = []
     for source, size in data_sources.items():
         if source == 'news':
-            documents.extend(get_news(size=size))
+            source_documents = get_news(size=size)
+            sources.extend(["news"] * len(source_documents))
         elif source == 'papers':
-            documents.extend(read_papers(size=size))
+            source_documents = read_papers(size=size)
+            sources.extend(pdf_source(document.metadata["file_name"]) for document in source_documents)
         elif source == 'stories':
-            documents.extend(get_stories(size=size))
+            source_documents = get_stories(size=size)
+            sources.extend(["stories"] * len(source_documents))
         else:
             logger.error(f"Unknown data source: {source}")
+            continue
+        documents.extend(source_documents)
+
+    # the IDs hash the text as stored, and do not depend on the shuffle
+    resize_documents(documents, max_document_size)
+    set_document_ids(documents, sources)
 
     if shuffle:
         random.shuffle(documents)
-
-    resize_documents(documents, max_document_size)
     
     nodes = documents
     save_nodes(nodes, os.path.join(base_dir_for_run(run_id, base_dir), "nodes_0_samples.json"))
@@ -67,6 +76,7 @@ def load_urls(run_id: str, urls: List[str], base_dir: str, max_document_size: Op
         document.metadata["url"] = document.id_
 
     resize_documents(documents, max_document_size)
+    set_document_ids(documents, [document.metadata["url"] for document in documents])
 
     save_nodes(documents, os.path.join(base_dir_for_run(run_id, base_dir), "nodes_0_urls.json"))
     return True
@@ -85,6 +95,7 @@ def load_uploaded_files(run_id: str, upload_dir: str, base_dir: str, max_documen
             logger.error(f"can not handle uploaded file {file}: extension is not supported: {extension}")
         
     resize_documents(documents, max_document_size)
+    set_document_ids(documents, [pdf_source(document.metadata["file_name"]) for document in documents])
     nodes = documents
     save_nodes(nodes, os.path.join(base_dir_for_run(run_id, base_dir), "nodes_0_uploads.json"))
 
@@ -145,7 +156,6 @@ def load_web_pages(run_id: str, search_query: str, base_dir: str, max_web_pages:
     print(f"web_body_only: {web_body_only}")
     if web_body_only:
         documents = [Document(
-            id_=result.get("href"),
             text=f"Title: {result.get('title')}\n\n{result.get('body')}",
             metadata={
                 "url": result.get("href")
@@ -154,6 +164,7 @@ def load_web_pages(run_id: str, search_query: str, base_dir: str, max_web_pages:
         print(f"documents: {documents}")
 
         resize_documents(documents, max_document_size)
+        set_document_ids(documents, [document.metadata["url"] for document in documents])
         save_nodes(documents, os.path.join(base_dir_for_run(run_id, base_dir), "nodes_0_urls.json"))
         return True
 
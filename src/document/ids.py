@@ -0,0 +1,62 @@
+"""Deterministic IDs of documents and nodes.
+
+Documents get an ID derived from their source (data set, file name, url) and
+from a hash of their text, chunks an ID derived from their document ID and
+their position, and summary nodes an ID derived from the nodes they
+summarize. Loading and processing the same corpus again gives the same IDs,
+so anything built from IDs (metadata, relationships, prompts) hits the cache.
+Documents are identified after their text is truncated, and copies of the
+same text from the same source get their rank among the copies in their ID.
+"""
+
+import hashlib
+import logging
+import uuid
+from collections import defaultdict
+from typing import Sequence, Union
+
+from llama_index.core.schema import Document
+
+logger = logging.getLogger(__name__)
+
+# fixed namespace of the uuid5 IDs, changing it changes all the IDs
+ID_NAMESPACE = uuid.UUID("6f0c3c55-4d55-4b8e-9a55-2b0f2c9c1d7e")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+def stable_id(*parts: str) -> str:
+    """uuid5 of the given parts, formatted like the default llama-index IDs."""
+    return str(uuid.uuid5(ID_NAMESPACE, "\x1f".join(parts)))
+
+
+def document_id(source: str, text: str, occurrence: int = 0) -> str:
+    """ID of the `occurrence`-th document of a source with this text, the first one keeps the ID of a unique document."""
+    if occurrence == 0:
+        return stable_id("document", source, content_hash(text))
+    return stable_id("document", source, content_hash(text), str(occurrence))
+
+
+def set_document_ids(documents: Sequence[Document], sources: Union[str, Sequence[str]]) -> None:
+    """Set the ID of documents from their source (one for all or one per document) and their text."""
+    if isinstance(sources, str):
+        sources = [sources] * len(documents)
+    occurrences = defaultdict(int)
+    for document, source in zip(documents, sources):
+        key = (source, content_hash(document.text))
+        document.id_ = document_id(source, document.text, occurrences[key])
+        if occurrences[key] > 0:
+            logger.warning(f"document {document.id_} is copy {occurrences[key]} of a document of {source}")
+        occurrences[key] += 1
+
+
+def chunk_id_func(i: int, doc: Document) -> str:
+    """`id_func` of the node parsers: the i-th chunk of a document."""
+    return stable_id("chunk", doc.id_, str(i))
+
+
+def summary_id(children_ids: Sequence[str], i: int) -> str:
+    """ID of the i-th summary of a list of nodes."""
+    return stable_id("summary", *children_ids, str(i))
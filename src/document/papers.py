@@ -66,6 +66,11 @@ def download_papers():
 def list_files_in_dir(dir_path):
     return os.listdir(dir_path)
 
+def pdf_source(file_path):
+    """Source of the ID of a pdf document."""
+    return f"pdf/{os.path.basename(file_path)}"
+
+
 def read_first_page_of_pdf(file_path):
     reader = PDFReader(return_full_document=False)
     documents = reader.load_data(file_path)
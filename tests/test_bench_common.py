@@ -0,0 +1,41 @@
+from benchmarks import common
+from benchmarks.common import compare_results, latency_summary, measure
+
+
+def test_latency_summary():
+    summary = latency_summary([float(i) for i in range(1, 101)])
+    assert summary["count"] == 100
+    assert summary["p50"] == 50.0
+    assert summary["p95"] == 95.0
+    assert summary["p99"] == 99.0
+    assert summary["max"] == 100.0
+    assert latency_summary([]) == {"count": 0}
+
+
+def test_compare_results():
+    baseline = [
+        {"size": 100, "step": "2", "wall_time": 10.0, "llm_requests": 100},
+        {"size": 100, "step": "3", "wall_time": 0.01, "llm_requests": 0},
+    ]
+    rows = [
+        {"size": 100, "step": "2", "wall_time": 11.0, "llm_requests": 150},
+        {"size": 100, "step": "3", "wall_time": 0.05, "llm_requests": 0},
+        {"size": 1000, "step": "2", "wall_time": 100.0, "llm_requests": 1000},
+    ]
+    regressions = compare_results(rows, baseline, ["size", "step"], ["wall_time", "llm_requests"], tolerance=0.2, min_value=0.1)
+    assert [(r["step"], r["metric"]) for r in regressions] == [("2", "llm_requests")]
+    assert regressions[0]["ratio"] == 1.5
+
+
+def test_measure_keeps_the_peak_rss_only_if_reset(monkeypatch):
+    monkeypatch.setattr(common, "reset_peak_rss", lambda: False)
+    with measure() as metrics:
+        pass
+    # the peak of the whole process is not a metric of the block
+    assert "peak_rss" not in metrics
+    assert metrics["wall_time"] >= 0
+
+    monkeypatch.setattr(common, "reset_peak_rss", lambda: True)
+    with measure() as metrics:
+        pass
+    assert metrics["peak_rss"] > 0
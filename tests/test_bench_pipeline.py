@@ -0,0 +1,25 @@
+from benchmarks import bench_pipeline
+from benchmarks.bench_pipeline import build_corpus
+from src.document.ids import document_id
+
+
+def test_corpus_ids_are_those_of_the_loaders(monkeypatch):
+    monkeypatch.setattr(bench_pipeline, "load_base_texts", lambda sources: [])
+    documents = build_corpus(6, ["stories", "news", "papers"])
+    assert documents[0].id_ == document_id("stories", documents[0].text)
+    assert documents[1].id_ == document_id("news", documents[1].text)
+    assert documents[2].metadata["file_name"] == "paper_2.pdf"
+    assert documents[2].id_ == document_id("pdf/paper_2.pdf", documents[2].text)
+    assert [document.id_ for document in build_corpus(3, ["stories", "news", "papers"])] == [
+        document.id_ for document in documents[:3]
+    ]
+
+
+def test_repeated_texts_keep_their_source(monkeypatch):
+    base_texts = [("stories", "A story.", {}), ("stories", "Another story.", {}), ("news", "A news.", {})]
+    monkeypatch.setattr(bench_pipeline, "load_base_texts", lambda sources: base_texts)
+    documents = build_corpus(4, ["stories", "news"])
+    assert [document.id_ for document in documents[:3]] == [
+        document_id("stories", "A story."), document_id("stories", "Another story."), document_id("news", "A news.")
+    ]
+    assert documents[3].id_ == document_id("stories", documents[3].text)
@@ -0,0 +1,96 @@
+import os
+import pickle
+import sqlite3
+
+from src.cache.cache_backend import (
+    PickleDirBackend,
+    SqliteBackend,
+    import_pickle_dir,
+    split_legacy_key,
+)
+
+LEGACY_KEY = "src.cache.wrapper_chat_with_cache_" + "a" * 64 + "b" * 32
+
+
+def test_split_legacy_key():
+    assert split_legacy_key(LEGACY_KEY) == ("src.cache.wrapper_chat_with_cache", "b" * 32)
+    assert split_legacy_key("not_a_legacy_key") == ("", "")
+
+
+def test_sqlite_backend_batched_commits(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    backend = SqliteBackend(path, batch_size=10, flush_interval=3600)
+    backend.set("key", b"value", func="func", source_hash="hash")
+
+    # pending writes are readable before being committed
+    assert backend.get("key") == b"value"
+    assert "key" in backend
+    assert SqliteBackend(path).get("key") is None
+
+    backend.flush()
+    assert SqliteBackend(path).get("key") == b"value"
+    assert backend.get("missing") is None
+
+    backend.delete("key")
+    assert backend.get("key") is None
+
+
+def test_sqlite_backend_reads_legacy_pickle_files(tmp_path):
+    with open(tmp_path / f"{LEGACY_KEY}.pickle", "wb") as f:
+        pickle.dump("cached answer", f)
+    backend = SqliteBackend(str(tmp_path / "cache.sqlite3"), legacy_dir=str(tmp_path))
+
+    assert pickle.loads(backend.get(LEGACY_KEY)) == "cached answer"
+    os.remove(tmp_path / f"{LEGACY_KEY}.pickle")
+    assert pickle.loads(backend.get(LEGACY_KEY)) == "cached answer"
+
+
+def test_import_pickle_dir(tmp_path):
+    pickle_dir = str(tmp_path / "pickles")
+    pickle_backend = PickleDirBackend(pickle_dir)
+    pickle_backend.set(LEGACY_KEY, pickle.dumps([1.0, 2.0]))
+    pickle_backend.set("other_key", pickle.dumps("text"))
+
+    backend = SqliteBackend(str(tmp_path / "cache.sqlite3"))
+    assert import_pickle_dir(pickle_dir, backend) == 2
+    assert import_pickle_dir(pickle_dir, backend) == 0
+    assert len(backend) == 2
+    assert pickle.loads(backend.get(LEGACY_KEY)) == [1.0, 2.0]
+
+
+def test_sqlite_backend_eviction_and_prune(tmp_path):
+    backend = SqliteBackend(str(tmp_path / "cache.sqlite3"))
+    for i in range(4):
+        backend.set(f"key{i}", b"x" * 100, func="func", source_hash="old" if i == 0 else "new")
+    backend.flush()
+    backend.get("key1")
+    backend.get("key1")
+    backend.get("key2")
+
+    # least frequently used first: key0 and key3 were never read
+    assert backend.evict(max_bytes=250, policy="lfu") == 2
+    assert "key1" in backend and "key2" in backend and "key3" not in backend
+
+    backend.set("key0", b"x" * 100, func="func", source_hash="old")
+    backend.set("other", b"x", func="unknown_func", source_hash="hash")
+    assert backend.prune({"func": {"new"}}) == 1
+    assert "key0" not in backend and "other" in backend
+    assert backend.prune({"func": {"new"}}, include_unknown=True) == 1
+    backend.compact()
+    assert len(backend) == 2
+
+
+def test_sqlite_backend_adds_access_columns(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE cache (key TEXT PRIMARY KEY, func TEXT NOT NULL, source_hash TEXT NOT NULL,"
+        " value BLOB NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO cache VALUES ('key', 'func', 'hash', x'00', 1, 1.0)")
+    conn.commit()
+    conn.close()
+
+    backend = SqliteBackend(path, max_age=3600)
+    # entries of the old database are aged from their creation time
+    assert backend.get("key") is None
@@ -0,0 +1,35 @@
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+
+from src.cache import wrapper  # noqa: F401 registers the chat message canonicalizer
+from src.cache.cache_key import canonical_hash
+
+
+def test_canonical_hash_is_order_independent_for_dicts():
+    assert canonical_hash({"a": 1, "b": [1.0, "x"]}) == canonical_hash({"b": [1.0, "x"], "a": 1})
+    assert canonical_hash({1: "a", "1": "b"}) == canonical_hash({"1": "b", 1: "a"})
+
+
+def test_canonical_hash_distinguishes_types_and_boundaries():
+    hashes = {
+        canonical_hash("1"),
+        canonical_hash(1),
+        canonical_hash(1.0),
+        canonical_hash(True),
+        canonical_hash(None),
+        canonical_hash(["ab", "c"]),
+        canonical_hash(["a", "bc"]),
+        canonical_hash("ab", "c"),
+    }
+    assert len(hashes) == 8
+
+
+def test_canonical_hash_chat_messages():
+    message = ChatMessage(role=MessageRole.USER, content="hello")
+    assert canonical_hash([message]) == canonical_hash([ChatMessage(role=MessageRole.USER, content="hello")])
+    assert canonical_hash([message]) != canonical_hash([ChatMessage(role=MessageRole.ASSISTANT, content="hello")])
+
+
+def test_canonical_hash_reference_cycles():
+    value = {"name": "root"}
+    value["self"] = value
+    assert canonical_hash(value) == canonical_hash(value)
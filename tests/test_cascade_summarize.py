@@ -0,0 +1,84 @@
+from typing import List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload, LlamaDebugHandler
+from llama_index.core.indices.prompt_helper import PromptHelper
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from src.classification.cascade_summarize import CascadeSummarize, select_representative_chunks
+
+TOPICS = ["castle", "dragon", "forest", "river"]
+
+
+class TopicEmbedding(BaseEmbedding):
+    """One dimension per topic word of the text."""
+
+    def _embed(self, text: str) -> List[float]:
+        return [float(text.count(topic)) for topic in TOPICS]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+
+class NonBlankPromptHelper(PromptHelper):
+    """Drops the blank chunks once repacked."""
+
+    def repack(self, prompt, text_chunks, **kwargs):
+        return [chunk for chunk in super().repack(prompt, text_chunks, **kwargs) if chunk.strip()]
+
+
+def make_chunks(topics):
+    return [NodeWithScore(node=TextNode(id_=f"chunk_{i}", text=f"The {topic}.")) for i, topic in enumerate(topics)]
+
+
+def chunk_ids(chunks):
+    return [chunk.node.id_ for chunk in chunks]
+
+
+def test_all_chunks_under_the_limit():
+    chunks = make_chunks(["castle"] * 3)
+    assert chunk_ids(select_representative_chunks(chunks, 5, TopicEmbedding())) == ["chunk_0", "chunk_1", "chunk_2"]
+    assert chunk_ids(select_representative_chunks(chunks, None)) == ["chunk_0", "chunk_1", "chunk_2"]
+
+
+def test_evenly_spaced_without_embeddings():
+    chunks = make_chunks(["castle"] * 9)
+    assert chunk_ids(select_representative_chunks(chunks, 3)) == ["chunk_0", "chunk_4", "chunk_8"]
+
+
+def test_mmr_covers_the_topics_in_order():
+    topics = ["castle", "castle", "castle", "dragon", "castle", "castle", "forest", "castle", "river"]
+    chunks = make_chunks(topics)
+    selected = select_representative_chunks(chunks, 4, TopicEmbedding())
+    # first and last chunks, then the topics not covered yet, in the order of the document
+    assert chunk_ids(selected) == ["chunk_0", "chunk_3", "chunk_6", "chunk_8"]
+    assert chunk_ids(select_representative_chunks(chunks, 4, TopicEmbedding())) == chunk_ids(selected)
+
+
+def test_documents_without_chunks_to_summarize():
+    summarizer = CascadeSummarize(
+        llm=MockLLM(max_tokens=5), prompt_helper=NonBlankPromptHelper(), callback_manager=CallbackManager([])
+    )
+    blank = [NodeWithScore(node=TextNode(id_=f"chunk_{i}", text=" ")) for i in range(3)]
+    responses = summarizer.synthesize_documents("Summarize.", [blank, [], make_chunks(["castle"])], num_workers=2)
+    assert [str(response) for response in responses][:2] == ["Empty Response"] * 2
+
+
+def test_each_document_has_its_synthesize_event():
+    handler = LlamaDebugHandler(print_trace_on_end=False)
+    summarizer = CascadeSummarize(llm=MockLLM(max_tokens=5), callback_manager=CallbackManager([handler]))
+    documents = [make_chunks(["castle"] * 3), [], make_chunks(["dragon"] * 2)]
+    responses = list(summarizer.synthesize_documents("Summarize.", documents, num_workers=2))
+
+    events = handler.get_event_pairs(CBEventType.SYNTHESIZE)
+    assert [start.payload[EventPayload.QUERY_STR] for start, _ in events] == ["Summarize."] * 2
+    assert sorted(id(end.payload[EventPayload.RESPONSE]) for _, end in events) == sorted(
+        id(responses[i]) for i in (0, 2)
+    )
@@ -0,0 +1,139 @@
+import contextvars
+import json
+import os
+import random
+import time
+
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import CompletionResponse, MockLLM
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import Document
+
+from src.classification import cascade_summary_index
+from src.classification.cascade_summarize import CascadeSummarize
+from src.classification.cascade_summary_index import CascadeSummaryIndex
+from src.document.ids import chunk_id_func
+
+caller_step = contextvars.ContextVar("caller_step", default=None)
+
+
+class SlowLLM(MockLLM):
+    """Answers the last words of the prompt after a random delay, with the context variable of the caller."""
+
+    def complete(self, prompt, formatted=False, **kwargs):
+        time.sleep(random.uniform(0, 0.02))
+        return CompletionResponse(text=f"# {caller_step.get()} {' '.join(prompt.split()[-5:])}")
+
+
+def make_documents(doc_ids=range(6)):
+    return [
+        # from a single level to several levels of summaries
+        Document(text=" ".join(f"Sentence {i} of document {doc}." for i in range(60 * 4 ** (doc % 3))), doc_id=f"doc_{doc}")
+        for doc in doc_ids
+    ]
+
+
+def index_kwargs(num_workers):
+    llm = SlowLLM()
+    return dict(
+        llm=llm,
+        transformations=[SentenceSplitter(chunk_size=100, chunk_overlap=0, id_func=chunk_id_func)],
+        response_synthesizer=CascadeSummarize(llm=llm, callback_manager=CallbackManager([])),
+        embed_model=MockEmbedding(embed_dim=8),
+        embed_summaries=False,
+        num_workers=num_workers,
+    )
+
+
+def build_index(num_workers, documents=None):
+    caller_step.set("summaries")
+    return CascadeSummaryIndex.from_documents(documents or make_documents(), **index_kwargs(num_workers))
+
+
+def summaries(index):
+    return [
+        (doc_id, index.docstore.get_node(summary_id).text)
+        for doc_id, summary_id in index.index_struct.doc_id_to_summary_id.items()
+    ]
+
+
+def test_concurrent_summaries_are_deterministic():
+    serial = build_index(num_workers=1)
+    concurrent = build_index(num_workers=4)
+    assert [doc_id for doc_id, _ in summaries(concurrent)] == [f"doc_{doc}" for doc in range(6)]
+    assert summaries(concurrent) == summaries(serial)
+    assert list(concurrent.docstore.docs) == list(serial.docstore.docs)
+    for node_id, node in serial.docstore.docs.items():
+        assert concurrent.docstore.docs[node_id].to_dict() == node.to_dict()
+
+
+def test_concurrent_summaries_keep_the_context():
+    index = build_index(num_workers=4)
+    assert all(text.startswith("# summaries") for _, text in summaries(index))
+
+
+def test_progress_goes_to_the_end(monkeypatch):
+    exhausted = []
+
+    def progress(items, show_progress, desc):
+        yield from items
+        exhausted.append(desc)
+
+    monkeypatch.setattr(cascade_summary_index, "get_tqdm_iterable", progress)
+    build_index(num_workers=4)
+    assert exhausted == ["Summarizing documents"]
+
+
+def test_refresh_only_summarizes_new_and_changed_documents(tmp_path):
+    persist_dir = str(tmp_path / "summary_index")
+    index = build_index(num_workers=4, documents=make_documents([0, 1, 2, 3]))
+    index.storage_context.persist(persist_dir=persist_dir)
+    index.persist_manifest(persist_dir)
+
+    # doc_0 removed, doc_2 changed, doc_4 added
+    documents = make_documents([1, 2, 3, 4])
+    documents[1].set_content(documents[1].text + " One more sentence.")
+    index = CascadeSummaryIndex.from_persist_dir(persist_dir, **index_kwargs(num_workers=4))
+    summarized, removed = index.refresh_documents(documents)
+    assert sorted(summarized) == ["doc_2", "doc_4"]
+    assert removed == ["doc_0"]
+    index.storage_context.persist(persist_dir=persist_dir)
+    index.persist_manifest(persist_dir)
+
+    reloaded = CascadeSummaryIndex.from_persist_dir(persist_dir, **index_kwargs(num_workers=4))
+    rebuilt = build_index(num_workers=4, documents=documents)
+    assert sorted(summaries(reloaded)) == sorted(summaries(rebuilt))
+    assert sorted(reloaded.docstore.docs) == sorted(rebuilt.docstore.docs)
+    assert reloaded.index_struct.node_id_to_summary_id == rebuilt.index_struct.node_id_to_summary_id
+
+
+def test_deleted_document_is_summarized_again_when_added_back(tmp_path):
+    persist_dir = str(tmp_path / "summary_index")
+    index = build_index(num_workers=4, documents=make_documents([0, 1, 2]))
+    index.delete_document("doc_1")
+    assert index.docstore.get_document_hash("doc_1") is None
+    index.storage_context.persist(persist_dir=persist_dir)
+    index.persist_manifest(persist_dir)
+    with open(os.path.join(persist_dir, "manifest.json")) as f:
+        assert sorted(json.load(f)["documents"]) == ["doc_0", "doc_2"]
+
+    index = CascadeSummaryIndex.from_persist_dir(persist_dir, **index_kwargs(num_workers=4))
+    summarized, removed = index.refresh_documents(make_documents([0, 1, 2]))
+    assert summarized == ["doc_1"]
+    assert removed == []
+    rebuilt = build_index(num_workers=4, documents=make_documents([0, 1, 2]))
+    assert sorted(summaries(index)) == sorted(summaries(rebuilt))
+    assert sorted(index.docstore.docs) == sorted(rebuilt.docstore.docs)
+
+
+def test_settings_change_invalidates_the_persisted_index(tmp_path):
+    persist_dir = str(tmp_path / "summary_index")
+    index = build_index(num_workers=1, documents=make_documents([0]))
+    index.storage_context.persist(persist_dir=persist_dir)
+    index.persist_manifest(persist_dir)
+    assert os.path.exists(os.path.join(persist_dir, "manifest.json"))
+
+    kwargs = index_kwargs(num_workers=1)
+    assert CascadeSummaryIndex.from_persist_dir(persist_dir, **kwargs) is not None
+    assert CascadeSummaryIndex.from_persist_dir(persist_dir, **kwargs, summary_query="Summarize.") is None
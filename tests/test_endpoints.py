@@ -0,0 +1,68 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from llama_index.core.base.llms.types import ChatMessage
+
+from src.cache import retry
+from src.cache.endpoints import EndpointPool
+from src.cache.ollama_clients import get_native_llm
+
+
+def start_stub_server(status_code):
+    """Ollama stub answering /api/chat with its port, or with an error status code."""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            received.append(self.path)
+            port = self.server.server_address[1]
+            body = json.dumps({
+                "model": "stub",
+                "message": {"role": "assistant", "content": f"answer from {port}"},
+                "done": True,
+                "prompt_eval_count": 5,
+                "eval_count": 3,
+            }).encode()
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", received
+
+
+@pytest.fixture
+def stub_servers():
+    servers = [start_stub_server(200), start_stub_server(200), start_stub_server(503)]
+    yield servers
+    for server, _, _ in servers:
+        server.shutdown()
+
+
+def test_endpoint_pool_spreads_requests_and_ejects_failing_endpoints(stub_servers, monkeypatch):
+    monkeypatch.setattr(retry, "LLM_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(retry, "LLM_MAX_RETRIES", 3)
+    urls = [url for _, url, _ in stub_servers]
+    pool = EndpointPool("test", urls, ejection_failures=2, ejection_seconds=60)
+    messages = [ChatMessage(role="user", content="question")]
+
+    def chat():
+        return pool.call(lambda url: get_native_llm("stub", base_url=url).chat(messages))
+
+    answers = [retry.call_with_retry("test_endpoints", chat).message.content for _ in range(12)]
+
+    assert all(answer.startswith("answer from") for answer in answers)
+    ok_counts = [len(received) for _, _, received in stub_servers[:2]]
+    assert min(ok_counts) >= 4
+    # ejected after 2 failures, not probed again before the end of the ejection
+    assert len(stub_servers[2][2]) == 2
+    assert pool.endpoints[2].nb_ejections == 1
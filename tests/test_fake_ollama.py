@@ -0,0 +1,82 @@
+import http.client
+import json
+import time
+
+import numpy as np
+import pytest
+import yaml
+from llama_index.core.base.llms.types import ChatMessage
+
+from benchmarks.fake_ollama import (
+    FakeOllamaServer,
+    LatencyModel,
+    answer,
+    classification_system_answer,
+    embedding,
+)
+from src.cache.ollama_clients import get_native_embed_model, get_native_llm
+from src.classification.classification_assignment_extractor import (
+    DEFAULT_TYPE_ASSIGN_PROMPT,
+    ClassificationAssignementExtractor,
+)
+from cli import CLEAN_TYPES
+
+
+@pytest.fixture
+def server():
+    server = FakeOllamaServer(latency=LatencyModel(time_scale=0)).start()
+    yield server
+    server.stop()
+
+
+def test_chat_is_deterministic(server):
+    llm = get_native_llm("fake", base_url=server.url)
+    messages = [ChatMessage(role="user", content="Once upon a time a king lived in a castle. He was old.")]
+    first = llm.chat(messages)
+    second = llm.chat(messages)
+    assert first.message.content == second.message.content
+    assert first.message.content.startswith("# ")
+    assert first.raw["prompt_eval_count"] > 0
+    assert server.stats["chat_summary"] == 2
+
+
+def test_assignment_answer_is_parsed_as_a_leaf():
+    extractor = ClassificationAssignementExtractor.__new__(ClassificationAssignementExtractor)
+    tree_str = extractor.fill_intermediate_branches(extractor.parse_tree_and_tags(classification_system_answer("")))
+    prompt = DEFAULT_TYPE_ASSIGN_PROMPT.format(context_str="physics of the stars", category_tree_str=tree_str)
+    kind, text = answer(prompt)
+    assert kind == "classification_assignment"
+    data = yaml.safe_load(text)
+    assert data["hierarchical_classification"] == ["Science - Physics"]
+    assert data["tags"]
+
+
+def test_clean_types_answer_is_json():
+    kind, text = answer(CLEAN_TYPES.format(types_str=str(["story", "story-short", "news"])))
+    assert kind == "clean_types"
+    data = json.loads(text)
+    assert sorted(data["cleaned_types"]) == ["news", "story"]
+    assert data["mapping"]["story"] == ["story", "story-short"]
+
+
+def test_embeddings_of_similar_texts_are_close(server):
+    embed_model = get_native_embed_model("fake", base_url=server.url)
+    first = np.array(embed_model.get_text_embedding("the king and the princess"))
+    assert first.tolist() == embedding("the king and the princess")
+    close = np.array(embedding("the old king and the princess"))
+    far = np.array(embedding("inflation rate of the economy"))
+    assert first @ close > first @ far
+
+
+def test_keep_alive_requests_add_no_latency(server):
+    connection = http.client.HTTPConnection(server.server_address[0], server.server_address[1])
+    body = json.dumps({"model": "fake", "input": ["the king"]})
+    start = time.perf_counter()
+    for _ in range(20):
+        connection.request("POST", "/api/embed", body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.status == 200
+        response.read()
+    connection.close()
+    # the same connection for every request, with no stall on the small writes of each reply
+    assert (time.perf_counter() - start) / 20 < 0.02
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from src.cache import file_cache, serialization
+from src.cache.cache_backend import SqliteBackend
+from src.cache.file_cache import legacy_cache_key
+from src.cache.memory_cache import MemoryLRUCache
+
+LEGACY_SOURCE_HASH = "a" * 32
+
+
+class SlowBackend(SqliteBackend):
+    """Backend with slow reads and writes, failing writes if `fail_writes` is set."""
+
+    delay = 0.2
+    fail_writes = False
+
+    def get(self, key):
+        time.sleep(self.delay)
+        return super().get(key)
+
+    def set(self, key, value, func="", source_hash=""):
+        time.sleep(self.delay)
+        if self.fail_writes:
+            raise OSError("disk full")
+        super().set(key, value, func, source_hash)
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    backend = SqliteBackend(str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(file_cache, "global_cache_backend", backend)
+    monkeypatch.setattr(file_cache, "global_memory_cache", MemoryLRUCache(100, 1_000_000))
+    monkeypatch.setattr(file_cache, "DISABLE_CACHE", False)
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def slow_backend(tmp_path, monkeypatch):
+    backend = SlowBackend(str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(file_cache, "global_cache_backend", backend)
+    # no memory cache, every read goes to the backend
+    monkeypatch.setattr(file_cache, "global_memory_cache", MemoryLRUCache(0, 0))
+    monkeypatch.setattr(file_cache, "DISABLE_CACHE", False)
+    yield backend
+    backend.close()
+
+
+def test_legacy_entries_are_only_reused_for_their_settings(backend):
+    settings = {"model": "new"}
+
+    @file_cache.file_cache(
+        key_func=lambda text: (dict(settings), text),
+        legacy_source_hash=LEGACY_SOURCE_HASH,
+        use_legacy=lambda text: settings["model"] == "former",
+    )
+    def upper(text):
+        return text.upper()
+
+    backend.set(legacy_cache_key(upper.__wrapped__, LEGACY_SOURCE_HASH, ("a",), {}), serialization.dumps("legacy A"))
+    # the legacy entry was written by another model, it is neither reused nor copied under the new key
+    assert upper("a") == "A"
+    settings["model"] = "former"
+    assert upper("a") == "legacy A"
+    settings["model"] = "new"
+    assert upper("a") == "A"
+
+
+def make_async_upper():
+    nb_calls = 0
+
+    @file_cache.afile_cache()
+    async def upper(text):
+        nonlocal nb_calls
+        nb_calls += 1
+        return text.upper()
+
+    return upper, lambda: nb_calls
+
+
+def test_async_read_after_write(slow_backend):
+    upper, nb_calls = make_async_upper()
+
+    async def main():
+        # the second read waits in the cache I/O thread for the write submitted by the first call
+        return [await upper("a"), await upper("a")]
+
+    assert asyncio.run(main()) == ["A", "A"]
+    assert nb_calls() == 1
+
+
+def test_async_reads_do_not_block_the_event_loop(slow_backend):
+    upper, _ = make_async_upper()
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    async def main():
+        ticker = asyncio.create_task(tick())
+        result = await upper("a")
+        ticker.cancel()
+        return result
+
+    assert asyncio.run(main()) == "A"
+    # the loop ran during the slow read of the backend
+    assert ticks >= 5
+
+
+def test_async_write_errors_are_logged(slow_backend, caplog):
+    slow_backend.fail_writes = True
+    upper, nb_calls = make_async_upper()
+
+    async def main():
+        return [await upper("a"), await upper("a")]
+
+    with caplog.at_level(logging.INFO, logger=file_cache.__name__):
+        assert asyncio.run(main()) == ["A", "A"]
+        file_cache.global_cache_io_executor.submit(lambda: None).result()
+    assert nb_calls() == 2
+    assert "disk full" in caplog.text
@@ -0,0 +1,52 @@
+import os
+
+from llama_index.core.node_parser import SentenceSplitter
+
+from src.document import document
+from src.document.ids import chunk_id_func, document_id, set_document_ids
+from src.document.stories import stories_to_documents, story_to_document
+from src.run.utils import base_dir_for_run, load_nodes
+
+
+def test_ids_are_stable_across_loads():
+    story = ["Once upon a time, a king took a long bath. " * 30, "The end."]
+    splitter = SentenceSplitter(chunk_size=100, chunk_overlap=10, id_func=chunk_id_func)
+
+    first_documents, second_documents = [story_to_document(story)], [story_to_document(story)]
+    set_document_ids(first_documents, "stories")
+    set_document_ids(second_documents, "stories")
+    first_nodes = splitter.get_nodes_from_documents(first_documents)
+    second_nodes = splitter.get_nodes_from_documents(second_documents)
+
+    assert len(first_nodes) > 1
+    assert [n.id_ for n in first_nodes] == [n.id_ for n in second_nodes]
+    assert first_nodes[0].ref_doc_id == document_id("stories", "\n".join(story))
+    assert len({n.id_ for n in first_nodes}) == len(first_nodes)
+
+
+def test_document_ids_depend_on_source_and_text():
+    assert document_id("news", "text") == document_id("news", "text")
+    assert document_id("news", "text") != document_id("stories", "text")
+    assert document_id("news", "text") != document_id("news", "other text")
+
+
+def test_copies_of_a_document_get_distinct_ids():
+    documents = stories_to_documents([["The same story."], ["Another story."], ["The same story."]])
+    set_document_ids(documents, "stories")
+    assert documents[0].id_ == document_id("stories", "The same story.")
+    assert documents[2].id_ == document_id("stories", "The same story.", 1)
+    assert len({document.id_ for document in documents}) == 3
+
+
+def test_sample_ids_hash_the_truncated_text(tmp_path, monkeypatch):
+    stories = [["Once upon a time, a king took a long bath."], ["Once upon a time, a king took a nap."]]
+    monkeypatch.setattr(document, "get_stories", lambda size: stories_to_documents(stories))
+    document.load_samples_documents("ids", str(tmp_path), "stories:2", shuffle=True, max_document_size=20)
+
+    nodes = load_nodes(os.path.join(base_dir_for_run("ids", str(tmp_path)), "nodes_0_samples.json"))
+    # both stories are the same once truncated
+    truncated = stories[0][0][:20]
+    assert [node.text for node in nodes] == [truncated] * 2
+    assert sorted(node.id_ for node in nodes) == sorted(
+        [document_id("stories", truncated), document_id("stories", truncated, 1)]
+    )
@@ -0,0 +1,34 @@
+import asyncio
+
+from src.cache import ledger
+
+
+def test_ledger_records_calls_of_the_recorded_steps(tmp_path):
+    async def achat():
+        # nested calls share the record of the outer call
+        with ledger.record_call("chat"):
+            ledger.note(cache="miss")
+            ledger.note_tokens({"prompt_eval_count": 100, "eval_count": 20})
+
+    async def apredict():
+        with ledger.record_call("predict", prompt_id="p1"):
+            ledger.note_count("retries")
+            await achat()
+
+    with ledger.record_call("chat"):
+        pass  # not recorded, outside of a step
+    with ledger.recording(str(tmp_path), "step_1"):
+        asyncio.run(apredict())
+        with ledger.record_call("predict", prompt_id="p2"):
+            ledger.note(cache="memory", prompt_tokens=50, completion_tokens=5)
+
+    records = ledger.read_ledger(str(tmp_path / ledger.LEDGER_FILE_NAME))
+    assert [(r["step"], r["kind"], r["prompt_id"], r["cache"]) for r in records] == [
+        ("step_1", "predict", "p1", "miss"),
+        ("step_1", "predict", "p2", "memory"),
+    ]
+    assert records[0]["prompt_tokens"] == 100 and records[0]["retries"] == 1
+
+    summary = ledger.summarize_ledger(records, group_by=["prompt_id"], sort_by="tokens")
+    # cached calls do not count in the tokens
+    assert [(group["prompt_id"], group["tokens"], group["cached"]) for group in summary] == [("p1", 120, 0), ("p2", 0, 1)]
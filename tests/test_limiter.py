@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from src.cache.limiter import AIMDController, Limiter, TokenBucket
+
+
+def test_limiter_bounds_threads_and_coroutines():
+    limiter = Limiter("test", max_concurrency=2)
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def track():
+        nonlocal max_in_flight
+        with lock:
+            max_in_flight = max(max_in_flight, limiter.in_use)
+
+    def sync_call():
+        with limiter.slot():
+            track()
+            time.sleep(0.02)
+
+    async def async_call():
+        async with limiter.aslot():
+            track()
+            await asyncio.sleep(0.02)
+
+    async def async_calls():
+        await asyncio.gather(*[async_call() for _ in range(5)])
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        futures = [executor.submit(sync_call) for _ in range(5)]
+        futures.append(executor.submit(asyncio.run, async_calls()))
+        for future in futures:
+            future.result()
+
+    assert max_in_flight == 2
+    assert limiter.nb_acquired == 10
+    assert limiter.in_use == 0 and limiter.queue_depth == 0
+
+
+def test_limiter_cancelled_waiter_does_not_leak_a_slot():
+    limiter = Limiter("test", max_concurrency=1)
+
+    async def main():
+        await limiter.aacquire()
+        waiter = asyncio.ensure_future(limiter.aacquire())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        limiter.release()
+
+    asyncio.run(main())
+    assert limiter.in_use == 0
+    with limiter.slot():
+        assert limiter.in_use == 1
+
+
+def test_token_bucket_delays():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.05 < bucket.reserve() <= 0.1
+
+
+def test_aimd_controller_increases_and_decreases_the_limit():
+    limiter = Limiter("test", max_concurrency=2)
+    controller = AIMDController(limiter, min_limit=1, max_limit=4, target_latency=1.0, window=3)
+
+    # 3 fast requests while the pool is full: one more slot
+    limiter.acquire()
+    limiter.acquire()
+    for _ in range(3):
+        controller.record_success(0.1)
+    assert limiter.limit == 3
+    # not saturated: the limit stays
+    limiter.release()
+    limiter.release()
+    for _ in range(3):
+        controller.record_success(0.1)
+    assert limiter.limit == 3
+    # slow requests: half the slots
+    for _ in range(3):
+        controller.record_success(2.0)
+    assert limiter.limit == 1
+    controller._last_decrease_time = None
+    limiter.set_limit(4)
+
+    try:
+        with limiter.slot():
+            raise httpx.ReadTimeout("timed out")
+    except httpx.ReadTimeout:
+        pass
+    assert limiter.limit == 2 and controller.nb_overloads == 1
+
+    # other errors do not change the limit
+    try:
+        with limiter.slot():
+            raise ValueError("bad prompt")
+    except ValueError:
+        pass
+    assert limiter.limit == 2
+
+
+def test_limiter_lowered_limit_drains_slots():
+    limiter = Limiter("test", max_concurrency=2)
+    limiter.acquire()
+    limiter.acquire()
+    limiter.set_limit(1)
+    waiter = limiter._try_acquire()
+    limiter.release()
+    # still one in flight, at the new limit
+    assert not waiter.done() and limiter.in_use == 1
+    limiter.release()
+    assert waiter.done() and limiter.in_use == 1
+    limiter.set_limit(2)
+    assert limiter.acquire() is None and limiter.in_use == 2
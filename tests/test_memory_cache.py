@@ -0,0 +1,27 @@
+from src.cache.memory_cache import MISSING, MemoryLRUCache
+
+
+def test_memory_cache_evicts_least_recently_used_entries():
+    cache = MemoryLRUCache(max_entries=2, max_bytes=100)
+    cache.set("a", "value a", 10)
+    cache.set("b", "value b", 10)
+    assert cache.get("a") == "value a"
+
+    cache.set("c", "value c", 10)
+    assert cache.get("b", MISSING) is MISSING
+    assert cache.get("a") == "value a"
+    assert cache.get("c") == "value c"
+    assert cache.evictions == 1
+
+
+def test_memory_cache_is_bounded_in_bytes():
+    cache = MemoryLRUCache(max_entries=10, max_bytes=100)
+    cache.set("a", "value a", 60)
+    cache.set("b", "value b", 60)
+    assert cache.get("a") is None
+    assert cache.nb_bytes == 60
+
+    # entries larger than the cache are not kept
+    cache.set("c", "value c", 200)
+    assert cache.get("c") is None
+    assert cache.get("b") == "value b"
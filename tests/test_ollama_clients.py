@@ -0,0 +1,53 @@
+import asyncio
+
+from src.cache.ollama_clients import get_native_embed_model, get_native_llm
+
+
+def test_native_models_and_clients_are_reused():
+    llm = get_native_llm("model", kwargs={"temperature": 0})
+    assert get_native_llm("model", kwargs={"temperature": 0}) is llm
+    assert get_native_llm("other model", kwargs={"temperature": 0}) is not llm
+    assert get_native_llm("other model", kwargs={"temperature": 0}).client is llm.client
+    assert get_native_embed_model("embed model") is get_native_embed_model("embed model")
+
+    async def get_async_client():
+        return llm.async_client, llm.async_client
+
+    first_loop_clients = asyncio.run(get_async_client())
+    second_loop_clients = asyncio.run(get_async_client())
+    assert first_loop_clients[0] is first_loop_clients[1]
+    assert first_loop_clients[0] is not second_loop_clients[0]
+
+
+def test_query_embeddings_use_the_pooled_clients(monkeypatch):
+    from benchmarks.fake_ollama import FakeOllamaServer, LatencyModel
+    from src.cache import file_cache, ollama_clients, wrapper
+
+    class UnusedClient:
+        def embeddings(self, **kwargs):
+            raise AssertionError("query embedded with the client of the base class")
+
+    pooled_hosts = []
+    get_client = ollama_clients.get_client
+
+    def spy_get_client(host, timeout):
+        pooled_hosts.append(host)
+        return get_client(host, timeout)
+
+    monkeypatch.setattr(ollama_clients, "get_client", spy_get_client)
+    monkeypatch.setattr(file_cache, "DISABLE_CACHE", True)
+    monkeypatch.setattr(wrapper, "DISABLE_CACHE", True)
+    server = FakeOllamaServer(latency=LatencyModel(time_scale=0)).start()
+    try:
+        embed_model = wrapper.EmbeddingWrapper("fake", base_urls=[server.url])
+        embed_model._client = UnusedClient()
+        embed_model._async_client = UnusedClient()
+        nb_embed_calls = wrapper.global_nb_embed_calls
+        embedding = embed_model.get_query_embedding("What happened in the forest?")
+        assert embedding == asyncio.run(embed_model.aget_query_embedding("What happened in the forest?"))
+        assert len(embedding) > 0
+        assert wrapper.global_nb_embed_calls == nb_embed_calls + 2
+        assert server.stats["embed"] == 2
+        assert pooled_hosts == [server.url, server.url]
+    finally:
+        server.stop()
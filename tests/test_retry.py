@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from src.cache import retry
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(retry, "LLM_RETRY_BASE_DELAY", 0)
+
+
+def test_call_with_retry_retries_transient_errors():
+    nb_calls = 0
+
+    def flaky():
+        nonlocal nb_calls
+        nb_calls += 1
+        if nb_calls < 3:
+            raise httpx.ReadTimeout("timed out")
+        return "answer"
+
+    assert retry.call_with_retry("test_retry", flaky) == "answer"
+    assert retry.global_retry_stats["test_retry"]["retries"] == 2
+
+    def invalid():
+        raise ValueError("bad prompt")
+
+    with pytest.raises(ValueError):
+        retry.call_with_retry("test_retry", invalid)
+    assert retry.global_retry_stats["test_retry"]["retries"] == 2
+    assert retry.global_retry_stats["test_retry"]["failures"] == 1
+
+
+def test_slow_calls_are_hedged(monkeypatch):
+    monkeypatch.setattr(retry, "LLM_HEDGE_PERCENTILE", 95)
+    monkeypatch.setattr(retry, "LLM_HEDGE_MIN_SAMPLES", 5)
+    for name in ["test_hedge", "test_ahedge"]:
+        for _ in range(5):
+            retry.record_latency(name, 0.01)
+
+    nb_calls = 0
+
+    def slow_then_fast():
+        nonlocal nb_calls
+        nb_calls += 1
+        time.sleep(1.0 if nb_calls == 1 else 0.01)
+        return nb_calls
+
+    start_time = time.monotonic()
+    assert retry.call_with_retry("test_hedge", slow_then_fast) == 2
+    assert time.monotonic() - start_time < 0.5
+    assert retry.global_retry_stats["test_hedge"]["hedge_wins"] == 1
+
+    nb_acalls = 0
+
+    async def aslow_then_fast():
+        nonlocal nb_acalls
+        nb_acalls += 1
+        await asyncio.sleep(1.0 if nb_acalls == 1 else 0.01)
+        return nb_acalls
+
+    start_time = time.monotonic()
+    assert asyncio.run(retry.acall_with_retry("test_ahedge", aslow_then_fast)) == 2
+    assert time.monotonic() - start_time < 0.5
+    assert retry.global_retry_stats["test_ahedge"]["hedges"] == 1
@@ -0,0 +1,34 @@
+import pickle
+
+import numpy as np
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
+
+from src.cache import serialization
+from src.cache import wrapper  # noqa: F401 registers the chat response kind
+
+
+def test_serialization_round_trips():
+    text = "a cached summary " * 100
+    assert serialization.loads(serialization.dumps(text)) == text
+    assert serialization.loads(serialization.dumps(text, codec="none")) == text
+    assert serialization.loads(serialization.dumps({"any": ("value",)})) == {"any": ("value",)}
+
+    embeddings = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]]
+    assert serialization.loads(serialization.dumps(embeddings)) == np.float32(embeddings).tolist()
+    assert serialization.loads(serialization.dumps(embeddings, embeddings_dtype="float16")) == np.float16(embeddings).tolist()
+
+
+def test_serialization_chat_response():
+    response = ChatResponse(
+        message=ChatMessage(role=MessageRole.ASSISTANT, content="answer", additional_kwargs={"tool_calls": []}),
+        raw={"model": "model", "message": {"content": "answer"}, "eval_count": 3},
+    )
+    data = serialization.dumps(response)
+    assert data.startswith(serialization.MAGIC)
+    loaded = serialization.loads(data)
+    assert loaded.message == response.message
+    assert loaded.raw == {"model": "model", "eval_count": 3}
+
+
+def test_serialization_reads_legacy_pickles():
+    assert serialization.loads(pickle.dumps(["legacy", 1])) == ["legacy", 1]
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.cache.single_flight import SingleFlight
+
+
+def test_single_flight_threads():
+    flight = SingleFlight()
+    nb_calls = 0
+    started = threading.Event()
+
+    def call():
+        nonlocal nb_calls
+        nb_calls += 1
+        started.set()
+        time.sleep(0.2)
+        return "result"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        leader = executor.submit(flight.do, "key", call)
+        started.wait()
+        followers = [executor.submit(flight.do, "key", call) for _ in range(3)]
+        assert leader.result() == ("result", False)
+        assert [follower.result() for follower in followers] == [("result", True)] * 3
+    assert nb_calls == 1
+    assert len(flight) == 0
+
+
+def test_single_flight_async_errors_are_shared():
+    flight = SingleFlight()
+    nb_calls = 0
+
+    async def call():
+        nonlocal nb_calls
+        nb_calls += 1
+        await asyncio.sleep(0.05)
+        raise ValueError("backend error")
+
+    async def main():
+        return await asyncio.gather(*[flight.ado("key", call) for _ in range(5)], return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert nb_calls == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    with pytest.raises(ValueError):
+        asyncio.run(flight.ado("key", call))
+    assert nb_calls == 2
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from src.cache.vector_cache import VectorCache
+
+
+def test_vector_cache_per_text(tmp_path):
+    cache = VectorCache(str(tmp_path), {"model": "test"})
+    assert cache.get_many(["a", "b"]) == [None, None]
+
+    stored = cache.put_many(["a", "b", "a"], [[0.1, 0.2], [0.3, 0.4], [0.1, 0.2]])
+    assert stored == np.float32([[0.1, 0.2], [0.3, 0.4], [0.1, 0.2]]).tolist()
+    assert len(cache) == 2
+
+    # batch boundaries do not matter, only the texts
+    assert cache.get_many(["b", "c", "a"]) == [stored[1], None, stored[0]]
+    cache.put_many(["c"], [[0.5, 0.6]])
+    assert cache.get_many(["c"]) == [np.float32([0.5, 0.6]).tolist()]
+    cache.close()
+
+    reopened = VectorCache(str(tmp_path), {"model": "test"})
+    assert reopened.dim == 2
+    assert reopened.get_many(["a", "b", "c"])[2] == np.float32([0.5, 0.6]).tolist()
+    assert VectorCache(str(tmp_path), {"model": "other"}).get_many(["a"]) == [None]
+
+
+def test_vector_cache_rejects_other_dimensions(tmp_path):
+    cache = VectorCache(str(tmp_path), "model")
+    cache.put_many(["a"], [[0.1, 0.2]])
+    with pytest.raises(ValueError):
+        cache.put_many(["b"], [[0.1, 0.2, 0.3]])
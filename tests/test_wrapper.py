@@ -0,0 +1,51 @@
+import pytest
+from llama_index.core.base.llms.types import ChatMessage
+
+from benchmarks.fake_ollama import FakeOllamaServer, LatencyModel
+from src.cache import file_cache, serialization, wrapper
+from src.cache.cache_backend import SqliteBackend
+from src.cache.file_cache import legacy_cache_key
+from src.cache.memory_cache import MemoryLRUCache
+
+
+def test_llm_budget_is_per_tier_and_kept_by_new_wrappers(monkeypatch):
+    monkeypatch.setattr(wrapper, "global_llm_backends", {})
+    monkeypatch.setattr(wrapper, "global_native_llm", wrapper.global_native_llm)
+    small = wrapper.LLMWrapper("model", max_nb_calls=1, base_urls=["http://localhost:1"], tier="small")
+    wrapper.LLMWrapper("other model", max_nb_calls=5, base_urls=["http://localhost:1"], tier="large")
+
+    small._update_and_check_nb_calls()
+    with pytest.raises(Exception, match="small LLM"):
+        small._update_and_check_nb_calls()
+
+    # set_api_key builds the wrappers again, the calls already made still count
+    small = wrapper.LLMWrapper("model", max_nb_calls=1, base_urls=["http://localhost:1"], tier="small")
+    with pytest.raises(Exception, match="small LLM"):
+        small._update_and_check_nb_calls()
+    assert wrapper.global_llm_backends["large"].nb_calls == 0
+
+
+def test_small_tier_does_not_reuse_the_legacy_entries_of_the_large_model(tmp_path, monkeypatch):
+    backend = SqliteBackend(str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(file_cache, "global_cache_backend", backend)
+    monkeypatch.setattr(file_cache, "global_memory_cache", MemoryLRUCache(100, 1_000_000))
+    monkeypatch.setattr(file_cache, "DISABLE_CACHE", False)
+    monkeypatch.setattr(wrapper, "global_llm_backends", {})
+    monkeypatch.setattr(wrapper, "global_native_llm", wrapper.global_native_llm)
+    server = FakeOllamaServer(latency=LatencyModel(time_scale=0)).start()
+    try:
+        large = wrapper.LLMWrapper(wrapper.LEGACY_LLM_MODEL, kwargs=wrapper.LEGACY_LLM_KWARGS, base_urls=[server.url])
+        small = wrapper.LLMWrapper("small model", kwargs=wrapper.LEGACY_LLM_KWARGS, base_urls=[server.url], tier="small")
+        messages = [ChatMessage(role="user", content="Once upon a time a king lived in a castle.")]
+        legacy_key = legacy_cache_key(wrapper.chat_with_cache.__wrapped__, "8eb7d743d2b9066b6de773abc1c61bc7", (messages,), {})
+        backend.set(legacy_key, serialization.dumps(wrapper.ChatResponse(message=ChatMessage(role="assistant", content="legacy"))))
+
+        assert small.chat(messages).message.content != "legacy"
+        assert server.stats["chat"] == 1
+        # nor later, from the entry saved by the first call
+        assert small.chat(messages).message.content != "legacy"
+        assert large.chat(messages).message.content == "legacy"
+        assert server.stats["chat"] == 1
+    finally:
+        server.stop()
+        backend.close()